@@ -0,0 +1,153 @@
+# bmu_search.py
+
+"""
+Best-matching-unit search backends over a trained SOM's codebook: brute force,
+exact KD-tree / ball-tree, and an approximate projected-tree mode with a recall knob.
+"""
+
+import numpy as np
+from minisom import MiniSom
+from scipy import sparse
+from sklearn.neighbors import KDTree, BallTree
+from typing import Tuple
+
+
+class BMUIndex:
+    """
+    Nearest-unit index over a flattened codebook, built once per trained SOM and
+    reused for assignment, scoring new data and quality metrics.
+
+    Methods:
+        "brute":    exact; full ||x||^2 + ||w||^2 - 2 x.w distance block per query.
+        "kdtree":   exact; sklearn KDTree over the codebook (best for few features).
+        "balltree": exact; sklearn BallTree over the codebook (copes better with
+                    many features).
+        "approx":   approximate; a KD-tree over the codebook projected onto its top
+                    n_components principal axes proposes n_candidates units per row,
+                    which are then re-ranked exactly. Raising n_candidates trades
+                    speed for recall (see measure_recall).
+
+    Sparse (CSR) queries always use the ||x||^2 + ||w||^2 - 2 x.w expansion,
+    whatever the method: it only touches each row's non-zeros, where trees would
+    need dense rows.
+    """
+
+    def __init__(
+        self,
+        codebook: np.ndarray,
+        method: str = "brute",
+        leaf_size: int = 40,
+        n_components: int = 8,
+        n_candidates: int = 10
+    ):
+        self.codebook = np.ascontiguousarray(codebook, dtype=float)
+        self.method = method
+        n_nodes, n_features = self.codebook.shape
+        self._w_sq = (self.codebook ** 2).sum(axis=1)
+
+        if method == "kdtree":
+            self._tree = KDTree(self.codebook, leaf_size=leaf_size)
+        elif method == "balltree":
+            self._tree = BallTree(self.codebook, leaf_size=leaf_size)
+        elif method == "approx":
+            self._mean = self.codebook.mean(axis=0)
+            _, _, vt = np.linalg.svd(self.codebook - self._mean, full_matrices=False)
+            self._proj = vt[:min(n_components, n_features)].T
+            self._tree = KDTree((self.codebook - self._mean) @ self._proj, leaf_size=leaf_size)
+            self.n_candidates = max(2, min(n_candidates, n_nodes))
+        elif method != "brute":
+            raise ValueError(f"Unknown BMU search method: {method!r}")
+
+    def query(self, x: np.ndarray, k: int = 2) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Find the k nearest units of each row of x.
+
+        Parameters:
+            x: 2D array or scipy sparse matrix (rows × features) in the codebook's
+               (scaled) feature space.
+            k: number of units to return per row.
+
+        Returns:
+            (dist, ind): Euclidean distances and flat node indices, both shaped
+            (rows, k) and sorted nearest first.
+        """
+        if sparse.issparse(x):
+            x_sq = np.asarray(x.multiply(x).sum(axis=1)).ravel()
+            d_sq = x_sq[:, None] + self._w_sq[None, :] - 2 * np.asarray(x @ self.codebook.T)
+            return self._top_k(d_sq, np.arange(d_sq.shape[1])[None, :], k)
+        if self.method == "brute":
+            d_sq = (x ** 2).sum(axis=1)[:, None] + self._w_sq[None, :] - 2 * x @ self.codebook.T
+            return self._top_k(d_sq, np.arange(d_sq.shape[1])[None, :], k)
+        if self.method in ("kdtree", "balltree"):
+            return self._tree.query(x, k=k)
+
+        cand = self._tree.query(
+            (x - self._mean) @ self._proj, k=max(k, self.n_candidates), return_distance=False
+        )
+        d_sq = ((x[:, None, :] - self.codebook[cand]) ** 2).sum(axis=2)
+        return self._top_k(d_sq, cand, k)
+
+    @staticmethod
+    def _top_k(d_sq: np.ndarray, ind: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+        # partial sort to the k smallest, then order just those
+        if k < d_sq.shape[1]:
+            part = np.argpartition(d_sq, k - 1, axis=1)[:, :k]
+        else:
+            part = np.broadcast_to(np.arange(d_sq.shape[1]), d_sq.shape)
+        part_d = np.take_along_axis(d_sq, part, axis=1)
+        order = np.argsort(part_d, axis=1)
+        part = np.take_along_axis(part, order, axis=1)
+        dist = np.sqrt(np.maximum(np.take_along_axis(part_d, order, axis=1), 0))
+        return dist, np.take_along_axis(np.broadcast_to(ind, d_sq.shape), part, axis=1)
+
+
+def build_bmu_index(
+    som: MiniSom,
+    method: str = "brute",
+    projection=None,
+    **kwargs
+) -> BMUIndex:
+    """
+    Build a BMU search index over a trained SOM's codebook.
+
+    Parameters:
+        som: a trained MiniSom object.
+        method: "brute", "kdtree", "balltree" or "approx" (see BMUIndex).
+        projection: optional som_model.fit_projection; the index is then built
+            over the codebook's reduced coordinates and must be queried with
+            projected rows (som_model.find_bmus does this).
+        **kwargs: leaf_size, n_components, n_candidates, passed to BMUIndex.
+
+    Returns:
+        A BMUIndex whose flat node indices follow get_weights() order (i * y_dim + j).
+    """
+    w = som.get_weights()
+    codebook = w.reshape(-1, w.shape[-1])
+    if projection is not None:
+        codebook = projection.transform(codebook)
+    return BMUIndex(codebook, method=method, **kwargs)
+
+
+def measure_recall(
+    index: BMUIndex,
+    values: np.ndarray,
+    n_sample: int = 1000,
+    random_seed: int = 42
+) -> float:
+    """
+    Share of sampled rows whose BMU from index matches the exact brute-force BMU.
+
+    Parameters:
+        index: the (typically approximate) index to check.
+        values: 2D array of scaled feature rows.
+        n_sample: rows to sample for the check.
+        random_seed: for reproducibility.
+
+    Returns:
+        Recall@1 in [0, 1].
+    """
+    rng = np.random.default_rng(random_seed)
+    rows = rng.choice(len(values), size=min(n_sample, len(values)), replace=False)
+    x = values[rows]
+    exact = BMUIndex(index.codebook, method="brute").query(x, k=1)[1][:, 0]
+    return float((index.query(x, k=1)[1][:, 0] == exact).mean())
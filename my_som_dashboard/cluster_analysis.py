@@ -1,57 +1,196 @@
 # cluster_analysis.py
 
 """
-Perform hierarchical clustering on SOM nodes and assign cluster labels to each observation.
+Cluster SOM nodes (hierarchical, grid-constrained or k-means) and assign cluster labels
+to each observation.
 """
 
+import numpy as np
 import pandas as pd
 from minisom import MiniSom
-from sklearn.cluster import AgglomerativeClustering
+from scipy import sparse
+from scipy.optimize import linear_sum_assignment
+from sklearn.cluster import AgglomerativeClustering, KMeans
+from som_model import find_bmus
+from data_loader import build_attribute_index
+from typing import Dict, List, Tuple
+
+
+def grid_connectivity(
+    x_dim: int,
+    y_dim: int,
+    topology: str = "hexagonal"
+) -> sparse.csr_matrix:
+    """
+    Sparse adjacency matrix of the SOM grid, in node order i * y_dim + j.
+
+    Parameters:
+        x_dim, y_dim: dimensions of the SOM grid.
+        topology: "hexagonal" (6 neighbours in the axial layout drawn by build_hex_plot)
+                  or "rectangular" (4 neighbours).
+
+    Returns:
+        A symmetric (x_dim*y_dim, x_dim*y_dim) CSR matrix with O(nodes) non-zeros.
+    """
+    if topology == "hexagonal":
+        offsets = [(1, 0), (0, 1), (1, -1)]
+    elif topology == "rectangular":
+        offsets = [(1, 0), (0, 1)]
+    else:
+        raise ValueError(f"Unknown topology: {topology!r}")
+
+    ii, jj = np.meshgrid(np.arange(x_dim), np.arange(y_dim), indexing="ij")
+    rows, cols = [], []
+    for di, dj in offsets:
+        ni, nj = ii + di, jj + dj
+        ok = (ni >= 0) & (ni < x_dim) & (nj >= 0) & (nj < y_dim)
+        rows.append((ii * y_dim + jj)[ok])
+        cols.append((ni * y_dim + nj)[ok])
+    rows = np.concatenate(rows)
+    cols = np.concatenate(cols)
+
+    n_nodes = x_dim * y_dim
+    adj = sparse.coo_matrix(
+        (np.ones(2 * len(rows)), (np.concatenate([rows, cols]), np.concatenate([cols, rows]))),
+        shape=(n_nodes, n_nodes)
+    )
+    return adj.tocsr()
+
+
+def cluster_nodes(
+    som: MiniSom,
+    n_clusters: int = 5,
+    method: str = "agglomerative",
+    topology: str = "hexagonal",
+    random_seed: int = 42
+) -> np.ndarray:
+    """
+    Cluster the trained SOM's node weights.
+
+    Parameters:
+        som: trained MiniSom instance.
+        n_clusters: number of clusters to form on the SOM grid.
+        method: "agglomerative" (unconstrained Ward, quadratic in the number of nodes),
+                "connected" (Ward restricted to grid neighbours; near-linear and
+                yields spatially contiguous clusters on the hex grid) or
+                "kmeans" (k-means on the codebook).
+        topology: grid adjacency used by "connected" (see grid_connectivity).
+        random_seed: for reproducibility of "kmeans".
+
+    Returns:
+        A 1D numpy array of length (x_dim * y_dim) with each node's cluster label.
+    """
+    weights = som.get_weights()  # shape (x_dim, y_dim, features)
+    x_dim, y_dim, _ = weights.shape
+    flat_weights = weights.reshape(x_dim * y_dim, -1)
+
+    if method == "agglomerative":
+        model = AgglomerativeClustering(n_clusters=n_clusters)
+    elif method == "connected":
+        model = AgglomerativeClustering(
+            n_clusters=n_clusters,
+            connectivity=grid_connectivity(x_dim, y_dim, topology)
+        )
+    elif method == "kmeans":
+        model = KMeans(n_clusters=n_clusters, n_init=10, random_state=random_seed)
+    else:
+        raise ValueError(f"Unknown clustering method: {method!r}")
+    return model.fit_predict(flat_weights)
+
+
+def align_labels(labels: np.ndarray, reference: np.ndarray) -> np.ndarray:
+    """
+    Renumber node cluster labels to best match a reference labelling (maximum
+    node overlap), so successive clusterings of an evolving map keep their colors.
+
+    Parameters:
+        labels: new per-node labels.
+        reference: previous per-node labels for the same nodes.
+
+    Returns:
+        labels with clusters renumbered; the partition itself is unchanged.
+    """
+    k = int(max(labels.max(), reference.max())) + 1
+    overlap = np.zeros((k, k), dtype=int)
+    np.add.at(overlap, (labels, reference), 1)
+    rows, cols = linear_sum_assignment(-overlap)
+    mapping = np.empty(k, dtype=int)
+    mapping[rows] = cols
+    return mapping[labels]
 
 
 def assign_clusters(
     som: MiniSom,
     data_df: pd.DataFrame,
-    n_clusters: int = 5
+    n_clusters: int = 5,
+    method: str = "agglomerative",
+    node_labels: np.ndarray = None,
+    bmus: np.ndarray = None
 ) -> pd.DataFrame:
     """
-    Perform agglomerative clustering on the trained SOM's node weights,
+    Cluster the trained SOM's node weights (see cluster_nodes),
     then assign each data observation to the cluster of its Best Matching Unit.
 
     Parameters:
         som: trained MiniSom instance.
         data_df: DataFrame used for SOM training (observations × features).
         n_clusters: number of clusters to form on the SOM grid.
+        method: node clustering method passed to cluster_nodes.
+        node_labels: precomputed output of cluster_nodes; skips the clustering step.
+        bmus: precomputed flat BMU indices from som_model.find_bmus; skips the BMU search.
 
     Returns:
-        DataFrame: original data_df with three new columns:
+        DataFrame: data_df's columns (sharing its arrays, not copied) plus three
+        int32 columns:
             - 'bmu_x', 'bmu_y': coordinates of each observation's BMU node.
             - 'hc_cluster': cluster label for each observation.
     """
     # 1) Cluster the SOM's nodes
-    weights = som.get_weights()  # shape (x_dim, y_dim, features)
-    x_dim, y_dim, _ = weights.shape
-    flat_weights = weights.reshape(x_dim * y_dim, -1)
-    hc = AgglomerativeClustering(n_clusters=n_clusters)
-    node_labels = hc.fit_predict(flat_weights)
+    x_dim, y_dim, _ = som.get_weights().shape
+    if node_labels is None:
+        node_labels = cluster_nodes(som, n_clusters, method)
 
     # 2) For each observation, find its Best Matching Unit (BMU)
-    features = data_df.drop(columns=["hex_x", "hex_y"], errors="ignore")
-    values = features.values
-    bmus = [som.winner(obs) for obs in values]
-    bmu_x = [pt[0] for pt in bmus]
-    bmu_y = [pt[1] for pt in bmus]
-    flat_idx = [i * y_dim + j for i, j in bmus]
+    if bmus is None:
+        bmus = find_bmus(som, data_df)[0]
 
     # 3) Assign cluster label based on BMU's node label
-    clusters = [int(node_labels[idx]) for idx in flat_idx]
+    clusters = np.asarray(node_labels)[bmus].astype(np.int32)
 
-    # 4) Return augmented DataFrame
-    df_out = data_df.copy()
-    df_out['bmu_x'] = bmu_x
-    df_out['bmu_y'] = bmu_y
-    df_out['hc_cluster'] = clusters
-    return df_out
+    # 4) Return the features alongside the assignment arrays
+    assignments = pd.DataFrame({
+        'bmu_x': (bmus // y_dim).astype(np.int32),
+        'bmu_y': (bmus % y_dim).astype(np.int32),
+        'hc_cluster': clusters,
+    }, index=data_df.index)
+    return pd.concat([data_df, assignments], axis=1, copy=False)
+
+
+def assignment_index(hex_df: pd.DataFrame) -> Dict[str, dict]:
+    """
+    Attribute index (data_loader.build_attribute_index) of each observation's
+    cluster and BMU, so attribute queries can say "cluster = 2" or "bmu_x < 3".
+    """
+    return build_attribute_index(pd.DataFrame({
+        'cluster': hex_df['hc_cluster'].values,
+        'bmu_x': hex_df['bmu_x'].values,
+        'bmu_y': hex_df['bmu_y'].values,
+    }))
+
+
+def _feature_columns(hex_df: pd.DataFrame) -> List[str]:
+    """
+    Numeric feature columns of hex_df, minus the SOM bookkeeping columns.
+    """
+    # (dtype checks rather than select_dtypes, so sparse float columns count too)
+    numeric_cols = [
+        c for c, t in hex_df.dtypes.items()
+        if pd.api.types.is_numeric_dtype(t) and not pd.api.types.is_bool_dtype(t)
+    ]
+    return [
+        c for c in numeric_cols
+        if c not in {"hc_cluster", "bmu_x", "bmu_y", "hex_x", "hex_y"}
+    ]
 
 
 def compute_cluster_means(
@@ -66,19 +205,87 @@ def compute_cluster_means(
     Returns:
         A DataFrame with 'hc_cluster' and the mean of each numeric column.
     """
-    numeric_cols = (
-        hex_df
-        .select_dtypes(include=[float, int])
-        .columns
-    )
-    numeric_cols = [
-        c for c in numeric_cols
-        if c not in {"hc_cluster", "bmu_x", "bmu_y", "hex_x", "hex_y"}
-    ]
-    cluster_means = (
-        hex_df
-        .groupby('hc_cluster')[numeric_cols]
-        .mean()
-        .reset_index()
-    )
-    return cluster_means
+    # bincount per column instead of a groupby, which cannot aggregate the sparse
+    # feature columns of scale_data(sparse=True) without densifying them all
+    hc = hex_df['hc_cluster'].values
+    present = np.unique(hc)
+    means = {'hc_cluster': present}
+    for c in _feature_columns(hex_df):
+        v = np.asarray(hex_df[c], dtype=float)
+        ok = ~np.isnan(v)  # NaNs are skipped, as by groupby().mean()
+        n = np.bincount(hc[ok], minlength=hc.max() + 1)[present]
+        total = np.bincount(hc[ok], weights=v[ok], minlength=hc.max() + 1)[present]
+        means[c] = np.divide(total, n, out=np.full(len(present), np.nan), where=n > 0)
+    return pd.DataFrame(means)
+
+
+def compute_node_stats(
+    hex_df: pd.DataFrame,
+    x_dim: int,
+    y_dim: int
+) -> pd.DataFrame:
+    """
+    Per-node sufficient statistics (observation count and feature sums).
+
+    Means for any set of nodes (a cluster, a lasso on the hex grid, the BMUs of
+    selected regions) are then sum(sums) / sum(_n) over those rows, which costs
+    O(nodes x features) instead of a groupby over every observation.
+
+    Parameters:
+        hex_df: output of assign_clusters (features plus 'bmu_x', 'bmu_y').
+        x_dim, y_dim: dimensions of the SOM grid.
+
+    Returns:
+        A DataFrame of length (x_dim * y_dim), in the same node order as compute_umatrix,
+        with column '_n' (observations mapped to the node) and one sum column per feature.
+    """
+    n_nodes = x_dim * y_dim
+    node = hex_df['bmu_x'].values * y_dim + hex_df['bmu_y'].values
+
+    stats = {'_n': np.bincount(node, minlength=n_nodes)}
+    for c in _feature_columns(hex_df):
+        # np.asarray: sparse feature columns are densified one at a time
+        stats[c] = np.bincount(node, weights=np.asarray(hex_df[c], dtype=float),
+                               minlength=n_nodes)
+    return pd.DataFrame(stats)
+
+
+def compute_node_histograms(
+    hex_df: pd.DataFrame,
+    x_dim: int,
+    y_dim: int,
+    n_bins: int = 20
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Per-node feature histograms: a node x feature x bin count cube.
+
+    The histogram of any feature over any set of nodes (a cluster, a lasso on the
+    hex grid, the BMUs of selected regions) is then the sum of those nodes'
+    slices, independent of the number of observations.
+
+    Parameters:
+        hex_df: output of assign_clusters (features plus 'bmu_x', 'bmu_y').
+        x_dim, y_dim: dimensions of the SOM grid.
+        n_bins: equal-width bins per feature, spanning its observed range.
+
+    Returns:
+        (cube, edges): int32 counts of shape (x_dim * y_dim, features, n_bins), in
+        compute_umatrix node order and _feature_columns order (NaNs are not
+        counted), and the (features, n_bins + 1) bin edges.
+    """
+    n_nodes = x_dim * y_dim
+    node = hex_df['bmu_x'].values * y_dim + hex_df['bmu_y'].values
+    features = _feature_columns(hex_df)
+
+    cube = np.zeros((n_nodes, len(features), n_bins), dtype=np.int32)
+    edges = np.zeros((len(features), n_bins + 1))
+    for f, c in enumerate(features):
+        v = np.asarray(hex_df[c], dtype=float)
+        ok = ~np.isnan(v)
+        lo, hi = (v[ok].min(), v[ok].max()) if ok.any() else (0.0, 1.0)
+        edges[f] = np.linspace(lo, hi if hi > lo else lo + 1, n_bins + 1)
+        b = np.clip(np.searchsorted(edges[f], v[ok], side="right") - 1, 0, n_bins - 1)
+        cube[:, f, :] = np.bincount(
+            node[ok] * n_bins + b, minlength=n_nodes * n_bins
+        ).reshape(n_nodes, n_bins)
+    return cube, edges
@@ -0,0 +1,501 @@
+# dashboard.py
+
+"""
+Build the dashboard document for a dataset once per server process and hand
+every new session a clone of it.
+
+The template holds all widgets, plots and browser-side (CustomJS) callbacks, and
+is stored in the pipeline it was built from, so it lives and is evicted with it.
+Sessions get its JSON minus the large columns and the map's GeoJSON, then
+point their sources back at the template's objects, so those buffers are
+shared by reference. Selections and any data a session replaces (data-file
+refreshes, retraining) stay per session. Python callbacks are not part of the
+template; main.py attaches them to the clone's models, found by name.
+"""
+
+import json
+import os
+from typing import Dict, List, Tuple
+
+from bokeh.document import Document
+from bokeh.layouts import column, row
+from bokeh.models import CustomJS, Div, ColumnDataSource, Range1d
+from bokeh.events import ButtonClick, Tap
+
+from pipeline import PIPELINES
+from tiles import TileLoader, tile_dir_for
+from widgets import (
+    create_um_toggle, create_component_select, create_locate_input, create_filter_input,
+    create_cluster_buttons, create_training_controls, create_histogram_select
+)
+from plots import (
+    build_hex_plot, build_map_plot, build_data_table, build_selection_table,
+    build_histogram_plot
+)
+
+
+# dataset name -> TileLoader, or None when no tile pyramid was built
+_TILE_LOADERS: Dict[str, TileLoader] = {}
+
+EMPTY_GEOJSON = '{"type": "FeatureCollection", "features": []}'
+
+
+def quality_text(quality):
+    text = (f"QE {quality['quantization_error']:.3f} &middot; "
+            f"TE {quality['topographic_error']:.3f}")
+    if 'sample_size' in quality:
+        text += (f" (sample of {quality['sample_size']}: "
+                 f"QE {quality['sample_quantization_error']:.3f} &middot; "
+                 f"TE {quality['sample_topographic_error']:.3f})")
+    return text
+
+
+def map_columns(pipe):
+    # BMU coords for the map source, so it has them for region selection, plus
+    # each region's distance to its best and second-best unit
+    hex_df = pipe['hex_df']
+    return dict(
+        bmu_x=hex_df['bmu_x'].values, bmu_y=hex_df['bmu_y'].values,
+        bmu_dist=pipe['bmu_dist'], bmu2_dist=pipe['bmu2_dist']
+    )
+
+
+def tile_loader_for(name: str) -> TileLoader:
+    """
+    The dataset's TileLoader (one per process), or None without a tile pyramid.
+
+    Very large region sets: if a tile pyramid was built (python tiles.py <dataset>),
+    the map only ever holds the tiles intersecting the viewport.
+    """
+    if name not in _TILE_LOADERS:
+        tile_dir = tile_dir_for(name)
+        _TILE_LOADERS[name] = (TileLoader(tile_dir)
+                               if os.path.exists(os.path.join(tile_dir, "meta.json"))
+                               else None)
+    return _TILE_LOADERS[name]
+
+
+def tile_geojson(pipe: Dict[str, object], features: List[dict]) -> str:
+    """
+    GeoJSON of loaded tile features with their attributes refreshed from the
+    pipeline, keyed by region id. The features belong to the process's shared
+    TileLoader cache and are left unchanged.
+    """
+    hx = pipe['hex_df']
+    hc, bx, by = hx['hc_cluster'].values, hx['bmu_x'].values, hx['bmu_y'].values
+    refreshed = []
+    for feat in features:
+        r = feat['properties']['rid']
+        refreshed.append({**feat, 'properties': {
+            **feat['properties'],
+            'hc_cluster': int(hc[r]), 'bmu_x': int(bx[r]), 'bmu_y': int(by[r]),
+            'bmu_dist': float(pipe['bmu_dist'][r]), 'bmu2_dist': float(pipe['bmu2_dist'][r]),
+        }})
+    return json.dumps({'type': 'FeatureCollection', 'features': refreshed})
+
+
+def build_dashboard(doc: Document, pipe: Dict[str, object]) -> Tuple[Dict[str, object], List[dict]]:
+    """
+    Add the full dashboard for a pipeline to doc.
+
+    Returns:
+        (models, tile_features): the models Python callbacks need, by name (each
+        model's Bokeh name is set to the same key), and the initially loaded map
+        tiles (empty without a tile pyramid).
+    """
+    som              = pipe['som']
+    um_flat          = pipe['um_flat']
+    feature_names    = pipe['feature_names']
+    planes           = pipe['planes']
+    node_labels      = pipe['node_labels']
+    hex_df           = pipe['hex_df']
+    cluster_means_df = pipe['cluster_means_df']
+    y_dim            = pipe['y_dim']
+
+    # 4) Create widgets
+    toggle          = create_um_toggle()
+    plane_select    = create_component_select(feature_names)
+    locate_input    = create_locate_input()
+    filter_input    = create_filter_input()
+    view_div        = Div(text="", name="view_div")
+    quality_div     = Div(text=quality_text(pipe['quality']))
+    cluster_buttons = create_cluster_buttons(n_clusters=cluster_means_df.shape[0])
+    train_controls  = create_training_controls(pipe['x_dim'], y_dim)
+    hist_select     = create_histogram_select(feature_names)
+
+    # 5) Build plots & table
+    # build_hex_plot now returns a ColumnDataSource of one row per SOM unit
+    p_hex, source_hex = build_hex_plot(
+        hex_df, som, um_flat, toggle, planes, plane_select, node_labels
+    )
+
+    tile_loader   = tile_loader_for(pipe['name'])
+    tile_features = []
+    if tile_loader is not None:
+        (ox, oy), size = tile_loader.origin, tile_loader.size
+        tile_features = tile_loader.load((ox, oy, ox + size, oy + size), 450)
+        p_map, source_map = build_map_plot(
+            pipe['geo_df'], hex_df, cluster_buttons,
+            geojson=tile_geojson(pipe, tile_features)
+        )
+        # fixed ranges: the data bounds change as tiles stream in
+        p_map.x_range = Range1d(ox, ox + size)
+        p_map.y_range = Range1d(oy, oy + size)
+    else:
+        p_map, source_map = build_map_plot(pipe['geo_df'], hex_df, cluster_buttons,
+                                           columns=map_columns(pipe))
+
+    data_table   = build_data_table(cluster_means_df)
+    source_table = data_table.source
+
+    selection_table, source_stats = build_selection_table(pipe['node_stats'])
+    p_hist, source_hist, source_cube, source_edges = build_histogram_plot(
+        pipe['node_hist'], pipe['hist_edges'], feature_names
+    )
+
+    # 6a) Cluster‐button callbacks: select/deselect all units & regions in the cluster
+    for i, btn in enumerate(cluster_buttons):
+        btn.js_on_event(ButtonClick, CustomJS(args=dict(
+            hex_src=source_hex,
+            map_src=source_map,
+            table_src=source_table,
+            cl=i
+        ), code="""
+            // gather unit indices for cluster cl
+            const hex_inds = [];
+            const hx = hex_src.data['hc_cluster'];
+            for (let j = 0; j < hx.length; j++) {
+                if (hx[j] === cl) hex_inds.push(j);
+            }
+            // gather region indices for cluster cl
+            const map_inds = [];
+            const mx = map_src.data['hc_cluster'];
+            for (let j = 0; j < mx.length; j++) {
+                if (mx[j] === cl) map_inds.push(j);
+            }
+            // toggle-off if already selected
+            const already = table_src.selected.indices.length===1
+                           && table_src.selected.indices[0]===cl;
+            if (already) {
+                hex_src.selected.indices   = [];
+                map_src.selected.indices   = [];
+                table_src.selected.indices = [];
+            } else {
+                hex_src.selected.indices   = hex_inds;
+                map_src.selected.indices   = map_inds;
+                table_src.selected.indices = [cl];
+            }
+            hex_src.change.emit();
+            map_src.change.emit();
+            table_src.change.emit();
+        """))
+
+    # 6b) Hex‐plot → Map & Table connectivity: single‐unit selection
+    source_hex.selected.js_on_change('indices', CustomJS(args=dict(
+        hex_src=source_hex,
+        map_src=source_map,
+        table_src=source_table
+    ), code="""
+        const inds = hex_src.selected.indices;
+        if (hex_src.data._skip){
+            hex_src.data._skip = false;
+            return;
+        }
+        // selection set by the server (main.py select_from_server): leave as is
+        if (hex_src.tags.includes('server_selection')) {
+            hex_src.tags = [];
+            hex_src.data._last_sel = null;
+            return;
+        }
+        if (inds.length === 1 && hex_src.data._last_sel === inds[0]) {
+            hex_src.data._skip = true;
+            hex_src.selected.indices   = [];
+            map_src.selected.indices   = [];
+            table_src.selected.indices = [];
+            hex_src.data._last_sel = null;
+            hex_src.change.emit();
+            map_src.change.emit();
+            table_src.change.emit();
+            return;
+        }
+        hex_src.data._last_sel = inds.length === 1 ? inds[0] : null;
+        if (inds.length === 0) {
+            map_src.selected.indices   = [];
+            table_src.selected.indices = [];
+        } else if (inds.length === 1) {
+            const idx = inds[0];
+            // find all regions with matching BMU coords
+            const bx = hex_src.data['bmu_x'][idx];
+            const by = hex_src.data['bmu_y'][idx];
+            const xs = map_src.data['bmu_x'];
+            const ys = map_src.data['bmu_y'];
+            const region_inds = [];
+            for (let i = 0; i < xs.length; i++) {
+                if (xs[i] === bx && ys[i] === by) {
+                    region_inds.push(i);
+                }
+            }
+            map_src.selected.indices   = region_inds;
+            const cl = hex_src.data['hc_cluster'][idx];
+            table_src.selected.indices = [cl];
+        } else {
+            return;
+        }
+        map_src.change.emit();
+        table_src.change.emit();
+    """))
+
+    # 6c) Map‐plot → Hex & Table connectivity: single‐unit selection
+    source_map.selected.js_on_change('indices', CustomJS(args=dict(
+        hex_src=source_hex,
+        map_src=source_map,
+        table_src=source_table
+    ), code="""
+        const inds = map_src.selected.indices;
+        if (map_src.data._skip){
+            map_src.data._skip = false;
+            return;
+        }
+        // selection set by the server (main.py select_from_server): leave as is
+        if (map_src.tags.includes('server_selection')) {
+            map_src.tags = [];
+            map_src.data._last_sel = null;
+            return;
+        }
+        if (inds.length === 1 && map_src.data._last_sel === inds[0]) {
+            map_src.data._skip = true;
+            map_src.selected.indices   = [];
+            hex_src.selected.indices   = [];
+            table_src.selected.indices = [];
+            map_src.data._last_sel = null;
+            map_src.change.emit();
+            hex_src.change.emit();
+            table_src.change.emit();
+            return;
+        }
+        map_src.data._last_sel = inds.length === 1 ? inds[0] : null;
+        if (inds.length === 0) {
+            hex_src.selected.indices   = [];
+            table_src.selected.indices = [];
+        } else if (inds.length === 1) {
+            const idx = inds[0];
+            const bx  = map_src.data['bmu_x'][idx];
+            const by  = map_src.data['bmu_y'][idx];
+            const xs  = hex_src.data['bmu_x'];
+            const ys  = hex_src.data['bmu_y'];
+            let hex_i = null;
+            for (let i = 0; i < xs.length; i++) {
+                if (xs[i] === bx && ys[i] === by) { hex_i = i; break; }
+            }
+            hex_src.selected.indices   = hex_i !== null ? [hex_i] : [];
+            const cl = map_src.data['hc_cluster'][idx];
+            table_src.selected.indices = [cl];
+        } else {
+            return;
+        }
+        hex_src.change.emit();
+        table_src.change.emit();
+    """))
+
+
+
+    # 6e) Live selection summary and histogram from cached per-node sums and
+    #     histogram slices (never rescans rows, never calls the server)
+    summary_js = """
+        const nodes = new Set();
+        %s
+        const feats = Object.keys(sel_src.data).filter(f => f !== 'selection');
+        const counts = stats.data['_n'];
+        let n = 0;
+        const tot = {};
+        for (const f of feats) tot[f] = 0;
+        for (const k of nodes) {
+            n += counts[k];
+            for (const f of feats) tot[f] += stats.data[f][k];
+        }
+        const out = {selection: [`Selection (n=${n})`]};
+        for (const f of feats) out[f] = [n > 0 ? tot[f] / n : NaN];
+        sel_src.data = out;
+
+        // histogram of the chosen feature: sum the selected nodes' counts in the
+        // cube, which holds that feature only
+        const e = edges.data[hist_select.value];
+        const nb = e.length - 1;
+        const cnt = cube.data['counts'];
+        const n_nodes = cnt.length / nb;
+        const all = new Array(nb).fill(0), sel = new Array(nb).fill(0);
+        for (let k = 0; k < n_nodes; k++) {
+            for (let b = 0; b < nb; b++) all[b] += cnt[k * nb + b];
+        }
+        for (const k of nodes) {
+            for (let b = 0; b < nb; b++) sel[b] += cnt[k * nb + b];
+        }
+        hist_src.data = {left: Array.from(e.slice(0, nb)), right: Array.from(e.slice(1)),
+                         all: all, selected: sel};
+    """
+    summary_args = dict(
+        hex_src=source_hex, map_src=source_map,
+        stats=source_stats, sel_src=selection_table.source, y_dim=y_dim,
+        cube=source_cube, edges=source_edges, hist_src=source_hist,
+        hist_select=hist_select
+    )
+    source_hex.selected.js_on_change('indices', CustomJS(args=summary_args, code=summary_js % """
+        for (const k of hex_src.selected.indices) nodes.add(k);
+    """))
+    map_summary = CustomJS(args=summary_args, code=summary_js % """
+        const bx = map_src.data['bmu_x'];
+        const by = map_src.data['bmu_y'];
+        for (const i of map_src.selected.indices) nodes.add(bx[i] * y_dim + by[i]);
+    """)
+    source_map.selected.js_on_change('indices', map_summary)
+    # switching the histogram variable (main.py sends that feature's cube): the
+    # hex selection, else the map's
+    hist_summary = CustomJS(args=summary_args, code=summary_js % """
+        for (const k of hex_src.selected.indices) nodes.add(k);
+        if (nodes.size === 0) {
+            const bx = map_src.data['bmu_x'];
+            const by = map_src.data['bmu_y'];
+            for (const i of map_src.selected.indices) nodes.add(bx[i] * y_dim + by[i]);
+        }
+    """)
+    source_cube.js_on_change('data', hist_summary)
+
+
+    # 6d) Toggle selection on repeated taps
+    p_hex.js_on_event(Tap, CustomJS(args=dict(src=source_hex), code="""
+        const inds = src.selected.indices;
+        if (inds.length === 1) {
+            const idx = inds[0];
+            if (src.data._last_sel === idx) {
+                src.selected.indices = [];
+                src.data._last_sel = null;
+            } else {
+                src.data._last_sel = idx;
+            }
+            src.change.emit();
+        }
+    """))
+
+    p_map.js_on_event(Tap, CustomJS(args=dict(src=source_map), code="""
+        const inds = src.selected.indices;
+        if (inds.length === 1) {
+            const idx = inds[0];
+            if (src.data._last_sel === idx) {
+                src.selected.indices = [];
+                src.data._last_sel = null;
+            } else {
+                src.data._last_sel = idx;
+            }
+            src.change.emit();
+        }
+    """))
+
+    # 6d) Toggle selection on repeated taps
+    p_hex.js_on_event(Tap, CustomJS(args=dict(src=source_hex), code="""
+        const inds = src.selected.indices;
+        if (inds.length === 1) {
+            const idx = inds[0];
+            if (src.data._last_sel === idx) {
+                src.selected.indices = [];
+                src.data._last_sel = null;
+            } else {
+                src.data._last_sel = idx;
+            }
+            src.change.emit();
+        }
+    """))
+
+    p_map.js_on_event(Tap, CustomJS(args=dict(src=source_map), code="""
+        const inds = src.selected.indices;
+        if (inds.length === 1) {
+            const idx = inds[0];
+            if (src.data._last_sel === idx) {
+                src.selected.indices = [];
+                src.data._last_sel = null;
+            } else {
+                src.data._last_sel = idx;
+            }
+            src.change.emit();
+        }
+    """))
+
+    # 6h) Reload the page on the server's word (main.py: a data-file refresh
+    #     changed the feature columns that the selects, tables, histogram cube and
+    #     the callbacks above are all built from)
+    reload_div = Div(text="", visible=False)
+    reload_div.js_on_change('text', CustomJS(code="window.location.reload();"))
+
+    # 7) Assemble layout
+    layout = column(
+        row(toggle, plane_select, locate_input, filter_input, view_div, quality_div,
+            *cluster_buttons, reload_div,
+            sizing_mode="stretch_width"),
+        row(*train_controls.values(), sizing_mode="stretch_width"),
+        row(p_hex,    p_map,           sizing_mode="stretch_width"),
+        data_table,
+        selection_table,
+        row(hist_select, p_hist, sizing_mode="stretch_width"),
+        sizing_mode="stretch_width"
+    )
+
+    doc.add_root(layout)
+    doc.title = f"SOM Dashboard ({pipe['name']})"
+
+    models = dict(
+        toggle=toggle, plane_select=plane_select, locate_input=locate_input,
+        filter_input=filter_input,
+        view_div=view_div, quality_div=quality_div, hist_select=hist_select,
+        reload_div=reload_div, p_hex=p_hex, p_map=p_map, source_hex=source_hex, source_map=source_map,
+        source_table=source_table, source_stats=source_stats, source_hist=source_hist,
+        source_cube=source_cube, source_edges=source_edges,
+        map_summary=map_summary, hist_summary=hist_summary,
+        **{f"training_{k}": w for k, w in train_controls.items()}
+    )
+    for name, model in models.items():
+        model.name = name
+    return models, tile_features
+
+
+def _template(pipe: Dict[str, object]) -> Dict[str, object]:
+    # kept in the pipeline itself, so the pipeline cache accounts for it and drops
+    # it (with its buffers) when it evicts or replaces the pipeline
+    template = pipe.get('session_template')
+    if template is not None:
+        return template
+
+    doc = Document()
+    models, tile_features = build_dashboard(doc, pipe)
+    # keep the large buffers here and serialize the document without them
+    data = {name: dict(m.data) for name, m in models.items()
+            if isinstance(m, ColumnDataSource)}
+    for name, columns in data.items():
+        models[name].data = {c: [] for c in columns}
+    geojson = models['source_map'].geojson
+    models['source_map'].geojson = EMPTY_GEOJSON
+
+    nbytes = len(geojson) + sum(getattr(v, 'nbytes', 8 * len(v))
+                                for columns in data.values() for v in columns.values())
+    template = dict(json=doc.to_json(), names=list(models), data=data,
+                    geojson=geojson, tile_features=tile_features, nbytes=nbytes)
+    pipe['session_template'] = template
+    PIPELINES.update_estimate(pipe['name'], pipe)
+    return template
+
+
+def clone_dashboard(doc: Document, pipe: Dict[str, object]) -> Tuple[Dict[str, object], List[dict]]:
+    """
+    Fill a new session's document with a clone of the pipeline's template.
+
+    The clone's sources hold the template's column objects, so replace their
+    data (never patch or stream it in place) before changing it.
+
+    Returns:
+        Same as build_dashboard, for the clone's models.
+    """
+    template = _template(pipe)
+    doc.replace_with_json(template['json'])
+    models = {name: doc.select_one({'name': name}) for name in template['names']}
+    for name, data in template['data'].items():
+        models[name].data = data
+    models['source_map'].geojson = template['geojson']
+    return models, list(template['tile_features'])
@@ -1,30 +1,168 @@
 # data_loader.py
 
 """
-Load geographic data and scale numeric variables for the SOM dashboard.
+Load geographic data, scale numeric variables and spatially index regions for the
+SOM dashboard.
 """
 
+import argparse
+import json
+import os
+import re
+import numpy as np
 import geopandas as gpd
 import pandas as pd
+from scipy import sparse as sp
+from shapely.geometry import Point, box
 from sklearn.preprocessing import StandardScaler
-from typing import Tuple, List
+from typing import Dict, Tuple, List
 
-def load_data(path: str) -> gpd.GeoDataFrame:
+PARQUET_EXTENSIONS = ('.parquet', '.geoparquet')
+FEATHER_EXTENSIONS = ('.feather', '.arrow', '.ipc')
+
+
+def detect_format(path: str) -> str:
+    """
+    Guess the storage format of a data file: 'parquet', 'feather' or 'ogr'.
+
+    Columnar files are recognised by their magic bytes ('PAR1' / 'ARROW1'), so a
+    renamed file is still read by the fast path; otherwise the extension decides
+    and anything else is left to GDAL/OGR (GeoPackage, shapefile, GeoJSON, ...).
+    """
+    ext = os.path.splitext(path)[1].lower()
+    try:
+        with open(path, 'rb') as f:
+            magic = f.read(6)
+    except OSError:
+        magic = b''
+    if magic[:4] == b'PAR1' or ext in PARQUET_EXTENSIONS:
+        return 'parquet'
+    if magic == b'ARROW1' or ext in FEATHER_EXTENSIONS:
+        return 'feather'
+    return 'ogr'
+
+
+_FILTER_OPS = {
+    '=': np.equal, '==': np.equal, '!=': np.not_equal,
+    '<': np.less, '<=': np.less_equal, '>': np.greater, '>=': np.greater_equal,
+}
+
+
+# attribute queries (see query_attributes)
+_WORD = re.compile(r"\w+")
+_CONDITION = re.compile(r"([A-Za-z_][\w.]*)\s*(<=|>=|!=|==|=|<|>|~)\s*(.+)")
+
+
+def _filter_mask(df: pd.DataFrame, filters: list) -> np.ndarray:
+    """
+    Evaluate pyarrow-style filters (AND of tuples, or OR of such lists) in pandas.
+    """
+    groups = filters if isinstance(filters[0], list) else [filters]
+    mask = np.zeros(len(df), dtype=bool)
+    for group in groups:
+        part = np.ones(len(df), dtype=bool)
+        for col, op, val in group:
+            if op == 'in':
+                part &= df[col].isin(val).to_numpy()
+            elif op == 'not in':
+                part &= ~df[col].isin(val).to_numpy()
+            else:
+                part &= np.asarray(_FILTER_OPS[op](df[col].to_numpy(), val), dtype=bool)
+        mask |= part
+    return mask
+
+
+def geometry_column(path: str) -> str:
+    """
+    Name of the primary geometry column of a GeoParquet or Feather/Arrow file,
+    from its 'geo' schema metadata (GeoPandas writes 'geometry' by default, but
+    files from other tools often use e.g. 'geom').
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    if detect_format(path) == 'parquet':
+        metadata = pq.read_schema(path).metadata
+    else:
+        with pa.memory_map(path) as source:
+            metadata = pa.ipc.open_file(source).schema.metadata
+    geo = json.loads((metadata or {}).get(b'geo', b'{}'))
+    return geo.get('primary_column', 'geometry')
+
+
+def load_data(
+    path: str,
+    columns: List[str] = None,
+    filters: list = None
+) -> gpd.GeoDataFrame:
     """
-    Read a GeoPackage (or other file supported by GeoPandas) into a GeoDataFrame.
+    Read a GeoParquet, Feather/Arrow or GeoPackage (or other file supported by
+    GeoPandas) into a GeoDataFrame; the format is auto-detected.
 
     Parameters:
         path: filesystem path or URL to the geospatial data.
+        columns: only read these columns (the geometry column is always kept).
+            Columnar formats skip the other columns on disk entirely.
+        filters: pyarrow predicate(s), e.g. [('year', '>=', 2020)]; for GeoParquet
+            whole row groups are skipped using their min/max statistics, other
+            formats are filtered after reading.
+
+    Returns:
+        A GeoDataFrame containing the requested columns of the file.
+    """
+    fmt = detect_format(path)
+    if fmt == 'parquet':
+        cols = None if columns is None else list(columns) + [geometry_column(path)]
+        return gpd.read_parquet(path, columns=cols, filters=filters)
+    if fmt == 'feather':
+        cols = None if columns is None else list(columns) + [geometry_column(path)]
+        gdf = gpd.read_feather(path, columns=cols)
+    else:
+        gdf = gpd.read_file(path) if columns is None else gpd.read_file(path, columns=columns)
+    if filters:
+        gdf = gdf[_filter_mask(gdf, filters)].reset_index(drop=True)
+    return gdf
+
+
+def convert_to_geoparquet(
+    src: str,
+    dst: str = None,
+    layer: str = None,
+    row_group_size: int = 65536,
+    spatial_sort: bool = False
+) -> str:
+    """
+    One-time conversion of a GeoPackage (or any OGR source) to GeoParquet.
+
+    Parameters:
+        src: source file, e.g. data/mydata.gpkg.
+        dst: output path; defaults to src with a .parquet extension.
+        layer: source layer (defaults to the first layer).
+        row_group_size: rows per Parquet row group; smaller groups make filters
+            more selective at the cost of a little metadata.
+        spatial_sort: order rows along a Hilbert curve so each row group covers a
+            compact area and bbox filters can prune them. Changes row order.
 
     Returns:
-        A GeoDataFrame containing all layers/columns in the file.
+        The path written.
     """
-    return gpd.read_file(path)
+    dst = dst or os.path.splitext(src)[0] + '.parquet'
+    gdf = gpd.read_file(src, layer=layer)
+    if spatial_sort:
+        gdf = gdf.iloc[np.argsort(gdf.hilbert_distance().to_numpy(), kind='stable')]
+        gdf = gdf.reset_index(drop=True)
+    tmp = dst + '.tmp'
+    gdf.to_parquet(tmp, index=False, row_group_size=row_group_size)
+    os.replace(tmp, dst)
+    return dst
 
 
 def scale_data(
     gdf: gpd.GeoDataFrame,
-    exclude_cols: List[str] = None
+    exclude_cols: List[str] = None,
+    scaler: StandardScaler = None,
+    columns: List[str] = None,
+    sparse=False
 ) -> Tuple[pd.DataFrame, gpd.GeoDataFrame]:
     """
     Standardize all numeric columns (except any in exclude_cols) and return a DataFrame
@@ -32,25 +170,341 @@ def scale_data(
 
     Parameters:
         gdf: input GeoDataFrame with numeric and geometry columns.
-        exclude_cols: list of column names to skip during scaling (e.g. identifiers).
+        exclude_cols: list of column names to skip during scaling (e.g. identifiers);
+                      hex_x/hex_y are always skipped.
+        scaler: StandardScaler to use. An unfitted one is fitted here, so the caller
+                keeps the parameters (e.g. to save with the model); a fitted one is
+                applied as-is (e.g. when scoring new data against a saved model).
+        columns: explicit feature columns, in order (e.g. a saved model's features);
+                 defaults to all numeric columns minus exclude_cols.
+        sparse: True for a sparse path for wide, mostly-zero features (e.g. many
+                indicator columns): features are divided by their standard
+                deviation but not centered, which would make every zero non-zero,
+                and scaled_df gets sparse columns (see som_model for training and
+                BMU search on them). Euclidean SOM training and BMU search do not
+                depend on a constant shift, so skipping the centering loses nothing.
+                "auto" takes this path when there are at least 100 features and
+                under 10% of their values are non-zero.
 
     Returns:
-        scaled_df: pandas DataFrame of standardized numeric features, plus any spatial keys.
+        scaled_df: pandas DataFrame of the standardized numeric features only (grid
+                   coordinates stay in geo_df).
         geo_df: the original GeoDataFrame (unchanged).
     """
-    exclude_cols = exclude_cols or []
+    # grid coordinates are never features, so the scaler always matches the
+    # feature columns (and a saved model's feature_names) and scaled_df is the
+    # feature matrix as is
+    exclude_cols = list(exclude_cols or []) + ["hex_x", "hex_y"]
 
-    # select numeric columns, minus any excludes
-    numeric = gdf.select_dtypes(include=["number"]).copy()
-    numeric.drop(columns=[c for c in exclude_cols if c in numeric.columns], inplace=True, errors='ignore')
+    if columns is None:
+        # numeric columns, minus any excludes (read from the dtypes: select_dtypes
+        # would copy every numeric column first)
+        columns = [
+            c for c, t in gdf.dtypes.items()
+            if pd.api.types.is_numeric_dtype(t) and not pd.api.types.is_bool_dtype(t)
+            and c not in exclude_cols
+        ]
+    columns = list(columns)
 
-    scaler = StandardScaler()
-    scaled_arr = scaler.fit_transform(numeric.values)
-    scaled_df = pd.DataFrame(scaled_arr, columns=numeric.columns, index=gdf.index)
-
-    # carry through any grid coordinates
-    for coord in ("hex_x", "hex_y"):
-        if coord in gdf.columns:
-            scaled_df[coord] = gdf[coord].values
+    if sparse:
+        csr = _sparse_features(gdf, columns)
+        if sparse != "auto" or (csr.shape[1] >= 100 and csr.nnz < 0.1 * np.prod(csr.shape)):
+            return _scale_sparse(gdf, columns, csr, scaler), gdf
 
+    # the one copy of the features: a float array filled column by column, then
+    # standardized in place and wrapped (not copied) as scaled_df's single block
+    values = np.empty((len(gdf), len(columns)))
+    for j, c in enumerate(columns):
+        values[:, j] = gdf[c].to_numpy(dtype=float)
+    if scaler is None:
+        scaler = StandardScaler()
+    if not hasattr(scaler, "mean_"):
+        scaler.fit(values)
+    values = scaler.transform(values, copy=False)
+    scaled_df = pd.DataFrame(values, columns=columns, index=gdf.index, copy=False)
     return scaled_df, gdf
+
+
+def is_sparse_frame(df: pd.DataFrame) -> bool:
+    """
+    Whether df's features come from scale_data's sparse path (hex_x/hex_y aside).
+    """
+    dtypes = [t for c, t in df.dtypes.items() if c not in ("hex_x", "hex_y")]
+    return len(dtypes) > 0 and all(isinstance(t, pd.SparseDtype) for t in dtypes)
+
+
+def _sparse_features(gdf: gpd.GeoDataFrame, columns: List[str]) -> sp.csr_matrix:
+    # built column by column, so the dense feature matrix is never materialized
+    rows, cols, vals = [], [], []
+    for j, c in enumerate(columns):
+        v = np.asarray(gdf[c], dtype=float)
+        nz = np.flatnonzero(v)
+        rows.append(nz)
+        cols.append(np.full(len(nz), j))
+        vals.append(v[nz])
+    return sp.csr_matrix(
+        (np.concatenate(vals), (np.concatenate(rows), np.concatenate(cols))),
+        shape=(len(gdf), len(columns))
+    )
+
+
+def _scale_sparse(
+    gdf: gpd.GeoDataFrame,
+    columns: List[str],
+    csr: sp.csr_matrix,
+    scaler: StandardScaler
+) -> pd.DataFrame:
+    if scaler is None:
+        scaler = StandardScaler(with_mean=False)
+    if not hasattr(scaler, "mean_"):
+        scaler.set_params(with_mean=False).fit(csr)
+        # saved with a zero mean, so dense callers (scoring) apply the same transform
+        scaler.mean_ = np.zeros_like(scaler.scale_)
+    elif np.any(scaler.mean_):
+        raise ValueError("A centering scaler cannot be applied to sparse features")
+    scaled = (csr @ sp.diags(1 / scaler.scale_)).tocsr()
+    return pd.DataFrame.sparse.from_spmatrix(scaled, index=gdf.index, columns=columns)
+
+
+def build_spatial_index(gdf: gpd.GeoDataFrame):
+    """
+    Build the STRtree spatial index of the regions once.
+
+    GeoPandas caches the index on the GeoDataFrame itself, so every query below
+    reuses it as long as the same frame is passed (copies start without one).
+
+    Parameters:
+        gdf: GeoDataFrame of regions.
+
+    Returns:
+        The GeoDataFrame's STRtree-backed spatial index.
+    """
+    return gdf.sindex
+
+
+def locate_point(gdf: gpd.GeoDataFrame, x: float, y: float) -> np.ndarray:
+    """
+    Find the region(s) containing a point.
+
+    Parameters:
+        gdf: GeoDataFrame of regions.
+        x, y: point coordinates, in the GeoDataFrame's CRS.
+
+    Returns:
+        Positional indices of the matching regions (empty if the point is outside all).
+    """
+    return gdf.sindex.query(Point(x, y), predicate="intersects")
+
+
+def regions_in_bbox(
+    gdf: gpd.GeoDataFrame,
+    bbox: Tuple[float, float, float, float]
+) -> np.ndarray:
+    """
+    Find the regions intersecting a bounding box (e.g. the current map viewport).
+
+    Parameters:
+        gdf: GeoDataFrame of regions.
+        bbox: (minx, miny, maxx, maxy) in the GeoDataFrame's CRS.
+
+    Returns:
+        Sorted positional indices of the intersecting regions.
+    """
+    return np.sort(gdf.sindex.query(box(*bbox), predicate="intersects"))
+
+
+def join_points_to_regions(
+    gdf: gpd.GeoDataFrame,
+    points: gpd.GeoSeries
+) -> np.ndarray:
+    """
+    Batch point-in-polygon join of external point data onto the regions.
+
+    Parameters:
+        gdf: GeoDataFrame of regions.
+        points: GeoSeries of points, in the GeoDataFrame's CRS.
+
+    Returns:
+        For each point, the positional index of the region containing it, or -1.
+        Points on a shared border are attached to the first matching region.
+    """
+    pt_idx, region_idx = gdf.sindex.query(points.values, predicate="intersects")
+    out = np.full(len(points), -1, dtype=int)
+    # reversed assignment so the first match per point wins
+    out[pt_idx[::-1]] = region_idx[::-1]
+    return out
+
+
+def build_attribute_index(df: pd.DataFrame, columns: List[str] = None) -> Dict[str, dict]:
+    """
+    Index attribute columns once, so query_attributes never scans the frame:
+    numeric columns get a sorted index, text columns an inverted index of their
+    (lower-cased) words.
+
+    Parameters:
+        df: regions, or any row-aligned frame (e.g. cluster assignments).
+        columns: columns to index (default: all but the geometry).
+
+    Returns:
+        {column: entry}, where entry is
+            {'kind': 'sorted', 'order': row positions sorted by value (NaNs last),
+             'values': the sorted values, 'n': number of non-NaN values}
+        or
+            {'kind': 'text', 'values': the lower-cased strings by row,
+             'tokens': sorted vocabulary, 'postings': sorted rows per token}.
+    """
+    if columns is None:
+        geom = df.geometry.name if isinstance(df, gpd.GeoDataFrame) else None
+        columns = [c for c in df.columns if c != geom]
+
+    index = {}
+    for c in columns:
+        t = df[c].dtype
+        if pd.api.types.is_numeric_dtype(t):
+            v = np.asarray(df[c], dtype=float)
+            order = np.argsort(v, kind="stable")
+            index[c] = {'kind': 'sorted', 'order': order, 'values': v[order],
+                        'n': int(np.count_nonzero(~np.isnan(v)))}
+        elif (pd.api.types.is_object_dtype(t) or pd.api.types.is_string_dtype(t)
+              or isinstance(t, pd.CategoricalDtype)):
+            # to strings before filling: "" is not a category of a Categorical
+            text = df[c].astype("string").fillna("").str.lower().reset_index(drop=True)
+            words = text.str.findall(_WORD.pattern).explode().dropna()
+            pairs = (pd.DataFrame({'token': words.values, 'row': words.index.values})
+                     .drop_duplicates().sort_values(['token', 'row']))
+            tokens, starts = np.unique(pairs['token'].to_numpy(dtype=str), return_index=True)
+            rows = pairs['row'].to_numpy(dtype=np.int64)
+            index[c] = {'kind': 'text', 'values': text.to_numpy(dtype=object), 'tokens': tokens,
+                        'postings': np.split(rows, starts[1:]) if len(tokens) else []}
+    return index
+
+
+def _text_rows(entry: dict, word: str) -> np.ndarray:
+    # rows holding a word starting with `word`: a range of the sorted vocabulary
+    tokens = entry['tokens']
+    lo = np.searchsorted(tokens, word, side="left")
+    hi = np.searchsorted(tokens, word + "\U0010ffff", side="left")
+    if lo == hi:
+        return np.empty(0, dtype=np.int64)
+    return np.unique(np.concatenate(entry['postings'][lo:hi]))
+
+
+def _condition_rows(entry: dict, op: str, value) -> np.ndarray:
+    if entry['kind'] == 'sorted':
+        if isinstance(value, str):
+            raise ValueError(f"Numeric column compared with text {value!r}")
+        order, values = entry['order'], entry['values'][:entry['n']]
+        lo = np.searchsorted(values, value, side="left")
+        hi = np.searchsorted(values, value, side="right")
+        n = entry['n']
+        rows = {'<': order[:lo], '<=': order[:hi], '>': order[hi:n], '>=': order[lo:n],
+                '=': order[lo:hi], '==': order[lo:hi],
+                '!=': np.concatenate([order[:lo], order[hi:n]])}.get(op)
+        if rows is None:
+            raise ValueError(f"Operator {op!r} does not apply to a numeric column")
+        return np.sort(rows)
+
+    words = _WORD.findall(str(value).lower())
+    if op == '~':
+        rows = None
+        for w in words:
+            found = _text_rows(entry, w)
+            rows = found if rows is None else np.intersect1d(rows, found, assume_unique=True)
+        return rows if rows is not None else np.arange(len(entry['values']))
+    if op in ('=', '==', '!='):
+        target = str(value).lower()
+        candidates = np.arange(len(entry['values']))
+        for w in words:
+            postings = entry['postings']
+            k = np.searchsorted(entry['tokens'], w)
+            found = (postings[k] if k < len(postings) and entry['tokens'][k] == w
+                     else np.empty(0, dtype=np.int64))
+            candidates = np.intersect1d(candidates, found, assume_unique=True)
+        equal = candidates[entry['values'][candidates] == target]
+        if op == '!=':
+            return np.setdiff1d(np.arange(len(entry['values'])), equal, assume_unique=True)
+        return equal
+    raise ValueError(f"Operator {op!r} does not apply to a text column")
+
+
+def _split_connective(text: str, word: str) -> List[str]:
+    # split on a connective ('and' / 'or'), except inside quoted values
+    parts, start = [], 0
+    for m in re.finditer(rf"""'[^']*'|"[^"]*"|\s+{word}\s+""", text, flags=re.IGNORECASE):
+        if m.group(0)[0] not in "'\"":
+            parts.append(text[start:m.start()])
+            start = m.end()
+    parts.append(text[start:])
+    return parts
+
+
+def query_attributes(index: Dict[str, dict], query: str) -> np.ndarray:
+    """
+    Evaluate an attribute query against indexes from build_attribute_index.
+
+    A query is conditions joined by 'and' / 'or' ('and' binds tighter), e.g.
+    "income > 30000 and cluster = 2" or "name = Springfield or name ~ spring";
+    quote values that contain a connective ("name = 'Trinidad and Tobago'"):
+
+    - numeric columns: =, ==, !=, <, <=, >, >= a number (NaNs never match);
+    - text columns: = / != a whole value (case-insensitive), ~ words that start
+      the value's words (all must match);
+    - a condition without an operator searches every text column like ~.
+
+    Parameters:
+        index: {column: entry}; merge several (e.g. region attributes and cluster
+            assignments) with {**a, **b} when their rows are aligned.
+        query: the query text.
+
+    Returns:
+        Sorted positional indices of the matching rows.
+
+    Raises:
+        ValueError: for an unknown column or operator, or malformed query.
+    """
+    text_columns = [c for c, e in index.items() if e['kind'] == 'text']
+    result = None
+    for group in _split_connective(query.strip(), "or"):
+        rows = None
+        for cond in _split_connective(group.strip(), "and"):
+            m = _CONDITION.fullmatch(cond.strip())
+            if m is not None:
+                col, op, raw = m.groups()
+                if col not in index:
+                    raise ValueError(f"Unknown column {col!r}")
+                raw = raw.strip().strip("'\"")
+                try:
+                    value = float(raw)
+                except ValueError:
+                    value = raw
+                if index[col]['kind'] == 'text':
+                    value = raw
+                found = _condition_rows(index[col], op, value)
+            elif cond.strip() and not re.search(r"[<>=!~]", cond):
+                if not text_columns:
+                    raise ValueError("No text columns to search")
+                found = np.unique(np.concatenate(
+                    [_condition_rows(index[c], '~', cond) for c in text_columns]))
+            else:
+                raise ValueError(f"Cannot parse condition {cond!r}")
+            rows = found if rows is None else np.intersect1d(rows, found, assume_unique=True)
+        result = rows if result is None else np.union1d(result, rows)
+    return result.astype(np.int64)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Convert a GeoPackage to GeoParquet.")
+    parser.add_argument("src", help="source file, e.g. data/mydata.gpkg")
+    parser.add_argument("dst", nargs="?", help="output file (default: <src>.parquet)")
+    parser.add_argument("--layer")
+    parser.add_argument("--row-group-size", type=int, default=65536)
+    parser.add_argument("--spatial-sort", action="store_true",
+                        help="Hilbert-order rows so bbox filters prune row groups")
+    args = parser.parse_args()
+    print(convert_to_geoparquet(args.src, args.dst, layer=args.layer,
+                                row_group_size=args.row_group_size,
+                                spatial_sort=args.spatial_sort))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,86 @@
+# file_watcher.py
+
+"""
+Watch the data files of cached pipelines and, when one changes, recompute only its
+dirty stages off the IOLoop thread, then update every connected session in place.
+"""
+
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from typing import Callable, Dict, List
+
+from bokeh.document import Document
+from tornado.ioloop import IOLoop, PeriodicCallback
+
+from pipeline import PIPELINES, refresh_pipeline, data_file_fingerprint
+
+
+log = logging.getLogger(__name__)
+
+# dataset name -> {session document: update callback(pipeline, dirty_stages)}
+_SESSIONS: Dict[str, Dict[Document, Callable[[Dict[str, object], List[str]], None]]] = {}
+_EXECUTOR = ThreadPoolExecutor(max_workers=1, thread_name_prefix="pipeline-refresh")
+_REFRESHING = set()
+_FAILED = {}
+_WATCHER = None
+
+
+def register_session(
+    name: str,
+    doc: Document,
+    update: Callable[[Dict[str, object], List[str]], None]
+) -> None:
+    """
+    Have a session's plot sources updated whenever its dataset is recomputed.
+
+    Parameters:
+        name: dataset the session shows.
+        doc: the session's Document.
+        update: called on the session's next tick with (pipeline, dirty_stages).
+    """
+    _SESSIONS.setdefault(name, {})[doc] = update
+    doc.on_session_destroyed(lambda ctx: _SESSIONS.get(name, {}).pop(doc, None))
+
+
+def start_watcher(interval_ms: int = 2000) -> None:
+    """
+    Start polling the data files of cached pipelines (once per server process).
+    """
+    global _WATCHER
+    if _WATCHER is None:
+        _WATCHER = PeriodicCallback(_check_files, interval_ms)
+        _WATCHER.start()
+
+
+def _check_files() -> None:
+    for name, pipe in PIPELINES.snapshot():
+        if name in _REFRESHING:
+            continue
+        try:
+            key = data_file_fingerprint(pipe['data_path'])
+        except OSError:
+            continue  # file is being replaced; try again next tick
+        if key == pipe['fingerprints']['load'] or _FAILED.get(name) == key:
+            continue
+        _REFRESHING.add(name)
+        future = _EXECUTOR.submit(refresh_pipeline, pipe)
+        IOLoop.current().add_future(future, partial(_on_refreshed, name, key))
+
+
+def _on_refreshed(name: str, key: str, future) -> None:
+    _REFRESHING.discard(name)
+    try:
+        pipe, dirty = future.result()
+    except Exception:
+        # e.g. a half-written file: skip this version until the file changes again
+        log.exception("Refreshing dataset %r failed", name)
+        _FAILED[name] = key
+        return
+    _FAILED.pop(name, None)
+    if not dirty:
+        return
+    log.info("Dataset %r refreshed; recomputed stages: %s", name, ", ".join(dirty))
+    PIPELINES.replace(name, pipe)
+    for doc, update in list(_SESSIONS.get(name, {}).items()):
+        doc.add_next_tick_callback(partial(update, pipe, dirty))
@@ -0,0 +1,234 @@
+# loadtest.py
+
+"""
+Load-test the dashboard: start it with `bokeh serve`, open N concurrent sessions
+through the Bokeh client API and report how session creation latency, document
+size, server RSS per session and callback round-trip time scale with the number
+of sessions and --num-procs.
+
+Usage:
+    python loadtest.py --sessions 1,5,10,25 --num-procs 1,2 --json results.json
+"""
+
+import argparse
+import http.client
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Tuple
+
+import psutil
+from bokeh.client import pull_session
+from bokeh.core.json_encoder import serialize_json
+
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def start_server(port: int, num_procs: int, timeout: float = 600.0) -> subprocess.Popen:
+    """
+    Start `bokeh serve` on this app directory and wait until it answers HTTP.
+
+    The first session of each process prepares the pipeline, so the wait also
+    loads sessions until every worker process has served one (see warm_workers),
+    to take that cost out of the measurements.
+    """
+    proc = subprocess.Popen([
+        sys.executable, "-m", "bokeh", "serve", HERE,
+        "--port", str(port), "--num-procs", str(num_procs),
+        "--allow-websocket-origin", f"localhost:{port}",
+    ], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            urllib.request.urlopen(app_url(port), timeout=timeout).read()
+            break
+        except OSError:
+            if proc.poll() is not None:
+                raise RuntimeError("bokeh serve exited during startup")
+            time.sleep(0.5)
+    else:
+        stop_server(proc)
+        raise TimeoutError("bokeh serve did not come up")
+    try:
+        warm_workers(proc, port, deadline - time.time())
+    except Exception:
+        stop_server(proc)
+        raise
+    return proc
+
+
+def stop_server(proc: subprocess.Popen) -> None:
+    """
+    Terminate `bokeh serve` and its worker processes, which would otherwise
+    outlive it (and keep the port) when it was started with --num-procs > 1.
+    """
+    procs = [psutil.Process(proc.pid)]
+    procs += procs[0].children(recursive=True)
+    for p in procs:
+        try:
+            p.terminate()
+        except psutil.NoSuchProcess:
+            pass
+    psutil.wait_procs(procs, timeout=30)
+    proc.wait()
+
+
+def serving_pid(pids: List[int], port: int, timeout: float) -> int:
+    """
+    Load the app page once; returns which of the processes pids served it, found
+    by the server side of the (kept-alive) connection, or None.
+    """
+    conn = http.client.HTTPConnection("localhost", port, timeout=timeout)
+    try:
+        conn.request("GET", "/" + os.path.basename(HERE))
+        conn.getresponse().read()
+        local = conn.sock.getsockname()[:2]
+        for pid in pids:
+            if any(c.raddr and tuple(c.raddr)[:2] == local
+                   for c in psutil.Process(pid).net_connections(kind="tcp")):
+                return pid
+        return None
+    finally:
+        conn.close()
+
+
+def warm_workers(proc: subprocess.Popen, port: int, timeout: float) -> None:
+    """
+    Load the app until each server process has served a session (with
+    --num-procs > 1, the forked workers; the kernel hands each connection to
+    whichever accepts first). Pages are requested as many at a time as there
+    are workers, so a worker busy preparing its pipeline leaves the other
+    requests to the rest.
+    """
+    workers = [p.pid for p in psutil.Process(proc.pid).children()] or [proc.pid]
+    warmed, deadline = set(), time.time() + timeout
+    while not warmed.issuperset(workers):
+        if time.time() > deadline:
+            raise TimeoutError(f"only {len(warmed)} of {len(workers)} bokeh workers warmed up")
+        with ThreadPoolExecutor(len(workers)) as pool:
+            warmed.update(pool.map(lambda _: serving_pid(workers, port, timeout), workers))
+
+
+def app_url(port: int) -> str:
+    return f"http://localhost:{port}/{os.path.basename(HERE)}"
+
+
+def server_rss(proc: subprocess.Popen) -> int:
+    """
+    Resident memory of the server and all its worker processes, in bytes.
+    """
+    root = psutil.Process(proc.pid)
+    return sum(p.memory_info().rss for p in [root] + root.children(recursive=True))
+
+
+def open_session(url: str):
+    """
+    Open one session; returns (session, creation latency in seconds, document bytes).
+    """
+    t0 = time.perf_counter()
+    session = pull_session(url=url)
+    latency = time.perf_counter() - t0
+    size = len(serialize_json(session.document.to_json()))
+    return session, latency, size
+
+
+def callback_roundtrip(session, i: int, timeout: float = 30.0) -> float:
+    """
+    Time from a widget change on the client to the server callback's reply.
+
+    Sets the point-locator text (a Python callback that writes back a status
+    line) and runs the client loop until the status reflects the new point.
+    """
+    doc = session.document
+    locate = doc.get_model_by_name("locate_input")
+    status = doc.get_model_by_name("view_div")
+    x = 1e-9 * (i + 1)
+    expected = f"({x:g}, 0)"
+
+    # the client applies the server's patches only while idle (a request such
+    # as request_server_info drops them while it waits for its reply), and has
+    # no public call to run its loop until a condition holds
+    connection = session._connection
+    stop = connection._loop.call_later(timeout, connection._loop.stop)
+    t0 = time.perf_counter()
+    try:
+        locate.value = f"{x}, 0"
+        connection._loop_until(lambda: expected in status.text)
+    finally:
+        connection._loop.remove_timeout(stop)
+    if expected not in status.text:
+        raise TimeoutError("no callback reply from server")
+    return time.perf_counter() - t0
+
+
+def _session_worker(url: str, i: int) -> Tuple[object, float, int, float]:
+    session, latency, size = open_session(url)
+    return session, latency, size, callback_roundtrip(session, i)
+
+
+def _percentile(values: List[float], q: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(q * (len(values) - 1))))]
+
+
+def run_level(proc: subprocess.Popen, url: str, n_sessions: int) -> Dict[str, float]:
+    """
+    Open n_sessions concurrently, measure, then close them all.
+    """
+    rss_before = server_rss(proc)
+    with ThreadPoolExecutor(n_sessions) as pool:
+        results = list(pool.map(lambda i: _session_worker(url, i), range(n_sessions)))
+    rss_after = server_rss(proc)
+
+    latencies = [r[1] for r in results]
+    roundtrips = [r[3] for r in results]
+    for session, *_ in results:
+        session.close()
+    return {
+        'sessions': n_sessions,
+        'create_p50_s': statistics.median(latencies),
+        'create_p95_s': _percentile(latencies, 0.95),
+        'doc_bytes': statistics.mean(r[2] for r in results),
+        'rss_total_mb': rss_after / 2**20,
+        'rss_per_session_mb': (rss_after - rss_before) / 2**20 / n_sessions,
+        'callback_p50_s': statistics.median(roundtrips),
+        'callback_p95_s': _percentile(roundtrips, 0.95),
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Concurrent-session load test.")
+    parser.add_argument("--sessions", default="1,5,10,25",
+                        help="comma-separated concurrent session counts")
+    parser.add_argument("--num-procs", default="1",
+                        help="comma-separated bokeh serve --num-procs values")
+    parser.add_argument("--port", type=int, default=5099)
+    parser.add_argument("--json", default=None, help="also write results to this file")
+    args = parser.parse_args()
+
+    rows = []
+    for num_procs in (int(v) for v in args.num_procs.split(",")):
+        proc = start_server(args.port, num_procs)
+        try:
+            for n in (int(v) for v in args.sessions.split(",")):
+                row = dict(num_procs=num_procs, **run_level(proc, app_url(args.port), n))
+                rows.append(row)
+                print(" ".join(f"{k}={v:.4g}" if isinstance(v, float) else f"{k}={v}"
+                               for k, v in row.items()), flush=True)
+        finally:
+            stop_server(proc)
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(rows, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,250 +1,286 @@
 # main.py
 
 """
-Entry point for Bokeh Server: assembles data, models, plots, and widgets.
+Entry point for Bokeh Server: clones the dataset's dashboard document (see
+dashboard.py) and wires up this session's Python callbacks.
 """
 
-import os
+import numpy as np
 from bokeh.io import curdoc
-from bokeh.layouts import column, row
-from bokeh.models import CustomJS
-from bokeh.events import ButtonClick, Tap
-
-from data_loader import load_data, scale_data
-from som_model import train_som, compute_umatrix
-from cluster_analysis import assign_clusters, compute_cluster_means
-from widgets import create_um_toggle, create_cluster_buttons
-from plots import build_hex_plot, build_map_plot, build_data_table
-
-
-# 1) Load & preprocess
-HERE = os.path.dirname(__file__)
-gpkg_path = os.path.join(HERE, 'data', 'mydata.gpkg')
-gdf = load_data(gpkg_path)
-scaled_df, geo_df = scale_data(gdf)
-
-# 2) Train SOM & compute U-Matrix
-som     = train_som(scaled_df)
-um_flat = compute_umatrix(som)
-
-# 3) Assign clusters & compute summary
-hex_df           = assign_clusters(som, scaled_df)
-cluster_means_df = compute_cluster_means(hex_df)
-
-# 4) Create widgets
-toggle          = create_um_toggle()
-cluster_buttons = create_cluster_buttons(n_clusters=cluster_means_df.shape[0])
-
-# 5) Build plots & table
-# build_hex_plot now returns a ColumnDataSource of one row per SOM unit
-p_hex, source_hex = build_hex_plot(hex_df, som, um_flat, toggle)
-
-# pass BMU coords into geo_df so map_source has them for region selection
-geo_with_bmu = geo_df.assign(bmu_x=hex_df['bmu_x'], bmu_y=hex_df['bmu_y'])
-p_map, source_map = build_map_plot(geo_with_bmu, hex_df, cluster_buttons)
-
-data_table   = build_data_table(cluster_means_df)
-source_table = data_table.source
-
-# 6a) Cluster‐button callbacks: select/deselect all units & regions in the cluster
-for i, btn in enumerate(cluster_buttons):
-    btn.js_on_event(ButtonClick, CustomJS(args=dict(
-        hex_src=source_hex,
-        map_src=source_map,
-        table_src=source_table,
-        cl=i
-    ), code="""
-        // gather unit indices for cluster cl
-        const hex_inds = [];
-        const hx = hex_src.data['hc_cluster'];
-        for (let j = 0; j < hx.length; j++) {
-            if (hx[j] === cl) hex_inds.push(j);
-        }
-        // gather region indices for cluster cl
-        const map_inds = [];
-        const mx = map_src.data['hc_cluster'];
-        for (let j = 0; j < mx.length; j++) {
-            if (mx[j] === cl) map_inds.push(j);
-        }
-        // toggle-off if already selected
-        const already = table_src.selected.indices.length===1
-                       && table_src.selected.indices[0]===cl;
-        if (already) {
-            hex_src.selected.indices   = [];
-            map_src.selected.indices   = [];
-            table_src.selected.indices = [];
-        } else {
-            hex_src.selected.indices   = hex_inds;
-            map_src.selected.indices   = map_inds;
-            table_src.selected.indices = [cl];
-        }
-        hex_src.change.emit();
-        map_src.change.emit();
-        table_src.change.emit();
-    """))
-
-# 6b) Hex‐plot → Map & Table connectivity: single‐unit selection
-source_hex.selected.js_on_change('indices', CustomJS(args=dict(
-    hex_src=source_hex,
-    map_src=source_map,
-    table_src=source_table
-), code="""
-    const inds = hex_src.selected.indices;
-    if (hex_src.data._skip){
-        hex_src.data._skip = false;
-        return;
-    }
-    if (inds.length === 1 && hex_src.data._last_sel === inds[0]) {
-        hex_src.data._skip = true;
-        hex_src.selected.indices   = [];
-        map_src.selected.indices   = [];
-        table_src.selected.indices = [];
-        hex_src.data._last_sel = null;
-        hex_src.change.emit();
-        map_src.change.emit();
-        table_src.change.emit();
-        return;
-    }
-    hex_src.data._last_sel = inds.length === 1 ? inds[0] : null;
-    if (inds.length === 0) {
-        map_src.selected.indices   = [];
-        table_src.selected.indices = [];
-    } else if (inds.length === 1) {
-        const idx = inds[0];
-        // find all regions with matching BMU coords
-        const bx = hex_src.data['bmu_x'][idx];
-        const by = hex_src.data['bmu_y'][idx];
-        const xs = map_src.data['bmu_x'];
-        const ys = map_src.data['bmu_y'];
-        const region_inds = [];
-        for (let i = 0; i < xs.length; i++) {
-            if (xs[i] === bx && ys[i] === by) {
-                region_inds.push(i);
-            }
-        }
-        map_src.selected.indices   = region_inds;
-        const cl = hex_src.data['hc_cluster'][idx];
-        table_src.selected.indices = [cl];
-    } else {
-        return;
-    }
-    map_src.change.emit();
-    table_src.change.emit();
-"""))
-
-# 6c) Map‐plot → Hex & Table connectivity: single‐unit selection
-source_map.selected.js_on_change('indices', CustomJS(args=dict(
-    hex_src=source_hex,
-    map_src=source_map,
-    table_src=source_table
-), code="""
-    const inds = map_src.selected.indices;
-    if (map_src.data._skip){
-        map_src.data._skip = false;
-        return;
-    }
-    if (inds.length === 1 && map_src.data._last_sel === inds[0]) {
-        map_src.data._skip = true;
-        map_src.selected.indices   = [];
-        hex_src.selected.indices   = [];
-        table_src.selected.indices = [];
-        map_src.data._last_sel = null;
-        map_src.change.emit();
-        hex_src.change.emit();
-        table_src.change.emit();
-        return;
-    }
-    map_src.data._last_sel = inds.length === 1 ? inds[0] : null;
-    if (inds.length === 0) {
-        hex_src.selected.indices   = [];
-        table_src.selected.indices = [];
-    } else if (inds.length === 1) {
-        const idx = inds[0];
-        const bx  = map_src.data['bmu_x'][idx];
-        const by  = map_src.data['bmu_y'][idx];
-        const xs  = hex_src.data['bmu_x'];
-        const ys  = hex_src.data['bmu_y'];
-        let hex_i = null;
-        for (let i = 0; i < xs.length; i++) {
-            if (xs[i] === bx && ys[i] === by) { hex_i = i; break; }
-        }
-        hex_src.selected.indices   = hex_i !== null ? [hex_i] : [];
-        const cl = map_src.data['hc_cluster'][idx];
-        table_src.selected.indices = [cl];
-    } else {
-        return;
-    }
-    hex_src.change.emit();
-    table_src.change.emit();
-"""))
-
-
-
-# 6d) Toggle selection on repeated taps
-p_hex.js_on_event(Tap, CustomJS(args=dict(src=source_hex), code="""
-    const inds = src.selected.indices;
-    if (inds.length === 1) {
-        const idx = inds[0];
-        if (src.data._last_sel === idx) {
-            src.selected.indices = [];
-            src.data._last_sel = null;
-        } else {
-            src.data._last_sel = idx;
-        }
-        src.change.emit();
-    }
-"""))
-
-p_map.js_on_event(Tap, CustomJS(args=dict(src=source_map), code="""
-    const inds = src.selected.indices;
-    if (inds.length === 1) {
-        const idx = inds[0];
-        if (src.data._last_sel === idx) {
-            src.selected.indices = [];
-            src.data._last_sel = null;
-        } else {
-            src.data._last_sel = idx;
-        }
-        src.change.emit();
-    }
-"""))
-
-# 6d) Toggle selection on repeated taps
-p_hex.js_on_event(Tap, CustomJS(args=dict(src=source_hex), code="""
-    const inds = src.selected.indices;
-    if (inds.length === 1) {
-        const idx = inds[0];
-        if (src.data._last_sel === idx) {
-            src.selected.indices = [];
-            src.data._last_sel = null;
-        } else {
-            src.data._last_sel = idx;
-        }
-        src.change.emit();
-    }
-"""))
-
-p_map.js_on_event(Tap, CustomJS(args=dict(src=source_map), code="""
-    const inds = src.selected.indices;
-    if (inds.length === 1) {
-        const idx = inds[0];
-        if (src.data._last_sel === idx) {
-            src.selected.indices = [];
-            src.data._last_sel = null;
-        } else {
-            src.data._last_sel = idx;
-        }
-        src.change.emit();
-    }
-"""))
-
-# 7) Assemble layout
-layout = column(
-    row(toggle, *cluster_buttons, sizing_mode="stretch_width"),
-    row(p_hex,    p_map,           sizing_mode="stretch_width"),
-    data_table,
-    sizing_mode="stretch_width"
-)
-
-curdoc().add_root(layout)
-curdoc().title = "SOM Dashboard"
+from bokeh.models import ColumnDataSource
+from bokeh.events import RangesUpdate
+
+from data_loader import locate_point, regions_in_bbox, query_attributes
+from pipeline import PIPELINES, DEFAULT_DATASET
+from file_watcher import register_session, start_watcher
+from scoring_api import publish_model
+from retrain import RetrainJob
+from dashboard import clone_dashboard, quality_text, map_columns, tile_loader_for, tile_geojson
+from plots import build_node_frame, build_map_geojson, node_patches, histogram_data, cube_data
+
+
+# 1-3) Load, train & cluster the dataset named by ?dataset=... (prepared once per
+#      process and shared through the memory-budgeted pipeline cache)
+doc = curdoc()
+args = doc.session_context.request.arguments if doc.session_context else {}
+dataset = args.get('dataset', [DEFAULT_DATASET.encode()])[0].decode()
+pipe = PIPELINES.get(dataset)
+current = {'pipe': pipe}  # swapped in place when the data file changes (see 8)
+
+
+def publish(pipe):
+    # share the in-memory codebook and scaler with the /score endpoint (see serve.py)
+    # (the session's index is over reduced coordinates when the SOM was trained on
+    # a PCA projection; the endpoint then builds its own over the full codebook)
+    index = pipe['bmu_index'] if pipe['projection'] is None else None
+    publish_model(dict(
+        weights=pipe['som'].get_weights(), scaler=pipe['scaler'],
+        feature_names=pipe['feature_names'], node_labels=pipe['node_labels']
+    ), index, name=pipe['name'])
+
+
+publish(pipe)
+
+# 4-7) Widgets, plots, tables, their browser-side links and the layout: a clone
+#      of the template built once per process, sharing its large buffers
+models, tile_features = clone_dashboard(doc, pipe)
+toggle          = models['toggle']
+plane_select    = models['plane_select']
+locate_input    = models['locate_input']
+filter_input    = models['filter_input']
+view_div        = models['view_div']
+quality_div     = models['quality_div']
+hist_select     = models['hist_select']
+reload_div      = models['reload_div']
+p_map           = models['p_map']
+source_hex      = models['source_hex']
+source_map      = models['source_map']
+source_table    = models['source_table']
+source_stats    = models['source_stats']
+source_hist     = models['source_hist']
+source_cube     = models['source_cube']
+source_edges    = models['source_edges']
+map_summary     = models['map_summary']
+hist_summary    = models['hist_summary']
+train_controls  = {k[len('training_'):]: m for k, m in models.items()
+                   if k.startswith('training_')}
+
+tile_loader = tile_loader_for(dataset)
+tile_state  = {'features': tile_features,
+               'rids': [f['properties']['rid'] for f in tile_features]}
+
+
+def session_tile_geojson(features):
+    # the loaded tiles of this session, refreshed from its live pipeline
+    tile_state['features'] = features
+    tile_state['rids'] = [f['properties']['rid'] for f in features]
+    return tile_geojson(current['pipe'], features)
+
+
+# 6f) Spatial-index lookups: locate a point, count regions in the viewport
+def on_locate(attr, old, new):
+    try:
+        x, y = (float(v) for v in new.split(","))
+    except ValueError:
+        return
+    rows = locate_point(current['pipe']['geo_df'], x, y).tolist()
+    if tile_loader is not None:
+        # regions are only selectable while their tile is loaded
+        rows = set(rows)
+        rows = [i for i, rid in enumerate(tile_state['rids']) if rid in rows]
+    source_map.selected.indices = rows
+    view_div.text = f"{len(rows)} region(s) at ({x:g}, {y:g})"
+
+locate_input.on_change('value', on_locate)
+
+
+def select_from_server(source, indices):
+    # a selection the hex <-> map single-unit links (6b, 6c) must not rewrite or
+    # toggle off: they skip the next change of a tagged source. Only tagged when
+    # the selection changes, so the browser's callback is sure to clear the tag.
+    if list(source.selected.indices) != list(indices):
+        source.tags = ['server_selection']
+        source.selected.indices = indices
+
+
+# 6g) Attribute filter: indexed query over region attributes and cluster/BMU
+#     assignments, highlighting the matches on the map and their units on the grid
+def on_filter(attr, old, new):
+    if not new.strip():
+        source_hex.selected.indices = []
+        source_map.selected.indices = []
+        view_div.text = ""
+        return
+    p = current['pipe']
+    try:
+        rows = query_attributes({**p['attr_index'], **p['assign_index']}, new)
+    except ValueError as exc:
+        view_div.text = f"Filter: {exc}"
+        return
+    if tile_loader is not None:
+        # regions are only selectable while their tile is loaded
+        hits = set(rows.tolist())
+        select_from_server(source_map, [i for i, rid in enumerate(tile_state['rids'])
+                                        if rid in hits])
+    else:
+        select_from_server(source_map, rows.tolist())
+    select_from_server(source_hex, np.unique(p['bmu'][rows]).tolist())
+    view_div.text = f"{len(rows)} region(s) match"
+
+filter_input.on_change('value', on_filter)
+
+
+# 6h) Histogram variable: send the browser that feature's slice of the count cube,
+#     from which its callback redraws the histogram for the current selection
+def on_hist_select(attr, old, new):
+    p = current['pipe']
+    source_cube.data = cube_data(p['node_hist'], p['feature_names'].index(new))
+
+hist_select.on_change('value', on_hist_select)
+
+
+def on_map_ranges(event):
+    inds = regions_in_bbox(current['pipe']['geo_df'], (event.x0, event.y0, event.x1, event.y1))
+    view_div.text = f"{len(inds)} regions in view"
+    if tile_loader is not None:
+        bbox = (event.x0, event.y0, event.x1, event.y1)
+        source_map.geojson = session_tile_geojson(tile_loader.load(bbox, p_map.width))
+
+p_map.on_event(RangesUpdate, on_map_ranges)
+
+def hex_data(pipe):
+    # the hex source's columns for a pipeline, in the current color mode
+    node_df = build_node_frame(
+        pipe['hex_df'], pipe['som'], pipe['um_flat'], pipe['planes'], pipe['node_labels']
+    )
+    if toggle.active:
+        node_df['display_color'] = node_df['u_color']
+    return dict(ColumnDataSource.from_df(node_df))
+
+
+# 8) Data-file changes: update this session's sources in place, touching only
+#    what the recomputed (dirty) pipeline stages affect
+def apply_pipeline(new_pipe, dirty, shared=True):
+    old_pipe, current['pipe'] = current['pipe'], new_pipe
+    if new_pipe['feature_names'] != old_pipe['feature_names']:
+        # a numeric column was added or dropped: the selects, tables, histogram
+        # cube layout and the callbacks' feature lists are all keyed by feature,
+        # so reload the page into a new session of the refreshed pipeline
+        reload_div.text = "Dataset columns changed: reloading"
+        return
+    if (new_pipe['x_dim'], new_pipe['y_dim']) != (old_pipe['x_dim'], old_pipe['y_dim']):
+        # retrained on another grid: node indices no longer mean the same units
+        for cb in (map_summary, hist_summary):
+            cb.args = dict(cb.args, y_dim=new_pipe['y_dim'])
+        source_hex.selected.indices = []
+        source_map.selected.indices = []
+    if 'cluster' in dirty:
+        source_hex.data = hex_data(new_pipe)
+        quality_div.text = quality_text(new_pipe['quality'])
+        if shared:  # a session's own retrained model is not served on /score
+            publish(new_pipe)
+    if tile_loader is not None:
+        # tile geometry is rebuilt offline; refresh the loaded tiles' attributes
+        if 'cluster' in dirty:
+            source_map.geojson = session_tile_geojson(tile_state['features'])
+    elif 'cluster' in dirty or 'geometry' in dirty:
+        source_map.geojson = build_map_geojson(
+            new_pipe['geo_df'], new_pipe['hex_df'], map_columns(new_pipe))
+    if 'means' in dirty:
+        source_table.data = dict(ColumnDataSource.from_df(new_pipe['cluster_means_df']))
+        source_stats.data = dict(ColumnDataSource.from_df(new_pipe['node_stats']))
+        feature_names = new_pipe['feature_names']
+        source_cube.data = cube_data(new_pipe['node_hist'],
+                                     feature_names.index(hist_select.value))
+        source_edges.data = {c: new_pipe['hist_edges'][f] for f, c in enumerate(feature_names)}
+        source_hist.data = histogram_data(
+            new_pipe['node_hist'], new_pipe['hist_edges'],
+            feature_names.index(hist_select.value), source_hex.selected.indices
+        )
+
+register_session(dataset, doc, apply_pipeline)
+start_watcher()
+
+# 9) Retraining panel: train with the chosen parameters in a worker thread, show
+#    progress and the evolving map, and swap the result into this session's
+#    sources in one update
+retrain = {'job': None}
+
+
+def progress_html(step, total):
+    return (f'<progress value="{step}" max="{total}" style="width:150px"></progress>'
+            f' {100 * step // total}%')
+
+
+def on_train_progress(step, total):
+    train_controls['progress'].text = progress_html(step, total)
+
+
+def on_train_snapshot(som, um_flat, labels):
+    if retrain['job'] is None:
+        return  # late snapshot of a finished run
+    if len(um_flat) != len(source_hex.data['bmu_x']):
+        # new grid size (or a multi-resolution level): replace the source once,
+        # then patch; planes are not tracked while training
+        if plane_select.value != "":
+            plane_select.value = ""
+        node_df = build_node_frame(current['pipe']['hex_df'], som, um_flat, None, labels)
+        if toggle.active:
+            node_df['display_color'] = node_df['u_color']
+        source_hex.data = dict(ColumnDataSource.from_df(node_df))
+        return
+    # only the cells whose color or cluster changed go over the wire
+    patches = node_patches(source_hex.data, um_flat, labels, show_umatrix=toggle.active)
+    if patches:
+        source_hex.patch(patches)
+
+
+def on_train_done(new_pipe, error):
+    retrain['job'] = None
+    train_controls['train'].disabled = False
+    train_controls['cancel'].disabled = True
+    if error is not None or new_pipe is None:
+        # drop the run's last snapshot (possibly on another grid size): the hex
+        # grid goes back to the pipeline the map, tables and links still show
+        source_hex.data = hex_data(current['pipe'])
+        train_controls['progress'].text = (f"Training failed: {error}" if error is not None
+                                           else "Training cancelled")
+        return
+    # hold: every source change below reaches the browser as one message
+    doc.hold('combine')
+    try:
+        apply_pipeline(new_pipe, ['train', 'cluster', 'means'], shared=False)
+    finally:
+        doc.unhold()
+    train_controls['progress'].text = "Retrained"
+
+
+def on_train():
+    if retrain['job'] is not None:
+        return
+    params = {k: train_controls[k].value for k in
+              ('x_dim', 'y_dim', 'sigma', 'learning_rate', 'iterations', 'random_seed')}
+    for k in ('x_dim', 'y_dim', 'iterations', 'random_seed'):
+        params[k] = int(params[k])
+    params['multires'] = train_controls['multires'].active
+    train_controls['train'].disabled = True
+    train_controls['cancel'].disabled = False
+    train_controls['progress'].text = progress_html(0, 1)
+    snapshot_ms = int(train_controls['snapshot_ms'].value or 0)
+    if snapshot_ms > 0:
+        # snapshots patch the hex columns in place: stop sharing them first
+        source_hex.data = {k: v.copy() for k, v in source_hex.data.items()}
+    retrain['job'] = RetrainJob(current['pipe'], doc, params,
+                                on_train_progress, on_train_done,
+                                on_snapshot=on_train_snapshot if snapshot_ms > 0 else None,
+                                snapshot_ms=snapshot_ms)
+
+
+def on_cancel():
+    if retrain['job'] is not None:
+        retrain['job'].cancel()
+
+
+train_controls['train'].on_click(on_train)
+train_controls['cancel'].on_click(on_cancel)
+doc.on_session_destroyed(lambda ctx: on_cancel())
@@ -0,0 +1,109 @@
+# membench.py
+
+"""
+Memory benchmark of the pipeline: run every stage for one dataset in-process and
+report, per stage, the peak and retained memory it allocates (tracemalloc, which
+sees numpy buffers) next to the size of one copy of the scaled features and one
+of the geometry, plus the process's peak RSS (Linux).
+
+Usage:
+    python membench.py mydata --json mem.json
+"""
+
+import argparse
+import json
+import resource
+import time
+import tracemalloc
+from typing import Dict, List
+
+import numpy as np
+
+from pipeline import STAGES, dataset_paths
+from dashboard import map_columns
+from plots import build_map_geojson
+
+
+MB = 2 ** 20
+
+
+def feature_bytes(pipe: Dict[str, object]) -> int:
+    """
+    Bytes of one copy of the scaled features (stored values only when sparse).
+    """
+    scaled_df = pipe['scaled_df']
+    return int(scaled_df.memory_usage(index=False).sum())
+
+
+def geometry_bytes(pipe: Dict[str, object]) -> int:
+    """
+    Bytes of one copy of the geometry, measured as its WKB encoding.
+    """
+    return int(sum(len(wkb or b"") for wkb in pipe['geo_df'].geometry.to_wkb()))
+
+
+def run_stages_measured(name: str, n_clusters: int = 5) -> List[Dict[str, float]]:
+    """
+    Run the pipeline stages (as run_stages does, without reuse) and the map's
+    GeoJSON serialization, measuring each under tracemalloc.
+
+    Returns:
+        One row per stage, then a 'total' row with the pipeline's retained memory,
+        its peak, and that peak relative to one copy of features plus geometry.
+    """
+    data_path, model_path = dataset_paths(name)
+    pipe = dict(name=name, data_path=data_path, model_path=model_path,
+                n_clusters=n_clusters, simplify_tolerance=0.0)
+    steps = [(stage, run) for stage, _, run, _, _ in STAGES]
+    steps.append(("map", lambda p, prev: dict(map_geojson=build_map_geojson(
+        p['geo_df'], p['hex_df'], map_columns(p)))))
+
+    rows, overall_peak = [], 0
+    tracemalloc.start()
+    start = tracemalloc.get_traced_memory()[0]
+    for stage, run in steps:
+        tracemalloc.reset_peak()
+        before = tracemalloc.get_traced_memory()[0]
+        t0 = time.perf_counter()
+        pipe.update(run(pipe, None))
+        seconds = time.perf_counter() - t0
+        after, peak = tracemalloc.get_traced_memory()
+        overall_peak = max(overall_peak, peak - start)
+        rows.append({'stage': stage, 'seconds': seconds,
+                     'retained_mb': (after - before) / MB, 'peak_mb': (peak - before) / MB})
+    del pipe['raw_df']  # as run_stages: geo_df holds what the dashboard needs
+    retained = tracemalloc.get_traced_memory()[0] - start
+    tracemalloc.stop()
+
+    baseline = feature_bytes(pipe) + geometry_bytes(pipe)
+    rows.append({
+        'stage': 'total', 'seconds': sum(r['seconds'] for r in rows),
+        'retained_mb': retained / MB, 'peak_mb': overall_peak / MB,
+        'features_mb': feature_bytes(pipe) / MB, 'geometry_mb': geometry_bytes(pipe) / MB,
+        'peak_over_baseline': overall_peak / baseline if baseline else float('nan'),
+        # ru_maxrss is in KiB on Linux
+        'rss_peak_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        'rows': len(pipe['geo_df']), 'features': len(pipe['feature_names']),
+    })
+    return rows
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Per-stage pipeline memory benchmark.")
+    parser.add_argument("dataset", help="dataset name (data/<name>.gpkg or .parquet)")
+    parser.add_argument("--clusters", type=int, default=5)
+    parser.add_argument("--json", default=None, help="also write results to this file")
+    args = parser.parse_args()
+
+    rows = run_stages_measured(args.dataset, args.clusters)
+    for row in rows:
+        print(" ".join(f"{k}={v:.4g}" if isinstance(v, (float, np.floating)) else f"{k}={v}"
+                       for k, v in row.items()), flush=True)
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(rows, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,533 @@
+# pipeline.py
+
+"""
+Prepare everything the dashboard needs for one dataset as fingerprinted stages
+(load -> geometry / scale -> train -> cluster -> means), and keep prepared
+pipelines in a process-wide, memory-budgeted LRU cache.
+"""
+
+import hashlib
+import mmap
+import os
+import re
+import threading
+from collections import OrderedDict
+from typing import Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+from sklearn.preprocessing import StandardScaler
+
+from data_loader import (
+    load_data, scale_data, build_spatial_index, is_sparse_frame, build_attribute_index
+)
+from som_model import (
+    train_som, compute_umatrix, compute_component_planes, find_bmus, compute_quality,
+    save_model, load_model, restore_som, fit_projection, sample_rows
+)
+from bmu_search import build_bmu_index
+from cluster_analysis import (
+    cluster_nodes, assign_clusters, compute_cluster_means, compute_node_stats,
+    compute_node_histograms, assignment_index
+)
+from shared_data import attach_shared
+
+
+HERE = os.path.dirname(__file__)
+DATA_DIR = os.path.join(HERE, 'data')
+DEFAULT_DATASET = 'mydata'
+DATA_EXTENSIONS = ('.parquet', '.feather', '.gpkg')
+# share of variance kept by the optional PCA reduction before training and BMU
+# search (e.g. 0.95 for wide datasets); 0 trains on the full feature width
+PCA_VARIANCE = float(os.environ.get("SOM_PCA_VARIANCE", "0"))
+# train on a sample of this many rows ("uniform", "stratified" by the
+# SOM_STRATIFY attribute column, or "reservoir"); 0 trains on every row
+SAMPLE_SIZE = int(os.environ.get("SOM_SAMPLE_SIZE", "0"))
+SAMPLE_METHOD = os.environ.get("SOM_SAMPLE", "uniform")
+STRATIFY_COLUMN = os.environ.get("SOM_STRATIFY")
+# sparse (CSR) features: "auto" for wide, mostly-zero data (see scale_data), or
+# "1" / "0" to force the sparse / dense path
+SPARSE = {"1": True, "0": False}.get(os.environ.get("SOM_SPARSE", "auto"), "auto")
+
+
+def dataset_paths(name: str) -> Tuple[str, str]:
+    """
+    Resolve a dataset name (e.g. 'mydata', 'region_2021') to its files in data/.
+
+    Parameters:
+        name: dataset name; letters, digits, '_' and '-' only.
+
+    Returns:
+        (data_path, model_path): the input file and its saved-model artifact.
+
+    When several formats exist (e.g. a GeoParquet copy made with
+    data_loader.convert_to_geoparquet) the most recently modified one wins, ties
+    going to the columnar formats, so editing the GeoPackage is never shadowed
+    by a stale conversion.
+    """
+    if not re.fullmatch(r"[A-Za-z0-9_-]+", name):
+        raise ValueError(f"Invalid dataset name: {name!r}")
+    found = [
+        os.path.join(DATA_DIR, name + ext) for ext in DATA_EXTENSIONS
+        if os.path.exists(os.path.join(DATA_DIR, name + ext))
+    ]
+    if not found:
+        raise FileNotFoundError(f"No data file for dataset {name!r} in {DATA_DIR}")
+    data_path = max(found, key=lambda p: (os.stat(p).st_mtime_ns, -found.index(p)))
+    return data_path, os.path.join(DATA_DIR, name + '.model.npz')
+
+
+def _fingerprint(*parts) -> str:
+    return hashlib.sha1(repr(parts).encode()).hexdigest()
+
+
+def _file_key(path: str) -> Tuple[int, int]:
+    st = os.stat(path)
+    return st.st_mtime_ns, st.st_size
+
+
+def data_file_fingerprint(data_path: str) -> str:
+    """
+    Fingerprint of the "load" stage input: the data file's mtime and size.
+    """
+    return _fingerprint('load', _file_key(data_path))
+
+
+def shared_dir_for(name: str) -> str:
+    """
+    Directory of a dataset's shared-memory export (see shared_data.py).
+    """
+    return os.path.join(DATA_DIR, f"{name}_shared")
+
+
+def _frame_fingerprint(df: pd.DataFrame, columns: List[str]) -> str:
+    # column by column, so hashing never needs a copy of the frame
+    h = hashlib.sha1(repr(list(columns)).encode())
+    h.update(pd.util.hash_pandas_object(df.index).values.tobytes())
+    for c in columns:
+        h.update(pd.util.hash_pandas_object(df[c], index=False).values.tobytes())
+    return h.hexdigest()
+
+
+def _geometry_fingerprint(geometry: gpd.GeoSeries) -> str:
+    h = hashlib.sha1()
+    for wkb in geometry.to_wkb():
+        h.update(wkb or b"")
+    return h.hexdigest()
+
+
+# --- stages: each takes the pipeline built so far (plus the previous run's
+# --- outputs, for reuse) and returns its own outputs
+
+def _load_stage(pipe: Dict[str, object], prev: Dict[str, object]) -> Dict[str, object]:
+    raw_df = load_data(pipe['data_path'])
+    attrs = [c for c in raw_df.columns if c != raw_df.geometry.name]
+    return dict(
+        raw_df=raw_df,
+        attr_fp=_frame_fingerprint(raw_df, attrs),
+        geom_fp=_geometry_fingerprint(raw_df.geometry),
+    )
+
+
+def _geometry_stage(pipe: Dict[str, object], prev: Dict[str, object]) -> Dict[str, object]:
+    geo_df = pipe['raw_df']
+    if pipe['simplify_tolerance']:
+        geo_df.geometry = geo_df.geometry.simplify(
+            pipe['simplify_tolerance'], preserve_topology=True
+        )
+    build_spatial_index(geo_df)
+    return dict(geo_df=geo_df, attr_index=build_attribute_index(geo_df))
+
+
+def _reuse_geometry(pipe: Dict[str, object], prev: Dict[str, object]) -> Dict[str, object]:
+    # attribute-only change: keep the processed geometry (and its spatial index),
+    # swap in the new attribute columns
+    raw_df = pipe['raw_df']
+    geo_df = prev['geo_df'].copy(deep=False)
+    stale = [c for c in geo_df.columns if c not in raw_df.columns]
+    geo_df = geo_df.drop(columns=stale)
+    for c in raw_df.columns:
+        if c != raw_df.geometry.name:
+            geo_df[c] = raw_df[c].values
+    build_spatial_index(geo_df)
+    return dict(geo_df=geo_df, attr_index=build_attribute_index(geo_df))
+
+
+def _scale_stage(pipe: Dict[str, object], prev: Dict[str, object]) -> Dict[str, object]:
+    scaler = StandardScaler()
+    scaled_df, _ = scale_data(pipe['raw_df'], scaler=scaler, sparse=SPARSE)
+    return dict(scaled_df=scaled_df, scaler=scaler, feature_names=list(scaled_df.columns))
+
+
+def _train_stage(pipe: Dict[str, object], prev: Dict[str, object]) -> Dict[str, object]:
+    data_path, model_path = pipe['data_path'], pipe['model_path']
+    if (os.path.exists(model_path)
+            and os.path.getmtime(model_path) >= os.path.getmtime(data_path)):
+        model = load_model(model_path)
+        # (models saved while scale_data still scaled hex_x/hex_y have a wider
+        # scaler than their feature_names; those are retrained)
+        if (model['feature_names'] == pipe['feature_names']
+                and len(model['scaler'].scale_) == len(pipe['feature_names'])):
+            # saved model is newer than the data: restore instead of retraining
+            saved, scaled_df = model['scaler'], pipe['scaled_df']
+            if not (np.array_equal(saved.mean_, pipe['scaler'].mean_)
+                    and np.array_equal(saved.scale_, pipe['scaler'].scale_)):
+                # rescale only if the saved scaling differs from the scale stage's
+                # (usually identical); a model trained on sparse features was
+                # saved with a zero mean
+                sparse = SPARSE if not np.any(saved.mean_) else False
+                scaled_df, _ = scale_data(
+                    pipe['raw_df'], scaler=saved, columns=model['feature_names'],
+                    sparse=sparse
+                )
+            return dict(som=restore_som(model), saved_node_labels=model['node_labels'],
+                        scaler=model['scaler'], scaled_df=scaled_df,
+                        projection=model['projection'], sample_index=None)
+    train_df, sample_index = pipe['scaled_df'], None
+    if 0 < SAMPLE_SIZE < len(train_df):
+        strata = pipe['raw_df'][STRATIFY_COLUMN].values if STRATIFY_COLUMN else None
+        sample_index = sample_rows(train_df, SAMPLE_SIZE, SAMPLE_METHOD, strata)
+        train_df = train_df.iloc[sample_index]
+    projection = None
+    if 0 < PCA_VARIANCE < 1 and not is_sparse_frame(train_df):
+        projection = fit_projection(train_df, variance=PCA_VARIANCE)
+    return dict(som=train_som(train_df, projection=projection),
+                saved_node_labels=None, projection=projection, sample_index=sample_index)
+
+
+def _cluster_stage(pipe: Dict[str, object], prev: Dict[str, object]) -> Dict[str, object]:
+    som, scaled_df = pipe['som'], pipe['scaled_df']
+    node_labels = pipe['saved_node_labels']
+    if node_labels is None:
+        # "connected" keeps node clustering near-linear on large grids
+        node_labels = cluster_nodes(som, n_clusters=pipe['n_clusters'], method="connected")
+        # saved for offline scoring and for cheap reloads after eviction
+        save_model(pipe['model_path'], som, pipe['scaler'], pipe['feature_names'],
+                   node_labels, projection=pipe['projection'])
+
+    # U-Matrix, BMUs and quality metrics (one BMU pass for both)
+    projection = pipe['projection']
+    # reused by every BMU lookup; over the reduced codebook when there is a projection
+    bmu_index = build_bmu_index(som, method="kdtree", projection=projection)
+    bmu, bmu2, bmu_dist, bmu2_dist = find_bmus(som, scaled_df, index=bmu_index,
+                                               projection=projection)
+    x_dim, y_dim, _ = som.get_weights().shape
+    # full-population metrics, plus the training sample's for comparison
+    quality = compute_quality(som, bmu, bmu2, bmu_dist)
+    sample_index = pipe['sample_index']
+    if sample_index is not None:
+        sampled = compute_quality(som, bmu[sample_index], bmu2[sample_index],
+                                  bmu_dist[sample_index])
+        quality.update({f"sample_{k}": v for k, v in sampled.items()},
+                       sample_size=len(sample_index))
+    hex_df = assign_clusters(som, scaled_df, node_labels=node_labels, bmus=bmu)
+    return dict(
+        node_labels=node_labels, um_flat=compute_umatrix(som), bmu_index=bmu_index,
+        bmu=bmu, bmu2=bmu2, bmu_dist=bmu_dist, bmu2_dist=bmu2_dist,
+        quality=quality,
+        planes=compute_component_planes(som, pipe['feature_names']),
+        hex_df=hex_df, assign_index=assignment_index(hex_df),
+        x_dim=x_dim, y_dim=y_dim,
+    )
+
+
+def _means_stage(pipe: Dict[str, object], prev: Dict[str, object]) -> Dict[str, object]:
+    hex_df, scaler = pipe['hex_df'], pipe['scaler']
+    node_hist, edges = compute_node_histograms(hex_df, pipe['x_dim'], pipe['y_dim'])
+    return dict(
+        cluster_means_df=compute_cluster_means(hex_df),
+        node_stats=compute_node_stats(hex_df, pipe['x_dim'], pipe['y_dim']),
+        # bin edges back in the features' original units, for the histogram axes
+        # (through the scaler, which checks it matches the feature columns)
+        node_hist=node_hist,
+        hist_edges=scaler.inverse_transform(edges.T).T,
+    )
+
+
+# (name, input fingerprint from the pipeline so far, run, reuse, outputs)
+# The last stage, the sessions' plot sources, runs per session (see main.py) and
+# is told which of these were dirty.
+STAGES = [
+    ("load", lambda p, fp: _file_key(p['data_path']),
+     _load_stage, None, ("raw_df", "attr_fp", "geom_fp")),
+    ("geometry", lambda p, fp: (p['geom_fp'], p['simplify_tolerance']),
+     _geometry_stage, _reuse_geometry, ("geo_df", "attr_index")),
+    ("scale", lambda p, fp: p['attr_fp'],
+     _scale_stage, None, ("scaled_df", "scaler", "feature_names")),
+    ("train", lambda p, fp: fp['scale'],
+     _train_stage, None, ("som", "saved_node_labels", "scaler", "scaled_df", "projection",
+                          "sample_index")),
+    ("cluster", lambda p, fp: (fp['train'], p['n_clusters']),
+     _cluster_stage, None, ("node_labels", "um_flat", "bmu_index", "bmu", "bmu2",
+                            "bmu_dist", "bmu2_dist", "quality", "planes", "hex_df",
+                            "assign_index", "x_dim", "y_dim")),
+    ("means", lambda p, fp: fp['cluster'],
+     _means_stage, None, ("cluster_means_df", "node_stats", "node_hist", "hist_edges")),
+]
+
+
+def run_stages(
+    name: str,
+    previous: Dict[str, object] = None,
+    n_clusters: int = 5,
+    simplify_tolerance: float = 0.0
+) -> Tuple[Dict[str, object], List[str]]:
+    """
+    Run the pipeline stages for one dataset, reusing every stage of a previous run
+    whose input fingerprint is unchanged.
+
+    Attribute-only changes to the data file keep the processed geometry;
+    geometry-only changes keep the scaled features, SOM, clusters and summaries.
+
+    Parameters:
+        name: dataset name (see dataset_paths).
+        previous: an earlier output of run_stages for the same dataset, or None.
+        n_clusters, simplify_tolerance: see prepare_pipeline (taken from previous
+            when given).
+
+    Returns:
+        (pipeline, dirty): the prepared pipeline, and the names of the stages that
+        were recomputed (empty if the data file is unchanged).
+    """
+    data_path, model_path = dataset_paths(name)
+    if previous is not None:
+        n_clusters = previous['n_clusters']
+        simplify_tolerance = previous['simplify_tolerance']
+        if previous['fingerprints']['load'] == data_file_fingerprint(data_path):
+            return previous, []
+
+    pipe = dict(name=name, data_path=data_path, model_path=model_path,
+                n_clusters=n_clusters, simplify_tolerance=simplify_tolerance)
+    fps, dirty = {}, []
+    for stage, key_fn, run, reuse, outputs in STAGES:
+        fps[stage] = _fingerprint(stage, key_fn(pipe, fps))
+        if previous is not None and previous['fingerprints'].get(stage) == fps[stage]:
+            if reuse is not None:
+                pipe.update(reuse(pipe, previous))
+            else:
+                pipe.update({k: previous[k] for k in outputs})
+        else:
+            pipe.update(run(pipe, previous))
+            dirty.append(stage)
+
+    pipe['fingerprints'] = fps
+    del pipe['raw_df']  # geo_df holds what the dashboard needs
+    return pipe, dirty
+
+
+def prepare_pipeline(
+    name: str = DEFAULT_DATASET,
+    n_clusters: int = 5,
+    simplify_tolerance: float = 0.0
+) -> Dict[str, object]:
+    """
+    Load, scale, train (or restore), cluster and summarize one dataset.
+
+    If a saved model newer than the data file exists it is reused, so reloading an
+    evicted pipeline skips SOM training and node clustering.
+
+    Parameters:
+        name: dataset name (see dataset_paths).
+        n_clusters: number of clusters to form on the SOM grid.
+        simplify_tolerance: geometry simplification tolerance in map units (0 = none).
+
+    Returns:
+        A dict of every prepared artifact, keyed as in main.py.
+    """
+    return run_stages(name, None, n_clusters, simplify_tolerance)[0]
+
+
+def refresh_pipeline(previous: Dict[str, object]) -> Tuple[Dict[str, object], List[str]]:
+    """
+    Recompute only the dirty stages of a prepared pipeline after its data file changed.
+
+    Returns:
+        (pipeline, dirty) as for run_stages.
+    """
+    return run_stages(previous['name'], previous)
+
+
+def retrain_pipeline(
+    previous: Dict[str, object],
+    progress: Callable[[int, int, object], None] = None,
+    **train_kwargs
+) -> Dict[str, object]:
+    """
+    Retrain a prepared pipeline's SOM with other parameters and recompute its
+    cluster and means stages, for a single session: the shared cache entry and
+    the saved model are left untouched.
+
+    Parameters:
+        previous: a prepared pipeline.
+        progress: passed to som_model.train_som (may raise TrainingCancelled).
+        **train_kwargs: x_dim, y_dim, sigma, learning_rate, iterations,
+            random_seed, ... for som_model.train_som.
+
+    Returns:
+        A new pipeline dict; previous is not modified.
+    """
+    pipe = dict(previous)
+    pipe.pop('session_template', None)  # built from the shared pipeline's sources
+    som = train_som(pipe['scaled_df'], projection=pipe['projection'],
+                    progress=progress, **train_kwargs)
+    # clustering the nodes here keeps the cluster stage from saving this
+    # session-only model over the dataset's
+    pipe.update(som=som, sample_index=None, saved_node_labels=cluster_nodes(
+        som, n_clusters=pipe['n_clusters'], method="connected"))
+    pipe.update(_cluster_stage(pipe, previous))
+    pipe.update(_means_stage(pipe, previous))
+    fp = _fingerprint('retrain', previous['fingerprints']['scale'], sorted(train_kwargs.items()))
+    pipe['fingerprints'] = dict(previous['fingerprints'], train=fp, cluster=fp, means=fp)
+    return pipe
+
+
+def load_pipeline(name: str) -> Dict[str, object]:
+    """
+    Attach to a current shared-memory export of the dataset if one exists
+    (memory-mapped, shared by all worker processes), else prepare it here.
+    """
+    data_path, model_path = dataset_paths(name)
+    pipe = attach_shared(shared_dir_for(name), data_path, model_path,
+                         data_file_fingerprint(data_path))
+    return pipe if pipe is not None else prepare_pipeline(name)
+
+
+def _is_mapped(values: np.ndarray) -> bool:
+    # a memmap, or a view whose chain of bases ends in one (or in its mmap)
+    base = values
+    while isinstance(base, np.ndarray):
+        if isinstance(base, np.memmap):
+            return True
+        base = base.base
+    return isinstance(base, mmap.mmap)
+
+
+def _frame_nbytes(df: pd.DataFrame) -> int:
+    total = int(df.index.memory_usage(deep=True))
+    for i in range(df.shape[1]):
+        column = df.iloc[:, i]
+        if isinstance(column.dtype, np.dtype) and _is_mapped(column.to_numpy(copy=False)):
+            continue
+        total += int(column.memory_usage(index=False, deep=True))
+    return total
+
+
+def estimate_nbytes(pipeline: Dict[str, object]) -> int:
+    """
+    Approximate resident size of a prepared pipeline.
+
+    Counts numpy arrays, DataFrames (deep) and geometry (as WKB); the SOM
+    and BMU index are counted as a few copies of the codebook. Memory-mapped
+    arrays, and DataFrame columns over them (see shared_data.attach_shared),
+    live in the shared page cache and are not counted.
+    """
+    total = 0
+    for key, value in pipeline.items():
+        if isinstance(value, np.ndarray) and _is_mapped(value):
+            continue
+        if isinstance(value, gpd.GeoDataFrame):
+            total += _frame_nbytes(value.drop(columns=value.geometry.name))
+            total += int(value.geometry.to_wkb().map(len).sum())
+        elif isinstance(value, pd.DataFrame):
+            total += _frame_nbytes(value)
+        elif isinstance(value, np.ndarray):
+            total += value.nbytes
+        elif key == 'session_template':  # see dashboard._template
+            total += value['nbytes']
+        elif key in ('attr_index', 'assign_index'):
+            total += sum(a.nbytes for entry in value.values() for a in entry.values()
+                         if isinstance(a, np.ndarray))
+    total += 4 * pipeline['som'].get_weights().nbytes
+    return total
+
+
+class PipelineCache:
+    """
+    Process-wide LRU of prepared pipelines, bounded by a memory budget.
+
+    get() returns a cached pipeline (marking it most recently used) or prepares it,
+    then evicts least recently used entries until the total estimated size fits
+    the budget (the newest entry is always kept). Evicted pipelines are rebuilt
+    lazily from their on-disk artifacts on next use; sessions still holding one
+    keep it alive until they close.
+
+    Preparing a pipeline holds only that dataset's lock: sessions of other,
+    cached datasets are served meanwhile, and concurrent sessions of the same
+    dataset wait for the one preparation instead of repeating it.
+    """
+
+    def __init__(
+        self,
+        budget_bytes: int,
+        loader: Callable[[str], Dict[str, object]] = load_pipeline
+    ):
+        self.budget_bytes = budget_bytes
+        self.loader = loader
+        self._entries = OrderedDict()  # name -> (pipeline, nbytes)
+        self._lock = threading.Lock()  # guards _entries and _loading only
+        self._loading = {}  # name -> lock held while that dataset is prepared
+
+    def get(self, name: str) -> Dict[str, object]:
+        with self._lock:
+            pipeline = self._lookup(name)
+            if pipeline is not None:
+                return pipeline
+            load_lock = self._loading.setdefault(name, threading.Lock())
+        with load_lock:
+            with self._lock:
+                # prepared by another session while this one waited
+                pipeline = self._lookup(name)
+                if pipeline is not None:
+                    return pipeline
+            pipeline = self.loader(name)
+            nbytes = estimate_nbytes(pipeline)
+            with self._lock:
+                self._entries[name] = (pipeline, nbytes)
+                self._evict()
+            return pipeline
+
+    def replace(self, name: str, pipeline: Dict[str, object]) -> None:
+        """
+        Swap in a refreshed pipeline if the dataset is still cached.
+        """
+        with self._lock:
+            if name in self._entries:
+                self._entries[name] = (pipeline, estimate_nbytes(pipeline))
+                self._evict()
+
+    def update_estimate(self, name: str, pipeline: Dict[str, object]) -> None:
+        """
+        Re-estimate a cached pipeline after more memory was attached to it (e.g.
+        dashboard's session template), evicting others if it no longer fits.
+        """
+        with self._lock:
+            if name in self._entries and self._entries[name][0] is pipeline:
+                self._entries[name] = (pipeline, estimate_nbytes(pipeline))
+                self._evict()
+
+    def snapshot(self) -> List[Tuple[str, Dict[str, object]]]:
+        with self._lock:
+            return [(name, entry[0]) for name, entry in self._entries.items()]
+
+    def invalidate(self, name: str) -> None:
+        with self._lock:
+            self._entries.pop(name, None)
+
+    def _lookup(self, name: str) -> Optional[Dict[str, object]]:
+        if name not in self._entries:
+            return None
+        self._entries.move_to_end(name)
+        return self._entries[name][0]
+
+    @property
+    def nbytes(self) -> int:
+        return sum(n for _, n in self._entries.values())
+
+    def _evict(self) -> None:
+        while len(self._entries) > 1 and self.nbytes > self.budget_bytes:
+            self._entries.popitem(last=False)
+
+
+# shared by every session in this server process; budget from SOM_CACHE_MB
+PIPELINES = PipelineCache(int(os.environ.get("SOM_CACHE_MB", "2048")) * 2**20)
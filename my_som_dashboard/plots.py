@@ -1,7 +1,8 @@
 # plots.py
 
 """
-Build Bokeh figures: hex plot, geographic map, and data table.
+Build Bokeh figures: hex plot, geographic map, data tables and the selection
+histogram.
 """
 
 import numpy as np
@@ -17,57 +18,129 @@ from bokeh.models import (
 )
 from bokeh.palettes import Viridis256, Category10
 from bokeh.events import ButtonClick
-from typing import Tuple, List
+from typing import Tuple, List, Dict
+
+
+def _cluster_palette(n_clusters: int) -> List[str]:
+    base = Category10[10]
+    return (base * ((n_clusters // 10) + 1))[:n_clusters]
+
+
+def node_colors(
+    um_flat: np.ndarray,
+    node_labels: np.ndarray,
+    cluster_palette: List[str]
+) -> Dict[str, list]:
+    """
+    The per-node columns of the hex source that follow from the codebook:
+    hc_cluster, u_color (U-Matrix on Viridis) and color (cluster palette).
+    """
+    um_min, um_max = um_flat.min(), um_flat.max()
+    norm = ((um_flat - um_min) / ((um_max - um_min) or 1) * 255).astype(int)
+    labels = np.asarray(node_labels, dtype=int)
+    return {
+        'hc_cluster': labels.tolist(),
+        'u_color': [Viridis256[k] for k in norm],
+        'color': [cluster_palette[k] for k in labels],
+    }
+
+
+def node_patches(
+    data: Dict[str, list],
+    um_flat: np.ndarray,
+    node_labels: np.ndarray,
+    show_umatrix: bool = False
+) -> Dict[str, list]:
+    """
+    ColumnDataSource.patch payload moving a hex source built by build_node_frame
+    to a new U-Matrix and node labelling, listing only the cells that changed.
+
+    Parameters:
+        data: the hex source's current data.
+        um_flat, node_labels: the new U-Matrix and per-node labels (same grid).
+        show_umatrix: whether display_color currently shows the U-Matrix.
+
+    Returns:
+        {column: [(row, value), ...]} for the changed columns only.
+    """
+    n_clusters = max(int(np.max(node_labels)) + 1, max(data['hc_cluster']) + 1)
+    cols = node_colors(um_flat, node_labels, _cluster_palette(n_clusters))
+    cols['display_color'] = cols['u_color'] if show_umatrix else cols['color']
+    patches = {}
+    for col, new in cols.items():
+        old = data[col]
+        changed = [(i, v) for i, (o, v) in enumerate(zip(old, new)) if o != v]
+        if changed:
+            patches[col] = changed
+    return patches
+
+
+def build_node_frame(
+    hex_df: pd.DataFrame,
+    som: MiniSom,
+    um_flat: np.ndarray,
+    planes: pd.DataFrame = None,
+    node_labels: np.ndarray = None
+) -> pd.DataFrame:
+    """
+    One row per SOM unit (node) with its (i,j), hc_cluster, u_color, color and
+    component planes: the data behind the hex plot's source, also used to refresh
+    it in place when the pipeline is recomputed.
+    """
+    n_clusters = int(hex_df['hc_cluster'].max()) + 1
+    if node_labels is not None:
+        n_clusters = max(n_clusters, int(node_labels.max()) + 1)
+    cluster_palette = _cluster_palette(n_clusters)
+
+    w = som.get_weights()             # shape (X, Y, features)
+    X, Y, _ = w.shape
+    # node labels must match the clustering used by assign_clusters
+    if node_labels is None:
+        from cluster_analysis import cluster_nodes
+        node_labels = cluster_nodes(som, n_clusters)  # length X*Y
+
+    node_df = pd.DataFrame({
+        'bmu_x': np.repeat(np.arange(X), Y),
+        'bmu_y': np.tile(np.arange(Y), X),
+        **node_colors(um_flat, node_labels, cluster_palette),
+        'alpha': 1.0,
+    })
+    node_df["display_color"] = node_df["color"]
+
+    # component planes ride along as numeric columns, so switching planes only
+    # re-points the color mapper instead of re-sending the source
+    if planes is not None:
+        for c in planes.columns:
+            node_df[f"cp_{c}"] = planes[c].values
+    return node_df
 
 
 def build_hex_plot(
     hex_df: pd.DataFrame,
     som: MiniSom,
     um_flat: np.ndarray,
-    toggle
+    toggle,
+    planes: pd.DataFrame = None,
+    plane_select=None,
+    node_labels: np.ndarray = None
 ) -> Tuple[figure, ColumnDataSource]:
     from bokeh.models.glyphs import HexTile
 
     # 1) cluster palette
     n_clusters = int(hex_df['hc_cluster'].max()) + 1
-    base = Category10[10]
-    cluster_palette = (base * ((n_clusters // 10) + 1))[:n_clusters]
-    cmap_hc = LinearColorMapper(palette=cluster_palette, low=0, high=n_clusters - 1)
+    if node_labels is not None:
+        n_clusters = max(n_clusters, int(node_labels.max()) + 1)
+    cmap_hc = LinearColorMapper(palette=_cluster_palette(n_clusters), low=0, high=n_clusters - 1)
 
-    # 2) Build a DataFrame of one row per SOM‐unit (node)
-    #    with its (i,j), hc_cluster, u_color, and color
-    w = som.get_weights()             # shape (X, Y, features)
-    X, Y, _ = w.shape
-    # flatten node_labels from our clustering of weights
-    flat_weights = w.reshape(X*Y, -1)
-    # we need the same hierarchical clustering as in cluster_analysis
-    from sklearn.cluster import AgglomerativeClustering
-    hc = AgglomerativeClustering(n_clusters=n_clusters).fit(flat_weights)
-    node_labels = hc.labels_         # length X*Y
-
-    records = []
-    um_min, um_max = um_flat.min(), um_flat.max()
-    for i in range(X):
-        for j in range(Y):
-            idx = i*Y + j
-            d = um_flat[idx]
-            norm = int((d - um_min)/(um_max - um_min)*255)
-            records.append({
-                'bmu_x':      i,
-                'bmu_y':      j,
-                'hc_cluster': int(node_labels[idx]),
-                'u_color':    Viridis256[norm],
-                'color':      cluster_palette[int(node_labels[idx])],
-                'alpha':      1.0,
-            })
-    node_df = pd.DataFrame.from_records(records)
-    node_df["display_color"] = node_df["color"]
+    # 2) one row per SOM-unit (node)
+    node_df = build_node_frame(hex_df, som, um_flat, planes, node_labels)
     node_source = ColumnDataSource(node_df)
+    um_min, um_max = um_flat.min(), um_flat.max()
 
     # 3) build the figure
     p_hex = figure(
         title="SOM Units (Hexplot)",
-        tools="pan,wheel_zoom,reset,tap",
+        tools="pan,wheel_zoom,reset,tap,lasso_select",
         match_aspect=True, width=450, height=450,
         background_fill_color="#ffffff", outline_line_color="#cccccc"
     )
@@ -123,9 +196,15 @@ def build_hex_plot(
     p_hex.add_layout(cb_u,  'right')
 
     # 7) wire up U-matrix toggle
+    toggle_args = dict(src=node_source, bar_c=cb_cl, bar_u=cb_u)
+    reset_plane = ""
+    if plane_select is not None:
+        toggle_args["plane"] = plane_select
+        reset_plane = """
+            if (plane.value !== "") { plane.value = ""; }"""
     toggle.js_on_change('active', CustomJS(
-        args=dict(src=node_source, bar_c=cb_cl, bar_u=cb_u),
-        code="""
+        args=toggle_args,
+        code=reset_plane + """
             const showU = cb_obj.active;
             const colors = showU ? src.data['u_color'] : src.data['color'];
             const newData = Object.assign({}, src.data);
@@ -136,32 +215,82 @@ def build_hex_plot(
         """
     ))
 
+    # 8) wire up component-plane selector: swap the field the fill color reads
+    if plane_select is not None:
+        cmap_cp = LinearColorMapper(palette=Viridis256, low=0, high=1)
+        cb_cp = ColorBar(color_mapper=cmap_cp, label_standoff=12,
+                         location=(0,0), visible=False)
+        p_hex.add_layout(cb_cp, 'right')
+        plane_select.js_on_change('value', CustomJS(
+            args=dict(
+                r=hex_renderer, src=node_source, cmap=cmap_cp, bar_cp=cb_cp,
+                bar_c=cb_cl, bar_u=cb_u, toggle=toggle,
+                labels=dict(plane_select.options)
+            ),
+            code="""
+                const col = cb_obj.value;
+                const glyphs = [r.glyph, r.hover_glyph,
+                                r.selection_glyph, r.nonselection_glyph];
+                if (col === "") {
+                    for (const g of glyphs) g.fill_color = {field: "display_color"};
+                } else {
+                    const vals = src.data[col];
+                    let lo = Infinity, hi = -Infinity;
+                    for (const v of vals) { if (v < lo) lo = v; if (v > hi) hi = v; }
+                    cmap.low  = lo;
+                    cmap.high = hi;
+                    for (const g of glyphs) g.fill_color = {field: col, transform: cmap};
+                    bar_cp.title = labels[col];
+                }
+                bar_cp.visible = col !== "";
+                bar_c.visible  = col === "" && !toggle.active;
+                bar_u.visible  = col === "" &&  toggle.active;
+            """
+        ))
+
     return p_hex, node_source
 
 
+def build_map_geojson(
+    geo_df: gpd.GeoDataFrame,
+    hex_df: pd.DataFrame,
+    columns: Dict[str, np.ndarray] = None
+) -> str:
+    """
+    GeoJSON for the map source: regions with their cluster label, plus any extra
+    per-region columns (e.g. BMU coordinates), attached by position.
+
+    The columns are added to a shallow copy, so geo_df's geometry and attribute
+    arrays are serialized in place rather than copied.
+    """
+    df = geo_df.copy(deep=False)
+    df['hc_cluster'] = hex_df['hc_cluster'].values
+    for c, values in (columns or {}).items():
+        df[c] = values
+    return df.to_json()
+
+
 def build_map_plot(
     geo_df: gpd.GeoDataFrame,
     hex_df: pd.DataFrame,
-    cluster_buttons: List
+    cluster_buttons: List,
+    geojson: str = None,
+    columns: Dict[str, np.ndarray] = None
 ) -> Tuple[figure, GeoJSONDataSource]:
     from bokeh.models import GeoJSONDataSource
 
-    # attach cluster label by index
-    df = geo_df.copy()
-    df['hc_cluster'] = hex_df['hc_cluster'].values
-
-    # GeoJSON source
-    source_map = GeoJSONDataSource(geojson=df.to_json())
+    # GeoJSON source (prebuilt, e.g. viewport tiles, or serialized from geo_df)
+    if geojson is None:
+        geojson = build_map_geojson(geo_df, hex_df, columns)
+    source_map = GeoJSONDataSource(geojson=geojson)
 
     # match the hex‐plot palette exactly
-    max_c = int(df['hc_cluster'].max())
-    base = Category10[10]
-    palette = (base * ((max_c // 10) + 1))[:max_c+1]
-    cmap    = LinearColorMapper(palette=palette, low=0, high=max_c)
+    max_c = int(hex_df['hc_cluster'].max())
+    cmap  = LinearColorMapper(palette=_cluster_palette(max_c + 1), low=0, high=max_c)
 
     p_map = figure(
         title="Geographic Map (HC Clusters)",
-        tools="pan,wheel_zoom,reset,tap",
+        tools="pan,wheel_zoom,reset,tap,lasso_select",
         width=450, height=450, background_fill_color="#efefef"
     )
     p_map.axis.visible = False
@@ -172,7 +301,9 @@ def build_map_plot(
         fill_color={'field': 'hc_cluster', 'transform': cmap},
         line_color="white", line_width=0.5, hover_line_color="black"
     )
-    p_map.add_tools(HoverTool(renderers=[patches], tooltips=[("Cluster","@hc_cluster")]))
+    tooltips = [("Cluster","@hc_cluster"),
+                ("BMU dist", "@bmu_dist{0.000}"), ("2nd BMU dist", "@bmu2_dist{0.000}")]
+    p_map.add_tools(HoverTool(renderers=[patches], tooltips=tooltips))
 
     return p_map, source_map
 
@@ -184,3 +315,91 @@ def build_data_table(cluster_means_df: pd.DataFrame) -> DataTable:
         cols.append(TableColumn(field=c, title=c, width=120))
     return DataTable(source=source, columns=cols, width=800, height=280,
                      fit_columns=False, index_position=None)
+
+
+def build_selection_table(node_stats: pd.DataFrame) -> Tuple[DataTable, ColumnDataSource]:
+    """
+    One-row table of feature means over the current selection.
+
+    Parameters:
+        node_stats: output of compute_node_stats (one row per SOM node).
+
+    Returns:
+        (DataTable, stats_source): the table, plus a source holding the per-node
+        counts and sums that selection callbacks aggregate over.
+    """
+    features = list(node_stats.columns.drop('_n'))
+    stats_source = ColumnDataSource(node_stats)
+
+    empty = {f: [float('nan')] for f in features}
+    empty['selection'] = ['Selection (n=0)']
+    source = ColumnDataSource(empty)
+    cols   = [TableColumn(field='selection', title='Selection', width=120)]
+    for c in features:
+        cols.append(TableColumn(field=c, title=c, width=120))
+    table = DataTable(source=source, columns=cols, width=800, height=60,
+                      fit_columns=False, index_position=None)
+    return table, stats_source
+
+
+def histogram_data(
+    node_hist: np.ndarray,
+    edges: np.ndarray,
+    feature: int,
+    nodes: List[int] = ()
+) -> Dict[str, list]:
+    """
+    Data of the selection histogram's source for one feature: bin edges, counts
+    over all nodes and over the given (selected) nodes.
+    """
+    return {
+        'left': edges[feature, :-1].tolist(),
+        'right': edges[feature, 1:].tolist(),
+        'all': node_hist[:, feature, :].sum(axis=0).tolist(),
+        'selected': node_hist[list(nodes), feature, :].sum(axis=0).tolist(),
+    }
+
+
+def cube_data(node_hist: np.ndarray, feature: int) -> Dict[str, np.ndarray]:
+    """
+    Data of the count cube's source: one feature's per-node bin counts, flattened
+    node by node. Only the histogram's current feature is sent to the browser; the
+    whole cube grows with grid size times features.
+    """
+    return {'counts': np.ascontiguousarray(node_hist[:, feature, :]).ravel()}
+
+
+def build_histogram_plot(
+    node_hist: np.ndarray,
+    edges: np.ndarray,
+    feature_names: List[str]
+) -> Tuple[figure, ColumnDataSource, ColumnDataSource, ColumnDataSource]:
+    """
+    Histogram of one feature over the whole dataset, with the current selection
+    overlaid.
+
+    Parameters:
+        node_hist, edges: output of cluster_analysis.compute_node_histograms
+            (edges in the features' original units).
+        feature_names: features in the cube's order.
+
+    Returns:
+        (figure, hist_source, cube_source, edges_source): the plot and its source,
+        plus the first feature's slice of the count cube (see cube_data; replaced
+        when the histogram variable changes) and the bin edges per feature, from
+        which selection callbacks recompute the histogram in the browser.
+    """
+    cube_source = ColumnDataSource(cube_data(node_hist, 0))
+    edges_source = ColumnDataSource({c: edges[f] for f, c in enumerate(feature_names)})
+    hist_source = ColumnDataSource(histogram_data(node_hist, edges, 0))
+
+    p_hist = figure(title="Selection histogram", width=450, height=250,
+                    tools="", toolbar_location=None)
+    p_hist.quad(left="left", right="right", bottom=0, top="all", source=hist_source,
+                fill_color="#dddddd", line_color="#ffffff", legend_label="All")
+    p_hist.quad(left="left", right="right", bottom=0, top="selected", source=hist_source,
+                fill_color=Category10[10][0], fill_alpha=0.8, line_color="#ffffff",
+                legend_label="Selection")
+    p_hist.legend.location = "top_right"
+    p_hist.y_range.start = 0
+    return p_hist, hist_source, cube_source, edges_source
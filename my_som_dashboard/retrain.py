@@ -0,0 +1,123 @@
+# retrain.py
+
+"""
+Retrain a session's SOM with user-chosen parameters off the IOLoop thread,
+streaming progress and codebook snapshots back to the session and supporting
+cancellation.
+"""
+
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from typing import Callable, Dict
+
+import numpy as np
+from bokeh.document import Document
+
+from cluster_analysis import cluster_nodes, align_labels
+from pipeline import retrain_pipeline
+from som_model import TrainingCancelled, compute_umatrix, restore_som
+
+
+log = logging.getLogger(__name__)
+
+# shared by every session in this server process; training mostly runs in numpy,
+# so the IOLoop and other sessions stay responsive while a job is running
+_EXECUTOR = ThreadPoolExecutor(max_workers=2, thread_name_prefix="som-retrain")
+# turns snapshot codebooks into U-Matrix + node labels, so the training threads
+# only pay for copying the weights
+_SNAPSHOTS = ThreadPoolExecutor(max_workers=1, thread_name_prefix="som-snapshot")
+
+
+class RetrainJob:
+    """
+    One retraining run for one session.
+
+    Progress and the result are delivered on the session's next tick, so the
+    callbacks may update Bokeh models directly.
+
+    Parameters:
+        pipe: the session's current pipeline.
+        doc: the session's Document.
+        params: keyword arguments for som_model.train_som (grid size, sigma, ...).
+        on_progress: called with (step, total_steps) at most `updates` times.
+        on_done: called with (pipeline, None) on success, (None, None) when
+                 cancelled, or (None, exception) on failure.
+        updates: how many progress updates to send over the whole run.
+        on_snapshot: if given, called with (som, um_flat, node_labels) for a copy
+                 of the codebook taken every snapshot_ms during training, node
+                 labels renumbered to match the previous snapshot. A snapshot is
+                 skipped while the previous one is still being summarized.
+        snapshot_ms: minimum time between snapshots.
+    """
+
+    def __init__(
+        self,
+        pipe: Dict[str, object],
+        doc: Document,
+        params: Dict[str, object],
+        on_progress: Callable[[int, int, object], None],
+        on_done: Callable[[Dict[str, object], Exception], None],
+        updates: int = 100,
+        on_snapshot: Callable[[object, np.ndarray, np.ndarray], None] = None,
+        snapshot_ms: int = 500
+    ):
+        self._doc = doc
+        self._cancel = threading.Event()
+        self._on_progress = on_progress
+        self._on_done = on_done
+        self._on_snapshot = on_snapshot
+        self._snapshot_s = snapshot_ms / 1000
+        self._last_snapshot = time.monotonic()
+        self._pending = None
+        self._labels = None
+        self._n_clusters = pipe['n_clusters']
+        iterations = params.get('iterations', 1000)
+        self._progress_every = max(1, iterations // updates)
+        self._future = _EXECUTOR.submit(self._run, pipe, params)
+
+    def cancel(self) -> None:
+        """
+        Stop training at the next progress step; on_done then gets (None, None).
+        """
+        self._cancel.set()
+
+    @property
+    def running(self) -> bool:
+        return not self._future.done()
+
+    def _progress(self, step: int, total: int, som) -> None:
+        if self._cancel.is_set():
+            raise TrainingCancelled()
+        self._doc.add_next_tick_callback(partial(self._on_progress, step, total))
+        now = time.monotonic()
+        if (self._on_snapshot is not None and now - self._last_snapshot >= self._snapshot_s
+                and (self._pending is None or self._pending.done())):
+            self._last_snapshot = now
+            self._pending = _SNAPSHOTS.submit(self._snapshot, som.get_weights().copy())
+
+    def _snapshot(self, weights: np.ndarray) -> None:
+        try:
+            som = restore_som({'weights': weights})
+            labels = cluster_nodes(som, n_clusters=self._n_clusters, method="connected")
+            if self._labels is not None and len(self._labels) == len(labels):
+                labels = align_labels(labels, self._labels)
+            self._labels = labels
+            self._doc.add_next_tick_callback(
+                partial(self._on_snapshot, som, compute_umatrix(som), labels))
+        except Exception:
+            log.exception("Summarizing a training snapshot failed")
+
+    def _run(self, pipe: Dict[str, object], params: Dict[str, object]) -> None:
+        result, error = None, None
+        try:
+            result = retrain_pipeline(pipe, progress=self._progress,
+                                      progress_every=self._progress_every, **params)
+        except TrainingCancelled:
+            pass
+        except Exception as exc:
+            log.exception("Retraining dataset %r failed", pipe['name'])
+            error = exc
+        self._doc.add_next_tick_callback(partial(self._on_done, result, error))
@@ -0,0 +1,209 @@
+# score.py
+
+"""
+Command-line batch scoring: project a new dataset onto a saved SOM.
+
+Streams a GeoPackage, CSV or Parquet file in chunks, applies the saved scale_data
+transform, assigns BMUs and hc_cluster across a process pool and appends the
+results to a CSV or Parquet file as chunks complete, so memory use stays flat
+regardless of input size.
+
+Usage:
+    python score.py data/mydata.model.npz data/other_year.gpkg out/other_year.parquet \\
+        --id-col region_id --workers 4
+"""
+
+import argparse
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from typing import Iterator, List
+
+import pandas as pd
+
+from data_loader import scale_data
+from som_model import load_model
+from bmu_search import BMUIndex
+
+
+# per-worker model state, set once by _init_worker
+_MODEL = None
+_INDEX = None
+
+
+def iter_chunks(
+    path: str,
+    columns: List[str],
+    chunk_size: int,
+    layer: str = None
+) -> Iterator[pd.DataFrame]:
+    """
+    Yield the given columns of a GeoPackage/CSV/Parquet/Feather file in chunks of rows.
+
+    Parameters:
+        path: input file; the format is detected as in data_loader.load_data.
+        columns: columns to read (features plus any id column); geometry is skipped.
+        chunk_size: rows per chunk.
+        layer: GeoPackage layer name (defaults to the first layer).
+
+    Returns:
+        An iterator of pandas DataFrames.
+    """
+    from data_loader import detect_format
+    fmt = detect_format(path)
+    if os.path.splitext(path)[1].lower() == ".csv":
+        yield from pd.read_csv(path, usecols=columns, chunksize=chunk_size)
+    elif fmt == "parquet":
+        import pyarrow.parquet as pq
+        for batch in pq.ParquetFile(path).iter_batches(batch_size=chunk_size, columns=columns):
+            yield batch.to_pandas()
+    elif fmt == "feather":
+        import pyarrow as pa
+        import pyarrow.ipc as ipc
+        # memory-mapped: only the selected columns' pages are actually read
+        table = ipc.open_file(pa.memory_map(path)).read_all().select(columns)
+        for batch in table.to_batches(max_chunksize=chunk_size):
+            yield batch.to_pandas()
+    else:
+        import geopandas as gpd
+        start = 0
+        while True:
+            chunk = gpd.read_file(
+                path, layer=layer, rows=slice(start, start + chunk_size),
+                columns=columns, ignore_geometry=True
+            )
+            if len(chunk) == 0:
+                return
+            yield pd.DataFrame(chunk[columns])
+            start += chunk_size
+
+
+def _init_worker(model_path: str, method: str) -> None:
+    global _MODEL, _INDEX
+    _MODEL = load_model(model_path)
+    w = _MODEL['weights']
+    _INDEX = BMUIndex(w.reshape(-1, w.shape[-1]), method=method)
+
+
+def _score_chunk(chunk: pd.DataFrame, id_col: str = None) -> pd.DataFrame:
+    features = _MODEL['feature_names']
+    scaled_df, _ = scale_data(chunk, scaler=_MODEL['scaler'], columns=features)
+    dist, ind = _INDEX.query(scaled_df[features].values, k=1)
+    bmu = ind[:, 0]
+    y_dim = _MODEL['weights'].shape[1]
+
+    out = pd.DataFrame({
+        'bmu_x': bmu // y_dim,
+        'bmu_y': bmu % y_dim,
+        'hc_cluster': _MODEL['node_labels'][bmu].astype(int),
+        'bmu_dist': dist[:, 0],
+    }, index=chunk.index)
+    if id_col is not None:
+        out.insert(0, id_col, chunk[id_col].values)
+    return out
+
+
+class _IncrementalWriter:
+    """
+    Append scored chunks to a CSV or Parquet file without holding them in memory.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.is_parquet = os.path.splitext(path)[1].lower() in (".parquet", ".geoparquet")
+        self._writer = None
+        self._first = True
+
+    def write(self, df: pd.DataFrame) -> None:
+        if self.is_parquet:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+            table = pa.Table.from_pandas(df, preserve_index=False)
+            if self._writer is None:
+                self._writer = pq.ParquetWriter(self.path, table.schema)
+            self._writer.write_table(table)
+        else:
+            df.to_csv(self.path, mode="w" if self._first else "a",
+                      header=self._first, index=False)
+        self._first = False
+
+    def close(self) -> None:
+        if self._writer is not None:
+            self._writer.close()
+
+
+def score_file(
+    model_path: str,
+    input_path: str,
+    output_path: str,
+    id_col: str = None,
+    chunk_size: int = 50000,
+    workers: int = None,
+    method: str = "kdtree",
+    layer: str = None
+) -> int:
+    """
+    Score input_path against the saved model and write results to output_path.
+
+    At most 2 × workers chunks are in flight, and results are written in input
+    order as soon as they are ready, so peak memory is bounded by the chunk size.
+
+    Parameters:
+        model_path: .npz written by som_model.save_model.
+        input_path: GeoPackage, CSV or Parquet file with the model's feature columns.
+        output_path: .csv or .parquet destination.
+        id_col: optional identifier column copied to the output.
+        chunk_size: rows per chunk.
+        workers: process pool size (defaults to the CPU count).
+        method: BMU search method (see bmu_search.BMUIndex).
+        layer: GeoPackage layer name.
+
+    Returns:
+        The number of rows scored.
+    """
+    features = load_model(model_path)['feature_names']
+    columns = features + ([id_col] if id_col and id_col not in features else [])
+    workers = workers or os.cpu_count() or 1
+
+    writer = _IncrementalWriter(output_path)
+    n_rows = 0
+    pending = deque()
+    with ProcessPoolExecutor(workers, initializer=_init_worker,
+                             initargs=(model_path, method)) as pool:
+        try:
+            for chunk in iter_chunks(input_path, columns, chunk_size, layer):
+                pending.append(pool.submit(_score_chunk, chunk, id_col))
+                if len(pending) >= 2 * workers:
+                    result = pending.popleft().result()
+                    writer.write(result)
+                    n_rows += len(result)
+            while pending:
+                result = pending.popleft().result()
+                writer.write(result)
+                n_rows += len(result)
+        finally:
+            writer.close()
+    return n_rows
+
+
+def main(argv: List[str] = None) -> None:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("model", help="model .npz written by som_model.save_model")
+    parser.add_argument("input", help="GeoPackage, CSV or Parquet file to score")
+    parser.add_argument("output", help=".csv or .parquet file to write")
+    parser.add_argument("--id-col", default=None, help="identifier column to carry through")
+    parser.add_argument("--chunk-size", type=int, default=50000)
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--method", default="kdtree",
+                        choices=["brute", "kdtree", "balltree", "approx"])
+    parser.add_argument("--layer", default=None, help="GeoPackage layer name")
+    args = parser.parse_args(argv)
+
+    n = score_file(args.model, args.input, args.output, id_col=args.id_col,
+                   chunk_size=args.chunk_size, workers=args.workers,
+                   method=args.method, layer=args.layer)
+    print(f"Scored {n} rows -> {args.output}")
+
+
+if __name__ == "__main__":
+    main()
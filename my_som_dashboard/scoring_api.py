@@ -0,0 +1,201 @@
+# scoring_api.py
+
+"""
+HTTP scoring endpoint served from the Bokeh server process: POST raw feature rows,
+get back their SOM units and clusters.
+
+Concurrent small requests are micro-batched into one vectorized BMU lookup
+against the shared in-memory codebook, keeping tail latency low under load.
+"""
+
+import asyncio
+import json
+import os
+from functools import partial
+from typing import Callable, Dict, List
+
+import numpy as np
+import pandas as pd
+from tornado.ioloop import IOLoop
+from tornado.web import RequestHandler, HTTPError
+
+from data_loader import scale_data
+from som_model import load_model
+from bmu_search import BMUIndex
+from pipeline import DEFAULT_DATASET, dataset_paths
+
+
+# process-wide models shared by all requests (and published by the dashboard),
+# keyed by dataset name: name -> (model, index)
+_MODELS = {}
+_BATCHERS = {}
+
+
+def publish_model(
+    model: Dict[str, object],
+    index: BMUIndex = None,
+    name: str = DEFAULT_DATASET
+) -> None:
+    """
+    Make a model the one the endpoint scores a dataset against.
+
+    Parameters:
+        model: dict shaped like som_model.load_model's output.
+        index: BMU index over model['weights']; built here if not given.
+        name: dataset name the model belongs to (?dataset=... on requests).
+    """
+    if index is None:
+        w = model['weights']
+        index = BMUIndex(w.reshape(-1, w.shape[-1]), method="kdtree")
+    _MODELS[name] = (model, index)
+
+
+def _ensure_model(name: str) -> Dict[str, object]:
+    if name not in _MODELS:
+        try:
+            model_path = dataset_paths(name)[1]
+        except (ValueError, FileNotFoundError) as exc:
+            raise HTTPError(404, reason=str(exc))
+        if not os.path.exists(model_path):
+            raise HTTPError(503, reason="No trained model available yet")
+        publish_model(load_model(model_path), name=name)
+    return _MODELS[name][0]
+
+
+def score_rows(values: np.ndarray, name: str = DEFAULT_DATASET) -> Dict[str, np.ndarray]:
+    """
+    Scale raw feature rows with the cached scaler and find their BMUs and clusters.
+
+    Parameters:
+        values: 2D array (rows × features) of raw values, in model feature order.
+        name: dataset whose published model to score against.
+
+    Returns:
+        {'bmu_x', 'bmu_y', 'hc_cluster', 'bmu_dist'} arrays, one entry per row.
+    """
+    model, index = _MODELS[name]
+    features = model['feature_names']
+    frame = pd.DataFrame(values, columns=features)
+    scaled_df, _ = scale_data(frame, scaler=model['scaler'], columns=features)
+    dist, ind = index.query(scaled_df[features].values, k=1)
+    bmu = ind[:, 0]
+    y_dim = model['weights'].shape[1]
+    return {
+        'bmu_x': bmu // y_dim,
+        'bmu_y': bmu % y_dim,
+        'hc_cluster': model['node_labels'][bmu].astype(int),
+        'bmu_dist': dist[:, 0],
+    }
+
+
+class MicroBatcher:
+    """
+    Coalesce concurrent scoring requests into one vectorized call.
+
+    A batch is flushed when it reaches max_rows or max_delay seconds after its
+    first request, whichever comes first; scoring runs in the IOLoop's default
+    executor so Bokeh sessions in the same process are not blocked.
+    """
+
+    def __init__(
+        self,
+        score_fn: Callable[[np.ndarray], Dict[str, np.ndarray]],
+        max_rows: int = 4096,
+        max_delay: float = 0.002
+    ):
+        self.score_fn = score_fn
+        self.max_rows = max_rows
+        self.max_delay = max_delay
+        self._pending = []
+        self._n_rows = 0
+        self._timer = None
+
+    async def submit(self, values: np.ndarray) -> Dict[str, np.ndarray]:
+        fut = asyncio.get_running_loop().create_future()
+        self._pending.append((values, fut))
+        self._n_rows += len(values)
+        if self._n_rows >= self.max_rows:
+            self._flush()
+        elif self._timer is None:
+            self._timer = IOLoop.current().call_later(self.max_delay, self._flush)
+        return await fut
+
+    def _flush(self) -> None:
+        if self._timer is not None:
+            IOLoop.current().remove_timeout(self._timer)
+            self._timer = None
+        batch, self._pending, self._n_rows = self._pending, [], 0
+        if batch:
+            IOLoop.current().add_callback(self._run, batch)
+
+    async def _run(self, batch: List) -> None:
+        sizes = [len(v) for v, _ in batch]
+        try:
+            res = await IOLoop.current().run_in_executor(
+                None, self.score_fn, np.vstack([v for v, _ in batch])
+            )
+        except Exception as exc:
+            if len(batch) > 1:
+                # isolate the failing request: score each one on its own
+                for item in batch:
+                    await self._run([item])
+                return
+            _, fut = batch[0]
+            if not fut.done():
+                fut.set_exception(exc)
+            return
+        start = 0
+        for size, (_, fut) in zip(sizes, batch):
+            if not fut.done():
+                fut.set_result({k: v[start:start + size] for k, v in res.items()})
+            start += size
+
+
+class ScoreHandler(RequestHandler):
+    """
+    POST /score[?dataset=name]
+
+    JSON body: {"rows": [[v1, v2, ...], ...]} in model feature order, or
+               {"rows": [{"feature": value, ...}, ...]}.
+    Binary body (Content-Type: application/octet-stream): little-endian float64
+               rows × features, row-major, in model feature order.
+
+    Responds with JSON {"bmu_x": [...], "bmu_y": [...], "hc_cluster": [...],
+    "bmu_dist": [...]}; GET returns the expected feature order.
+    """
+
+    def get(self):
+        model = _ensure_model(self.get_argument('dataset', DEFAULT_DATASET))
+        self.write({'feature_names': model['feature_names']})
+
+    async def post(self):
+        name = self.get_argument('dataset', DEFAULT_DATASET)
+        values = self._parse_rows(_ensure_model(name))
+        if name not in _BATCHERS:
+            _BATCHERS[name] = MicroBatcher(partial(score_rows, name=name))
+        res = await _BATCHERS[name].submit(values)
+        self.set_header("Content-Type", "application/json")
+        self.write(json.dumps({k: v.tolist() for k, v in res.items()}))
+
+    def _parse_rows(self, model: Dict[str, object]) -> np.ndarray:
+        features = model['feature_names']
+        n_features = len(features)
+        ctype = self.request.headers.get("Content-Type", "")
+        try:
+            if ctype.startswith("application/octet-stream"):
+                values = np.frombuffer(self.request.body, dtype="<f8").reshape(-1, n_features)
+            else:
+                rows = json.loads(self.request.body)["rows"]
+                if rows and isinstance(rows[0], dict):
+                    values = pd.DataFrame.from_records(rows)[features].values
+                else:
+                    values = np.asarray(rows, dtype=float).reshape(-1, n_features)
+            values = values.astype(float)
+        except (ValueError, KeyError, TypeError) as exc:
+            raise HTTPError(400, reason=f"Malformed rows: {exc}")
+        # rejected here, per request: one bad row would fail a whole micro-batch
+        bad = np.flatnonzero(~np.isfinite(values).all(axis=1))
+        if len(bad):
+            raise HTTPError(400, reason=f"Missing or non-finite values in row(s) "
+                                        f"{bad[:10].tolist()}")
+        return values
@@ -0,0 +1,53 @@
+# serve.py
+
+"""
+Launch the dashboard on a Bokeh server with the /score HTTP endpoint mounted
+alongside it (bokeh serve cannot add extra tornado handlers to a directory app).
+
+Usage:
+    python serve.py --port 5006 --allow-websocket-origin localhost:5006 \
+        --num-procs 4 --preload mydata
+"""
+
+import argparse
+import os
+
+from bokeh.application import Application
+from bokeh.application.handlers import DirectoryHandler
+from bokeh.server.server import Server
+
+from pipeline import prepare_pipeline, shared_dir_for
+from scoring_api import ScoreHandler
+from shared_data import export_shared
+
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Serve the SOM dashboard and scoring API.")
+    parser.add_argument("--port", type=int, default=5006)
+    parser.add_argument("--num-procs", type=int, default=1)
+    parser.add_argument("--allow-websocket-origin", action="append", default=None)
+    parser.add_argument("--preload", action="append", default=[],
+                        help="dataset to prepare and share with all workers before forking")
+    args = parser.parse_args()
+
+    # prepared once here, memory-mapped by every worker (see shared_data.py)
+    for name in args.preload:
+        export_shared(prepare_pipeline(name), shared_dir_for(name))
+
+    app = Application(DirectoryHandler(filename=HERE))
+    server = Server(
+        {"/my_som_dashboard": app},
+        port=args.port,
+        num_procs=args.num_procs,
+        allow_websocket_origin=args.allow_websocket_origin,
+        extra_patterns=[(r"/score", ScoreHandler)],
+    )
+    server.start()
+    server.io_loop.start()
+
+
+if __name__ == "__main__":
+    main()
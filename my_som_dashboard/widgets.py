@@ -1,12 +1,14 @@
 # widgets.py
 
 """
-Define interactive widgets: U-Matrix toggle and cluster-selection buttons.
+Define interactive widgets: U-Matrix toggle, component-plane selector, point
+locator, attribute filter, cluster-selection buttons, histogram variable and the
+retraining panel.
 """
 
-from bokeh.models import Toggle, Button
+from bokeh.models import Toggle, Button, Select, TextInput, Spinner, Div
 from bokeh.palettes import Category10
-from typing import List
+from typing import List, Dict
 
 def create_um_toggle() -> Toggle:
     """
@@ -15,6 +17,46 @@ def create_um_toggle() -> Toggle:
     return Toggle(label="Show U-Matrix", button_type="primary", active=False)
 
 
+def create_component_select(feature_names: List[str]) -> Select:
+    """
+    Dropdown for coloring the hex grid by a single feature's component plane.
+
+    Parameters:
+        feature_names: the SOM's input features, in training order.
+
+    Returns:
+        A Bokeh Select whose values are the 'cp_<feature>' columns of the node source
+        ("" means no plane, i.e. cluster / U-Matrix coloring).
+    """
+    options = [("", "(clusters)")] + [(f"cp_{c}", c) for c in feature_names]
+    return Select(title="Component plane", value="", options=options, width=200)
+
+
+def create_histogram_select(feature_names: List[str]) -> Select:
+    """
+    Dropdown choosing the variable of the linked selection histogram.
+    """
+    return Select(title="Histogram", value=feature_names[0], options=list(feature_names),
+                  width=200)
+
+
+def create_locate_input() -> TextInput:
+    """
+    Text box for locating the region containing an "x, y" point (map CRS).
+    """
+    return TextInput(title="Locate point", placeholder="x, y", width=200,
+                     name="locate_input")
+
+
+def create_filter_input() -> TextInput:
+    """
+    Text box for highlighting regions by attribute query (see
+    data_loader.query_attributes), e.g. "income > 30000 and cluster = 2".
+    """
+    return TextInput(title="Filter regions", placeholder="income > 30000 and cluster = 2",
+                     width=260, name="filter_input")
+
+
 def create_cluster_buttons(n_clusters: int) -> List[Button]:
     """
     Generate a list of Buttons for selecting clusters.
@@ -33,3 +75,34 @@ def create_cluster_buttons(n_clusters: int) -> List[Button]:
         btn = Button(label=str(i), css_classes=[f"cluster-btn-{i}"], width=30)
         buttons.append(btn)
     return buttons
+
+
+def create_training_controls(x_dim: int = 10, y_dim: int = 10) -> Dict[str, object]:
+    """
+    Retraining panel: SOM parameters, Train/Cancel buttons and a progress bar.
+
+    Parameters:
+        x_dim, y_dim: the current grid size, used as the initial values.
+
+    Returns:
+        {'x_dim', 'y_dim', 'sigma', 'learning_rate', 'iterations', 'random_seed':
+         Spinners named after som_model.train_som's arguments,
+         'multires': Toggle for train_som's coarse-to-fine training (large grids),
+         'snapshot_ms': interval of live hex-plot updates while training (0 = off),
+         'train', 'cancel': Buttons (cancel starts disabled),
+         'progress': Div showing the run's progress}.
+    """
+    return {
+        'x_dim': Spinner(title="Grid X", low=2, high=200, step=1, value=x_dim, width=80),
+        'y_dim': Spinner(title="Grid Y", low=2, high=200, step=1, value=y_dim, width=80),
+        'sigma': Spinner(title="Sigma", low=0.1, step=0.1, value=1.0, width=80),
+        'learning_rate': Spinner(title="Learning rate", low=0.01, high=1, step=0.05,
+                                 value=0.5, width=100),
+        'iterations': Spinner(title="Iterations", low=100, step=500, value=1000, width=100),
+        'random_seed': Spinner(title="Seed", low=0, step=1, value=42, width=80),
+        'multires': Toggle(label="Coarse-to-fine", active=False, width=110),
+        'snapshot_ms': Spinner(title="Animate (ms)", low=0, step=100, value=500, width=90),
+        'train': Button(label="Retrain", button_type="success", width=80),
+        'cancel': Button(label="Cancel", button_type="warning", width=80, disabled=True),
+        'progress': Div(text="", width=220),
+    }
@@ -0,0 +1,255 @@
+# writeback.py
+
+"""
+Write each region's BMU and cluster assignment back next to its geometry, in bulk
+and without re-serializing geometry that has not changed:
+
+- for a GeoPackage, as a plain attribute table keyed by the layer's feature ID,
+  in a sidecar GeoPackage (registered in gpkg_contents, so GIS tools can join it
+  to the layer). The source file is only read: its mtime and size stay as they
+  are, so the dashboard neither reloads it nor retrains its model;
+- as GeoParquet, by adding the columns to the Arrow table of an existing
+  GeoParquet file, whose WKB geometry is copied through undecoded.
+
+Usage:
+    python writeback.py mydata                        # table in data/mydata.som.gpkg
+    python writeback.py mydata --out out/mydata.parquet
+"""
+
+import argparse
+import os
+import pathlib
+import re
+import sqlite3
+from typing import Dict
+
+import numpy as np
+import pandas as pd
+
+from data_loader import detect_format, load_data
+
+
+def assignment_frame(pipe: Dict[str, object]) -> pd.DataFrame:
+    """
+    bmu_x, bmu_y and hc_cluster of every region, in data-file row order, built
+    from a pipeline's BMU and node-label arrays.
+    """
+    bmu, y_dim = np.asarray(pipe['bmu']), pipe['y_dim']
+    return pd.DataFrame({
+        'bmu_x': (bmu // y_dim).astype(np.int32),
+        'bmu_y': (bmu % y_dim).astype(np.int32),
+        'hc_cluster': np.asarray(pipe['node_labels'])[bmu].astype(np.int32),
+    })
+
+
+# the spatial reference systems every GeoPackage must define (GeoPackage 1.3, 1.1.2)
+_GPKG_SRS = [
+    ("Undefined cartesian SRS", -1, "NONE", -1, "undefined"),
+    ("Undefined geographic SRS", 0, "NONE", 0, "undefined"),
+    ("WGS 84 geodetic", 4326, "EPSG", 4326,
+     'GEOGCS["WGS 84",DATUM["WGS_1984",SPHEROID["WGS 84",6378137,298.257223563]],'
+     'PRIMEM["Greenwich",0],UNIT["degree",0.0174532925199433],AUTHORITY["EPSG","4326"]]'),
+]
+
+
+def _init_gpkg(con: sqlite3.Connection) -> None:
+    # the GeoPackage tables an attribute-only file needs (no-op on an existing one)
+    con.execute("PRAGMA application_id = 1196444487")  # 'GPKG'
+    con.execute("PRAGMA user_version = 10300")
+    con.execute(
+        "CREATE TABLE IF NOT EXISTS gpkg_spatial_ref_sys (srs_name TEXT NOT NULL, "
+        "srs_id INTEGER PRIMARY KEY, organization TEXT NOT NULL, "
+        "organization_coordsys_id INTEGER NOT NULL, definition TEXT NOT NULL, "
+        "description TEXT)"
+    )
+    con.executemany("INSERT OR IGNORE INTO gpkg_spatial_ref_sys (srs_name, srs_id, "
+                    "organization, organization_coordsys_id, definition) "
+                    "VALUES (?, ?, ?, ?, ?)", _GPKG_SRS)
+    con.execute(
+        "CREATE TABLE IF NOT EXISTS gpkg_contents (table_name TEXT NOT NULL PRIMARY KEY, "
+        "data_type TEXT NOT NULL, identifier TEXT UNIQUE, description TEXT DEFAULT '', "
+        "last_change DATETIME NOT NULL DEFAULT (strftime('%Y-%m-%dT%H:%M:%fZ','now')), "
+        "min_x DOUBLE, min_y DOUBLE, max_x DOUBLE, max_y DOUBLE, srs_id INTEGER, "
+        "CONSTRAINT fk_gc_r_srs_id FOREIGN KEY (srs_id) "
+        "REFERENCES gpkg_spatial_ref_sys(srs_id))"
+    )
+    # empty here, but GDAL only lists a GeoPackage's tables when it exists
+    con.execute(
+        "CREATE TABLE IF NOT EXISTS gpkg_geometry_columns (table_name TEXT NOT NULL, "
+        "column_name TEXT NOT NULL, geometry_type_name TEXT NOT NULL, "
+        "srs_id INTEGER NOT NULL, z TINYINT NOT NULL, m TINYINT NOT NULL, "
+        "CONSTRAINT pk_geom_cols PRIMARY KEY (table_name, column_name), "
+        "CONSTRAINT fk_gc_tn FOREIGN KEY (table_name) REFERENCES gpkg_contents(table_name), "
+        "CONSTRAINT fk_gc_srs FOREIGN KEY (srs_id) REFERENCES gpkg_spatial_ref_sys (srs_id))"
+    )
+
+
+def write_gpkg_table(
+    gpkg_path: str,
+    assignments: pd.DataFrame,
+    out_path: str = None,
+    table: str = "som_assignments",
+    layer: str = None
+) -> str:
+    """
+    Replace an attribute table of a sidecar GeoPackage with the assignments, keyed
+    by the source feature layer's primary key, in a single transaction.
+
+    The source GeoPackage is opened read-only and never written: changing its
+    mtime or size would make a dashboard serving it reload it, stale its
+    shared-memory export, and retrain its model on the next start (the saved
+    model would be older than the data).
+
+    Parameters:
+        gpkg_path: the GeoPackage holding the regions.
+        assignments: one row per feature, in load_data order (e.g. assignment_frame).
+        out_path: GeoPackage to write the table to, created if missing (default:
+            <data>.som.gpkg beside the source); never the source itself.
+        table: name of the attribute table to (re)create.
+        layer: feature layer the rows belong to (defaults to the first one).
+
+    Returns:
+        The path written.
+    """
+    for name in (table, layer):
+        if name is not None and not re.fullmatch(r"[A-Za-z_][A-Za-z0-9_]*", name):
+            raise ValueError(f"Invalid table name: {name!r}")
+    if out_path is None:
+        out_path = os.path.splitext(gpkg_path)[0] + ".som.gpkg"
+    if os.path.abspath(out_path) == os.path.abspath(gpkg_path):
+        raise ValueError("Refusing to write assignments into the dataset's own data file")
+
+    src = sqlite3.connect(pathlib.Path(os.path.abspath(gpkg_path)).as_uri() + "?mode=ro",
+                          uri=True)
+    try:
+        if layer is None:
+            layer = src.execute(
+                "SELECT table_name FROM gpkg_contents WHERE data_type = 'features' "
+                "ORDER BY rowid LIMIT 1"
+            ).fetchone()[0]
+        pk = next(r[1] for r in src.execute(f'PRAGMA table_info("{layer}")') if r[5])
+        # OGR reads GeoPackage features in primary-key order, so row i of
+        # load_data is the layer's i-th smallest feature ID
+        fids = [r[0] for r in src.execute(f'SELECT "{pk}" FROM "{layer}" ORDER BY "{pk}"')]
+    finally:
+        src.close()
+    if len(fids) != len(assignments):
+        raise ValueError(f"{len(assignments)} assignments for {len(fids)} features "
+                         f"in layer {layer!r}")
+
+    con = sqlite3.connect(out_path)
+    try:
+        with con:  # one transaction: readers see the old table or the new one
+            _init_gpkg(con)
+            cols = list(assignments.columns)
+            con.execute(f'DROP TABLE IF EXISTS "{table}"')
+            con.execute(f'CREATE TABLE "{table}" ("{pk}" INTEGER PRIMARY KEY, '
+                        + ", ".join(f'"{c}" INTEGER' for c in cols) + ")")
+            con.executemany(
+                f'INSERT INTO "{table}" VALUES ({", ".join("?" * (len(cols) + 1))})',
+                zip(fids, *(assignments[c].astype(int).tolist() for c in cols))
+            )
+            con.execute("DELETE FROM gpkg_contents WHERE table_name = ?", (table,))
+            con.execute(
+                "INSERT INTO gpkg_contents (table_name, data_type, identifier, last_change) "
+                "VALUES (?, 'attributes', ?, strftime('%Y-%m-%dT%H:%M:%fZ', 'now'))",
+                (table, table)
+            )
+    finally:
+        con.close()
+    return out_path
+
+
+def write_geoparquet(
+    src_path: str,
+    assignments: pd.DataFrame,
+    out_path: str
+) -> str:
+    """
+    Write the regions of src_path plus the assignment columns as GeoParquet.
+
+    A GeoParquet source goes through Arrow only: the columns are added to its
+    table and the WKB geometry, metadata and row-group size are kept as they
+    are. Other sources are read once with GeoPandas and written with to_parquet.
+
+    Parameters:
+        src_path: the dataset's data file.
+        assignments: one row per region, in load_data order.
+        out_path: destination .parquet path (replaced atomically).
+
+    Returns:
+        out_path.
+    """
+    tmp = out_path + ".tmp"
+    if detect_format(src_path) == "parquet":
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        src = pq.ParquetFile(src_path)
+        table = src.read()
+        metadata = table.schema.metadata
+        for c in assignments.columns:
+            arr = pa.array(assignments[c].to_numpy())
+            if c in table.column_names:
+                table = table.set_column(table.column_names.index(c), c, arr)
+            else:
+                table = table.append_column(c, arr)
+        row_group_size = (src.metadata.row_group(0).num_rows
+                          if src.metadata.num_row_groups else None)
+        pq.write_table(table.replace_schema_metadata(metadata), tmp,
+                       row_group_size=row_group_size)
+    else:
+        gdf = load_data(src_path)
+        for c in assignments.columns:
+            gdf[c] = assignments[c].values
+        gdf.to_parquet(tmp, index=False)
+    os.replace(tmp, out_path)
+    return out_path
+
+
+def write_assignments(
+    data_path: str,
+    assignments: pd.DataFrame,
+    out_path: str = None,
+    table: str = "som_assignments"
+) -> str:
+    """
+    Write assignments back for a dataset: for a GeoPackage source, to an
+    attribute table in a sidecar GeoPackage when out_path is None or a .gpkg
+    (default: <data>.som.gpkg), else to the GeoParquet file out_path (default:
+    <data>.som.parquet beside a columnar source). Never into the source itself,
+    whose new columns would become features and whose changed mtime would
+    trigger a reload and retrain.
+
+    Returns:
+        The path written.
+    """
+    is_gpkg = (detect_format(data_path) == "ogr"
+               and os.path.splitext(data_path)[1].lower() == ".gpkg")
+    if is_gpkg and (out_path is None or out_path.lower().endswith(".gpkg")):
+        return write_gpkg_table(data_path, assignments, out_path=out_path, table=table)
+    if out_path is None:
+        out_path = os.path.splitext(data_path)[0] + ".som.parquet"
+    if os.path.abspath(out_path) == os.path.abspath(data_path):
+        raise ValueError("Refusing to add assignment columns to the dataset's own data file")
+    return write_geoparquet(data_path, assignments, out_path)
+
+
+def main() -> None:
+    from pipeline import PIPELINES
+
+    parser = argparse.ArgumentParser(description="Write BMU/cluster assignments back to files.")
+    parser.add_argument("dataset", help="dataset name (data/<name>.gpkg or .parquet)")
+    parser.add_argument("--out", help="GeoParquet or GeoPackage output "
+                        "(default: <data>.som.gpkg or <data>.som.parquet)")
+    parser.add_argument("--table", default="som_assignments",
+                        help="GeoPackage attribute table name")
+    args = parser.parse_args()
+
+    pipe = PIPELINES.get(args.dataset)
+    print(write_assignments(pipe['data_path'], assignment_frame(pipe),
+                            out_path=args.out, table=args.table))
+
+
+if __name__ == "__main__":
+    main()